@@ -1,19 +1,55 @@
 from run_strategies.portfolio_return import (
+    find_returns_per_mo_stock,
     get_equal_and_value_portfolios_return_per_month,
 )
-from run_strategies.two_stage_momentum import get_two_stage_momentum_splits
+from run_strategies.two_stage_momentum import (
+    get_two_stage_momentum_splits,
+    reset_random_day_rng,
+)
+from run_strategies.conditional_sort import get_conditional_momentum_splits
 from run_strategies.final_strat_stats import get_final_strategy_stats
+from run_strategies.prefetch import estimate_period_nbytes, load_period_data, prefetch
+from utils import MODEL_NAMES
 import pandas as pd
+import sys
+
+
+PERIODS = [(1993, 2005), (2005, 2024)]
+COST_SENSITIVITIES = [0, 1, 6, 12]
 
 
-def run_two_stage_momentum_sorting():
+def prefetch_periods():
     """
-    Runs the two-stage momentum sort
+    Yields each period with its data, loaded once for all cost
+    sensitivities while the previous period is run
     """
-    for cost_sensitivity in [0, 1, 6, 12]:
-        print(f"running cost sensitivity equal to {cost_sensitivity}")
-        for split in [(1993, 2005), (2005, 2024)]:
-            get_two_stage_momentum_splits(*split, cost_sensitivity=cost_sensitivity)
+    return prefetch(PERIODS, load_period_data, estimate_func=estimate_period_nbytes)
+
+
+def run_two_stage_momentum_sorting(conditioning: str = None):
+    """
+    Runs the two-stage momentum sort, or the conditional double sort on
+    the conditioning variable, the next period's data is loaded in the
+    background while the current one is sorted. Spread days of each
+    period and cost sensitivity are drawn with their own seed, so splits
+    do not depend on the order of the runs
+    """
+    for split, data in prefetch_periods():
+        for cost_sensitivity in COST_SENSITIVITIES:
+            print(f"running cost sensitivity equal to {cost_sensitivity}, {split}")
+            reset_random_day_rng((*split, cost_sensitivity))
+            if conditioning is None:
+                get_two_stage_momentum_splits(
+                    *split, cost_sensitivity=cost_sensitivity, data=data
+                )
+            else:
+                get_conditional_momentum_splits(
+                    *split,
+                    cost_sensitivity=cost_sensitivity,
+                    conditioning=conditioning,
+                    data=data,
+                )
+        del data
 
 
 def create_csvs(
@@ -25,16 +61,18 @@ def create_csvs(
     start_year,
     end_year,
     cost_sensitivity,
+    conditioning=None,
 ):
+    suffix = "" if conditioning is None else f"_{conditioning}"
     pd.DataFrame.from_dict(returns_equal, orient="index").rename_axis(
         ["year", "month"]
     ).to_csv(
-        f"ret_cost_{model_names[(hedged, sigma_model_rv)]}_equal_{start_year}_{end_year}_lambda_{cost_sensitivity}.csv"
+        f"ret_cost_{model_names[(hedged, sigma_model_rv)]}_equal_{start_year}_{end_year}_lambda_{cost_sensitivity}{suffix}.csv"
     )
     pd.DataFrame.from_dict(returns_value, orient="index").rename_axis(
         ["year", "month"]
     ).to_csv(
-        f"ret_cost_{model_names[(hedged, sigma_model_rv)]}_value_{start_year}_{end_year}_lambda_{cost_sensitivity}.csv"
+        f"ret_cost_{model_names[(hedged, sigma_model_rv)]}_value_{start_year}_{end_year}_lambda_{cost_sensitivity}{suffix}.csv"
     )
 
     print(
@@ -42,18 +80,19 @@ def create_csvs(
     )
 
 
-def run_portfolio_return():
+def run_portfolio_return(conditioning: str = None):
     """
-    Runs portfolio return for each strategy
+    Runs portfolio return for each strategy, on the conditional double
+    sort legs if a conditioning variable is given. The next period's data
+    is loaded in the background and each period's monthly stock returns
+    are shared by all cost sensitivities and models
     """
-    model_names = {
-        (False, False): "standard",
-        (True, True): "hedged_rv",
-        (True, False): "hedged_garch",
-    }
-    for cost_sensitivity in [0, 1, 6, 12]:
-        print(f"running cost sensitivity equal to {cost_sensitivity}")
-        for start_year, end_year in [(1993, 2005), (2005, 2024)]:
+    model_names = MODEL_NAMES
+    for (start_year, end_year), data in prefetch_periods():
+        cum_returns_per_month = find_returns_per_mo_stock(data)
+        del data
+        for cost_sensitivity in COST_SENSITIVITIES:
+            print(f"running cost sensitivity equal to {cost_sensitivity}")
             for hedged, sigma_model_rv in model_names:
                 args = {
                     "start_year": start_year,
@@ -61,9 +100,12 @@ def run_portfolio_return():
                     "hedged": hedged,
                     "sigma_model_rv": sigma_model_rv,
                     "cost_sensitivity": cost_sensitivity,
+                    "conditioning": conditioning,
                 }
                 returns_equal, returns_value = (
-                    get_equal_and_value_portfolios_return_per_month(**args)
+                    get_equal_and_value_portfolios_return_per_month(
+                        **args, cum_returns_per_month=cum_returns_per_month
+                    )
                 )
 
                 create_csvs(
@@ -74,19 +116,21 @@ def run_portfolio_return():
                 )
 
 
-def main() -> None:
+def main(conditioning: str = None) -> None:
     print("running two-stage momentum sorting...")
-    run_two_stage_momentum_sorting()
+    run_two_stage_momentum_sorting(conditioning)
     print("finished running two-stage momentum sorting")
 
     print("running portfolio return...")
-    run_portfolio_return()
+    run_portfolio_return(conditioning)
     print("finished running portfolio return")
 
-    print("running final strategy statistics...")
-    get_final_strategy_stats()
-    print("finished running final strategy statistics")
+    # Statistics cover the standard sort's strategies
+    if conditioning is None:
+        print("running final strategy statistics...")
+        get_final_strategy_stats()
+        print("finished running final strategy statistics")
 
 
 if __name__ == "__main__":
-    main()
+    main(*sys.argv[1:2])
@@ -0,0 +1,156 @@
+from concurrent.futures import ProcessPoolExecutor
+from post_run_analysis.quoted_bid_ask_analysis import (
+    get_avg_quoted_bid_ask_series,
+    plot_quoted_spread_series,
+)
+from post_run_analysis.trading_cost_analysis import (
+    construct_df,
+    get_costs_for_lambdas,
+    plot_trading_costs,
+    print_cost_statistics,
+)
+from post_run_analysis.volatility_prediction_analysis import (
+    get_vol_predictions_per_model,
+    get_true_volatilities,
+    plot_vol_predictions,
+    get_mse_analysis,
+)
+from utils import HEDGING, WEIGHTINGS
+import matplotlib
+import os
+
+
+def use_headless_backend() -> None:
+    """
+    Switches to a non-interactive backend, so no figure ever blocks
+    """
+    matplotlib.use("Agg")
+
+
+def render_figure(figure_job: tuple) -> str:
+    """
+    Renders one figure to file and returns its path
+    """
+    plot_func, args, save_path = figure_job
+    plot_func(*args, save_path=save_path)
+
+    return save_path
+
+
+def get_quoted_spread_figure_jobs(output_dir: str) -> list:
+    """
+    Gets figure jobs of the quoted bid-ask spread analysis
+    """
+    return [
+        (
+            "Quoted bid-ask spread progression",
+            plot_quoted_spread_series,
+            (
+                get_avg_quoted_bid_ask_series(),
+                "Quoted bid-ask spread progression",
+                "Year",
+                "Average quoted bid-ask spread across all stocks",
+            ),
+            os.path.join(output_dir, "quoted_spread.png"),
+        )
+    ]
+
+
+def get_trading_cost_figure_jobs(output_dir: str) -> list:
+    """
+    Gets figure jobs of the trading cost analysis
+    """
+    costs_per_strategy = construct_df("ret_cost_ts.csv")
+    figure_jobs = []
+
+    for strat in HEDGING:
+        for weighting in WEIGHTINGS:
+            curr_df = get_costs_for_lambdas(costs_per_strategy, strat, weighting)
+            print_cost_statistics(curr_df, strat, weighting)
+            figure_jobs.append(
+                (
+                    f"Trading costs: {strat}, {weighting}",
+                    plot_trading_costs,
+                    (curr_df, f"{strat}, {weighting}"),
+                    os.path.join(output_dir, f"trading_costs_{strat}_{weighting}.png"),
+                )
+            )
+
+    return figure_jobs
+
+
+def get_volatility_figure_jobs(
+    output_dir: str, model_names: tuple = ("GARCH", "RV")
+) -> list:
+    """
+    Gets figure jobs of the volatility prediction analysis
+    """
+    vol_predictions = get_vol_predictions_per_model(model_names)
+    true_rv = get_true_volatilities(
+        "ret_cost_standard_value_1993_2005_lambda_0.csv",
+        "ret_cost_standard_value_2005_2024_lambda_0.csv",
+    )
+    get_mse_analysis(vol_predictions, true_rv)
+
+    return [
+        (
+            "Volatility predictions",
+            plot_vol_predictions,
+            (vol_predictions, true_rv),
+            os.path.join(output_dir, "volatility_predictions.png"),
+        )
+    ]
+
+
+def write_report_index(figure_jobs: list, output_dir: str) -> str:
+    """
+    Writes a single html index of all rendered figures
+    """
+    index_path = os.path.join(output_dir, "index.html")
+    sections = [
+        f'<h2>{title}</h2>\n<img src="{os.path.basename(save_path)}">'
+        for title, _, _, save_path in figure_jobs
+    ]
+
+    with open(index_path, "w") as file:
+        file.write(
+            "<html>\n<head><title>Analysis report</title></head>\n<body>\n"
+            + "\n".join(sections)
+            + "\n</body>\n</html>\n"
+        )
+
+    return index_path
+
+
+def run_batch_report(output_dir: str = "report", max_workers: int = None) -> str:
+    """
+    Renders all analysis figures to files in parallel, without any
+    interactive window, and writes a report index
+    """
+    use_headless_backend()
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Series are computed once here, workers only draw them
+    figure_jobs = (
+        get_quoted_spread_figure_jobs(output_dir)
+        + get_trading_cost_figure_jobs(output_dir)
+        + get_volatility_figure_jobs(output_dir)
+    )
+
+    with ProcessPoolExecutor(
+        max_workers=max_workers, initializer=use_headless_backend
+    ) as executor:
+        for save_path in executor.map(
+            render_figure,
+            [
+                (plot_func, args, save_path)
+                for _, plot_func, args, save_path in figure_jobs
+            ],
+        ):
+            print(f"rendered {save_path}")
+
+    return write_report_index(figure_jobs, output_dir)
+
+
+if __name__ == "__main__":
+    run_batch_report()
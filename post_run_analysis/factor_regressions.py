@@ -0,0 +1,168 @@
+from numpy.lib.stride_tricks import sliding_window_view
+from post_run_analysis.significance_tests import (
+    get_newey_west_lags,
+    load_monthly_series,
+)
+import numpy as np
+import pandas as pd
+import scipy.stats as stats
+import os
+
+
+FACTOR_PATH = "F-F_Research_Data_Factors.csv"
+
+
+def load_factor_returns(path: str = FACTOR_PATH, factors: list = None) -> pd.DataFrame:
+    """
+    Loads monthly factor returns from a Kenneth French style csv, the
+    percentage rows of yyyymm dates, as decimal returns per month
+    """
+    with open(path) as file:
+        lines = [line.strip() for line in file]
+
+    rows, columns = [], None
+    for line_num, line in enumerate(lines):
+        fields = [field.strip() for field in line.split(",")]
+        is_monthly_row = len(fields[0]) == 6 and fields[0].isdigit()
+        if not is_monthly_row:
+            # Annual rows follow the monthly block, separated by other lines
+            if rows:
+                break
+            continue
+        if columns is None:
+            columns = [field.strip() for field in lines[line_num - 1].split(",")[1:]]
+        rows.append(fields)
+
+    factor_returns = pd.DataFrame(
+        [[float(field) / 100 for field in row[1:]] for row in rows],
+        index=pd.PeriodIndex([row[0] for row in rows], freq="M", name="month"),
+        columns=columns,
+    )
+
+    return factor_returns if factors is None else factor_returns[factors]
+
+
+def get_regression_data(
+    returns: pd.DataFrame, factor_returns: pd.DataFrame
+) -> tuple[np.ndarray, np.ndarray, pd.PeriodIndex]:
+    """
+    Aligns strategy returns with the factors on their common months and
+    returns the shared design matrix, with a constant, and the responses
+    """
+    returns = returns.set_axis(pd.to_datetime(returns.index).to_period("M"))
+    data = returns.join(factor_returns, how="inner").dropna()
+    design = np.column_stack(
+        [np.ones(len(data)), data[factor_returns.columns].to_numpy()]
+    )
+
+    return design, data[returns.columns].to_numpy(dtype=float), data.index
+
+
+def newey_west_coef_std(
+    design: np.ndarray, residuals: np.ndarray, lags: int
+) -> np.ndarray:
+    """
+    Computes HAC standard errors of the coefficients of all regressions
+    sharing one design matrix, returns (coefficients x series)
+    """
+    num_periods = design.shape[0]
+    # Scores of each period, (periods x coefficients x series)
+    scores = design[:, :, None] * residuals[:, None, :]
+    long_run_cov = np.einsum("tkn,tmn->nkm", scores, scores) / num_periods
+
+    for lag in range(1, lags + 1):
+        autocov = np.einsum("tkn,tmn->nkm", scores[lag:], scores[:-lag]) / num_periods
+        long_run_cov += (1 - lag / (lags + 1)) * (autocov + autocov.transpose(0, 2, 1))
+
+    inv_design_cov = np.linalg.inv(design.T @ design / num_periods)
+    coef_cov = inv_design_cov @ long_run_cov @ inv_design_cov / num_periods
+
+    return np.sqrt(np.diagonal(coef_cov, axis1=1, axis2=2)).T
+
+
+def get_factor_regressions(
+    returns: pd.DataFrame, factor_returns: pd.DataFrame, lags: int = None
+) -> pd.DataFrame:
+    """
+    Regresses all strategy return series on the factors in one least
+    squares solve, with Newey-West t-statistics of alphas and betas
+    """
+    design, responses, months = get_regression_data(returns, factor_returns)
+    if lags is None:
+        lags = get_newey_west_lags(len(months))
+
+    coefs = np.linalg.lstsq(design, responses, rcond=None)[0]
+    residuals = responses - design @ coefs
+    t_stats = coefs / newey_west_coef_std(design, residuals, lags)
+    r_squared = 1 - (residuals**2).sum(axis=0) / (
+        (responses - responses.mean(axis=0)) ** 2
+    ).sum(axis=0)
+
+    coef_names = ["alpha", *[f"beta_{factor}" for factor in factor_returns.columns]]
+    regressions = {
+        **dict(zip(coef_names, coefs)),
+        **{f"{name}_nw_t": t_stat for name, t_stat in zip(coef_names, t_stats)},
+        "alpha_nw_p-value": 2 * (1 - stats.norm.cdf(np.abs(t_stats[0]))),
+        "annualized_alpha": 12 * coefs[0],
+        "r_squared": r_squared,
+        "num_months": len(months),
+    }
+
+    return pd.DataFrame(regressions, index=returns.columns)
+
+
+def get_rolling_alphas(
+    returns: pd.DataFrame, factor_returns: pd.DataFrame, window: int = 36
+) -> pd.DataFrame:
+    """
+    Computes alphas of all series over rolling windows of months, solving
+    the normal equations of all windows in one batch
+    """
+    design, responses, months = get_regression_data(returns, factor_returns)
+    # (windows x months x columns) views
+    design_windows, response_windows = (
+        np.moveaxis(sliding_window_view(values, window, axis=0), -1, 1)
+        for values in (design, responses)
+    )
+    design_windows_t = design_windows.transpose(0, 2, 1)
+    coefs = np.linalg.solve(
+        design_windows_t @ design_windows, design_windows_t @ response_windows
+    )
+
+    return pd.DataFrame(
+        coefs[:, 0, :], index=months[window - 1 :], columns=returns.columns
+    )
+
+
+def run_factor_regressions(
+    path: str = "ret_cost_ts.csv",
+    factor_path: str = FACTOR_PATH,
+    factors: list = None,
+    rolling_window: int = 36,
+) -> dict:
+    """
+    Runs factor regressions of gross and net returns of all strategies
+    and saves the estimates and rolling alphas to csv files
+    """
+    if not os.path.exists(factor_path):
+        print(f"{factor_path} not found, skipping factor regressions")
+        return dict()
+
+    factor_returns = load_factor_returns(factor_path, factors)
+    # Long-short returns are already excess returns
+    factor_returns = factor_returns.drop(columns="RF", errors="ignore")
+    results = dict()
+
+    for ret_type, returns in load_monthly_series(path).items():
+        returns.columns = ["_".join(col) for col in returns.columns]
+        results[ret_type] = get_factor_regressions(returns, factor_returns)
+        results[ret_type].to_csv(f"factor_regressions_{ret_type}.csv")
+        get_rolling_alphas(returns, factor_returns, rolling_window).to_csv(
+            f"rolling_alphas_{ret_type}_{rolling_window}.csv"
+        )
+
+    return results
+
+
+if __name__ == "__main__":
+    run_factor_regressions()
@@ -0,0 +1,14 @@
+import matplotlib.pyplot as plt
+
+
+def finish_plot(save_path: str = None) -> None:
+    """
+    Shows the current figure, or renders it to file and closes it
+    when a path is given
+    """
+    if save_path is None:
+        plt.show()
+        return
+
+    plt.savefig(save_path)
+    plt.close()
@@ -1,17 +1,14 @@
-from utils import extract_data
+from utils import load_monthly_aggregates
 import pandas as pd
 import matplotlib.pyplot as plt
+from post_run_analysis.plot_utils import finish_plot
 
 
 def get_avg_quoted_bid_asks(data_file: str) -> pd.Series:
     """
     Gets average quoted bid ask spreads per month
     """
-    data = extract_data(data_file)
-
-    return data.groupby(["year", "month"])[["quoted_spread"]].agg(
-        quoted_spread=("quoted_spread", "mean")
-    )["quoted_spread"]
+    return load_monthly_aggregates(data_file)["mean_quoted_spread"]
 
 
 def plot_quoted_spread_series(
@@ -19,6 +16,7 @@ def plot_quoted_spread_series(
     plot_title: str,
     plot_x_label: str,
     plot_y_label: str,
+    save_path: str = None,
 ) -> None:
     """
     Plots series of quoted bid-ask spreads development over time
@@ -35,12 +33,12 @@ def plot_quoted_spread_series(
     plt.xlabel(plot_x_label)
     plt.ylabel(plot_y_label)
 
-    plt.show()
+    finish_plot(save_path)
 
 
-def get_quoted_bid_ask_spread_analysis() -> None:
+def get_avg_quoted_bid_ask_series() -> pd.Series:
     """
-    Gets quoted bid-ask spread analysis
+    Gets average quoted bid-ask spread per month over the full sample
     """
     avg_quoted_bid_asks: pd.Series = pd.concat(
         [
@@ -56,8 +54,15 @@ def get_quoted_bid_ask_spread_analysis() -> None:
         [f"{year}-{month:02d}" for year, month in avg_quoted_bid_asks.index]
     )
 
+    return avg_quoted_bid_asks
+
+
+def get_quoted_bid_ask_spread_analysis() -> None:
+    """
+    Gets quoted bid-ask spread analysis
+    """
     plot_quoted_spread_series(
-        avg_quoted_bid_asks,
+        get_avg_quoted_bid_ask_series(),
         "Quoted bid-ask spread progression",
         "Year",
         "Average quoted bid-ask spread across all stocks",
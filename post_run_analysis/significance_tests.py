@@ -0,0 +1,210 @@
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import numpy as np
+import pandas as pd
+import scipy.stats as stats
+
+
+def load_monthly_series(path: str = "ret_cost_ts.csv") -> dict:
+    """
+    Loads gross and net monthly returns of all strategies as
+    (months x strategies) frames
+    """
+    series = pd.read_csv(path, header=[0, 1, 2, 3], index_col=0)
+    gross = series.xs("gross_return", axis=1, level=3)
+    costs = series.xs("costs", axis=1, level=3)
+
+    return {"gross": gross, "net": gross - costs[gross.columns]}
+
+
+def get_pair_indices(num_strategies: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns index arrays of all unordered strategy pairs
+    """
+    pairs = np.array(list(itertools.combinations(range(num_strategies), 2)))
+
+    return pairs[:, 0], pairs[:, 1]
+
+
+def get_newey_west_lags(num_periods: int) -> int:
+    """
+    Returns the usual automatic Newey-West lag truncation
+    """
+    return int(np.floor(4 * (num_periods / 100) ** (2 / 9)))
+
+
+def newey_west_mean_std(series: np.ndarray, lags: int) -> np.ndarray:
+    """
+    Computes HAC standard errors of the mean of each column
+    """
+    num_periods = series.shape[0]
+    demeaned = series - series.mean(axis=0)
+    long_run_var = (demeaned**2).sum(axis=0) / num_periods
+
+    for lag in range(1, lags + 1):
+        autocov = (demeaned[lag:] * demeaned[:-lag]).sum(axis=0) / num_periods
+        long_run_var += 2 * (1 - lag / (lags + 1)) * autocov
+
+    return np.sqrt(long_run_var / num_periods)
+
+
+def stationary_bootstrap_indices(
+    rng: np.random.Generator, num_draws: int, num_periods: int, block_length: float
+) -> np.ndarray:
+    """
+    Draws (draws x months) resampling indices of the stationary bootstrap
+    (geometric block lengths, circular wrap)
+    """
+    new_block = rng.random((num_draws, num_periods)) < 1 / block_length
+    new_block[:, 0] = True
+    block_starts = rng.integers(0, num_periods, (num_draws, num_periods))
+
+    periods = np.broadcast_to(np.arange(num_periods), (num_draws, num_periods))
+    last_start_period = np.maximum.accumulate(np.where(new_block, periods, 0), axis=1)
+    start_values = np.take_along_axis(block_starts, last_start_period, axis=1)
+
+    return (start_values + periods - last_start_period) % num_periods
+
+
+def moving_block_bootstrap_indices(
+    rng: np.random.Generator, num_draws: int, num_periods: int, block_length: float
+) -> np.ndarray:
+    """
+    Draws (draws x months) resampling indices of the moving block bootstrap
+    """
+    block_length = int(block_length)
+    num_blocks = -(-num_periods // block_length)
+    block_starts = rng.integers(
+        0, num_periods - block_length + 1, (num_draws, num_blocks)
+    )
+
+    indices = block_starts[:, :, None] + np.arange(block_length)
+
+    return indices.reshape(num_draws, -1)[:, :num_periods]
+
+
+BOOTSTRAP_METHODS = {
+    "stationary": stationary_bootstrap_indices,
+    "moving_block": moving_block_bootstrap_indices,
+}
+
+
+def bootstrap_means_chunk(
+    series: np.ndarray,
+    num_draws: int,
+    method: str,
+    block_length: float,
+    seed: np.random.SeedSequence,
+) -> np.ndarray:
+    """
+    Computes (draws x strategies) resampled means for one chunk of draws
+    """
+    indices = BOOTSTRAP_METHODS[method](
+        np.random.default_rng(seed), num_draws, series.shape[0], block_length
+    )
+
+    return series[indices].mean(axis=1)
+
+
+def bootstrap_means(
+    series: np.ndarray,
+    num_draws: int = 10000,
+    method: str = "stationary",
+    block_length: float = 6,
+    chunk_size: int = 1000,
+    max_workers: int = None,
+    seed: int = 1,
+) -> np.ndarray:
+    """
+    Computes resampled means of all strategies, with chunks of draws
+    spread across processes so the (draws x months x strategies) tensor
+    never has to be held at once
+    """
+    chunk_sizes = [chunk_size] * (num_draws // chunk_size)
+    if num_draws % chunk_size:
+        chunk_sizes.append(num_draws % chunk_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        chunks = executor.map(
+            bootstrap_means_chunk,
+            itertools.repeat(series),
+            chunk_sizes,
+            itertools.repeat(method),
+            itertools.repeat(block_length),
+            seeds,
+        )
+
+        return np.concatenate(list(chunks))
+
+
+def get_pairwise_tests(
+    returns: pd.DataFrame,
+    num_draws: int = 10000,
+    method: str = "stationary",
+    block_length: float = 6,
+    significance_level: float = 0.05,
+    max_workers: int = None,
+) -> pd.DataFrame:
+    """
+    Tests equality of mean returns for all strategy pairs at once,
+    with Newey-West t-statistics and block-bootstrap p-values
+    """
+    series = returns.to_numpy(dtype=float)
+    first, second = get_pair_indices(series.shape[1])
+
+    mean_diffs = series[:, first].mean(axis=0) - series[:, second].mean(axis=0)
+    nw_std = newey_west_mean_std(
+        series[:, first] - series[:, second], get_newey_west_lags(series.shape[0])
+    )
+    nw_t_stats = mean_diffs / nw_std
+
+    resampled_means = bootstrap_means(
+        series, num_draws, method, block_length, max_workers=max_workers
+    )
+    resampled_diffs = resampled_means[:, first] - resampled_means[:, second]
+    bootstrap_p_values = (
+        np.abs(resampled_diffs - mean_diffs) >= np.abs(mean_diffs)
+    ).mean(axis=0)
+
+    return pd.DataFrame(
+        {
+            "mean_difference": mean_diffs,
+            "nw_test_statistic": nw_t_stats,
+            "nw_p-value": 2 * (1 - stats.norm.cdf(np.abs(nw_t_stats))),
+            "bootstrap_p-value": bootstrap_p_values,
+            "conclusion": np.where(
+                bootstrap_p_values < significance_level, "reject", "not reject"
+            ),
+        },
+        index=pd.MultiIndex.from_arrays(
+            [returns.columns[first], returns.columns[second]],
+            names=["strategy_1", "strategy_2"],
+        ),
+    )
+
+
+def get_significance_analysis(
+    path: str = "ret_cost_ts.csv", num_draws: int = 10000
+) -> dict:
+    """
+    Runs pairwise significance tests on gross and net returns of all
+    strategies and saves them to csv files
+    """
+    results = dict()
+
+    for ret_type, returns in load_monthly_series(path).items():
+        returns.columns = ["_".join(col) for col in returns.columns]
+        results[ret_type] = get_pairwise_tests(returns, num_draws)
+        results[ret_type].to_csv(f"significance_tests_{ret_type}.csv")
+        num_rejected = (results[ret_type]["conclusion"] == "reject").sum()
+        print(
+            f"{ret_type}: {num_rejected} of {len(results[ret_type])} "
+            + "strategy pairs differ significantly"
+        )
+
+    return results
+
+
+if __name__ == "__main__":
+    get_significance_analysis()
@@ -1,5 +1,6 @@
 import pandas as pd
 import matplotlib.pyplot as plt
+from post_run_analysis.plot_utils import finish_plot
 from utils import HEDGING, WEIGHTINGS
 
 
@@ -14,7 +15,9 @@ def print_cost_statistics(
     print(f"Average cost:\n{costs_df.mean()}\nstandard_deviation:\n{costs_df.std()}")
 
 
-def plot_trading_costs(costs_df: pd.DataFrame, plot_title: str) -> None:
+def plot_trading_costs(
+    costs_df: pd.DataFrame, plot_title: str, save_path: str = None
+) -> None:
     """
     Plots trading cost series
     """
@@ -30,14 +33,15 @@ def plot_trading_costs(costs_df: pd.DataFrame, plot_title: str) -> None:
     plt.title(plot_title)
     plt.legend()
     plt.grid()
-    plt.show()
+    finish_plot(save_path)
 
 
-def analyse_costs_for_lambdas(
+def get_costs_for_lambdas(
     costs_df: pd.DataFrame, strategy: str, weighting: str
-) -> None:
+) -> pd.DataFrame:
     """
-    Analyses costs for different cost-sensitivty parameter configurations
+    Gets cost series of each cost-sensitivity parameter for the given
+    strategy, weighting combination
     """
     curr_df = costs_df.loc[
         :,
@@ -46,6 +50,17 @@ def analyse_costs_for_lambdas(
 
     curr_df.columns = ["0", "1", "6", "12"]
 
+    return curr_df
+
+
+def analyse_costs_for_lambdas(
+    costs_df: pd.DataFrame, strategy: str, weighting: str
+) -> None:
+    """
+    Analyses costs for different cost-sensitivty parameter configurations
+    """
+    curr_df = get_costs_for_lambdas(costs_df, strategy, weighting)
+
     plot_trading_costs(curr_df, f"{strategy}, {weighting}")
     print_cost_statistics(curr_df, strategy, weighting)
 
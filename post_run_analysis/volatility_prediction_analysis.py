@@ -2,6 +2,10 @@ import pandas as pd
 import numpy as np
 import json
 import matplotlib.pyplot as plt
+from post_run_analysis.plot_utils import finish_plot
+
+
+PREDICTION_COLORS = {"GARCH": "orange", "RV": "red"}
 
 
 def get_volatility_predictions(path: str) -> pd.Series:
@@ -46,25 +50,39 @@ def get_true_volatilities(path_first_sample: str, path_second_sample: str) -> pd
     )
 
 
+def get_vol_predictions_per_model(model_names: tuple) -> dict:
+    """
+    Takes volatility predictions of each named model from the output files
+    """
+    return {
+        model_name: get_volatility_predictions(f"vol_predictions_{model_name}.json")
+        for model_name in model_names
+    }
+
+
 def plot_vol_predictions(
-    garch_predictions: pd.Series,
-    rv_predictions: pd.Series,
+    vol_predictions: dict,
     true_volatilities: pd.Series,
+    save_path: str = None,
 ) -> None:
     """
-    Plots volatility predictions for both models and the true volatilities
+    Plots volatility predictions for each model and the true volatilities
     """
     plt.figure(figsize=(12, 8))
 
-    plt.plot(garch_predictions, label="GARCH Predictions", color="orange")
-    plt.plot(rv_predictions, label="RV Predictions", color="red")
+    for model_name, predictions in vol_predictions.items():
+        plt.plot(
+            predictions,
+            label=f"{model_name} Predictions",
+            color=PREDICTION_COLORS.get(model_name),
+        )
     plt.plot(true_volatilities, label="True volatilities", color="black")
 
     plt.xlabel("Date")
     plt.ylabel("Volatility")
     plt.legend()
     plt.tight_layout()
-    plt.show()
+    finish_plot(save_path)
 
 
 def get_mse(model_predictions: pd.Series, true_values: pd.Series) -> float:
@@ -74,29 +92,27 @@ def get_mse(model_predictions: pd.Series, true_values: pd.Series) -> float:
     return ((model_predictions - true_values) ** 2).mean()
 
 
-def get_mse_analysis(
-    garch_predictions: pd.Series, rv_predictions: pd.Series, true_values: pd.Series
-) -> None:
+def get_mse_analysis(vol_predictions: dict, true_values: pd.Series) -> None:
     """
-    Prints out the MSEs of GARCH and RV predictions
+    Prints out the MSEs of each model's predictions
     """
-    print(f"GARCH MSE: {get_mse(garch_predictions, true_values)}")
-    print(f"RV MSE: {get_mse(rv_predictions, true_values)}")
+    for model_name, predictions in vol_predictions.items():
+        print(f"{model_name} MSE: {get_mse(predictions, true_values)}")
 
 
-def run_volatility_prediction_analysis() -> None:
+def run_volatility_prediction_analysis(model_names: tuple = ("GARCH", "RV")) -> None:
     """
-    Runs analysis of GARCH and RV predictions
+    Runs analysis of the named models' predictions, GARCH and RV by default
+    or any registered volatility model used for hedging
     """
-    garch_predictions = get_volatility_predictions("vol_predictions_GARCH.json")
-    rv_predictions = get_volatility_predictions("vol_predictions_RV.json")
+    vol_predictions = get_vol_predictions_per_model(model_names)
     true_rv = get_true_volatilities(
         "ret_cost_standard_value_1993_2005_lambda_0.csv",
         "ret_cost_standard_value_2005_2024_lambda_0.csv",
     )
 
-    plot_vol_predictions(garch_predictions, rv_predictions, true_rv)
-    get_mse_analysis(garch_predictions, rv_predictions, true_rv)
+    plot_vol_predictions(vol_predictions, true_rv)
+    get_mse_analysis(vol_predictions, true_rv)
 
 
 if __name__ == "__main__":
@@ -1,23 +1,48 @@
+from post_run_analysis.batch_report import run_batch_report
+from post_run_analysis.factor_regressions import run_factor_regressions
 from post_run_analysis.quoted_bid_ask_analysis import get_quoted_bid_ask_spread_analysis
 from post_run_analysis.strategy_performance_analysis import (
     get_strategy_performance_analysis,
 )
+from post_run_analysis.significance_tests import get_significance_analysis
 from post_run_analysis.trading_cost_analysis import run_trading_cost_analysis
 from post_run_analysis.volatility_prediction_analysis import (
     run_volatility_prediction_analysis,
 )
+import sys
 
 
-def main():
+def main(batch: bool = False):
     """
-    Select the analysis to run
+    Select the analysis to run, in batch mode all figures are rendered
+    to files instead of being shown
     """
+    if batch:
+        print("Strategy performance analysis")
+        get_strategy_performance_analysis()
+
+        print("Pairwise significance analysis")
+        get_significance_analysis()
+
+        print("Factor regressions")
+        run_factor_regressions()
+
+        print("Rendering figures")
+        print(f"Report written to {run_batch_report()}")
+        return
+
     print("Quoted bid-ask spread analysis")
     get_quoted_bid_ask_spread_analysis()
 
     print("Strategy performance analysis")
     get_strategy_performance_analysis()
 
+    print("Pairwise significance analysis")
+    get_significance_analysis()
+
+    print("Factor regressions")
+    run_factor_regressions()
+
     print("Trading cost analysis")
     run_trading_cost_analysis()
 
@@ -26,4 +51,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    main(batch="--batch" in sys.argv[1:])
@@ -0,0 +1,202 @@
+from collections import deque
+from datetime import datetime
+from utils import WEIGHTINGS, extract_data, get_date_range_mask
+from run_strategies.two_stage_momentum import get_stock_returns, get_final_split_permnos
+from run_strategies.portfolio_return import find_returns_per_mo_stock
+from run_strategies.holdings_store import get_holding_return
+import pandas as pd
+import numpy as np
+
+
+def get_formation_window_mask(
+    data: pd.DataFrame, date: pd.Timestamp, formation_months: int, skip_months: int
+) -> pd.Series:
+    """
+    Returns mask of the formation_months months ending skip_months
+    months before the month-end date
+    """
+    formation_end = date - pd.offsets.MonthEnd(skip_months)
+
+    return get_date_range_mask(
+        data, formation_end - pd.offsets.MonthEnd(formation_months), formation_end
+    )
+
+
+def get_cohort_weights(
+    stock_returns: pd.DataFrame,
+    long_split: pd.Series,
+    short_split: pd.Series,
+    is_weighting_func_equal: bool,
+) -> pd.Series:
+    """
+    Returns signed weights of a cohort per permno, equal or value
+    weighted within each leg
+    """
+    long_sizes, short_sizes = (
+        (
+            pd.Series(1.0, index=split.index)
+            if is_weighting_func_equal
+            else stock_returns["avg_market_cap"][split.index]
+        )
+        for split in (long_split, short_split)
+    )
+
+    return pd.concat([long_sizes / long_sizes.sum(), -short_sizes / short_sizes.sum()])
+
+
+def get_net_positions(cohorts: deque, holding_months: int) -> pd.Series:
+    """
+    Averages the weights of the live cohorts into one net position per
+    permno, each cohort holds 1 / holding_months of the capital
+    """
+    net_positions = pd.concat(cohorts).groupby(level=0).sum() / holding_months
+
+    return net_positions[net_positions != 0]
+
+
+def get_holding_returns(
+    cum_returns_per_month: dict, year: int, month: int, permnos: pd.Index
+) -> np.ndarray:
+    """
+    Returns compound return of each stock over the holding month
+    """
+    return np.array(
+        [
+            get_holding_return(cum_returns_per_month, year, month, int(permno))
+            for permno in permnos
+        ]
+    )
+
+
+def get_net_trade_costs(
+    net_positions: pd.Series, drifted_positions: pd.Series, quoted_spreads: dict
+) -> tuple[float, float]:
+    """
+    Returns turnover and cost, half spread times absolute trade, of moving
+    from the drifted previous positions to the new net positions
+    """
+    trades = net_positions.sub(drifted_positions, fill_value=0)
+    abs_trades = trades.abs().to_numpy()
+
+    return (
+        abs_trades.sum(),
+        (
+            abs_trades
+            * np.array([quoted_spreads[permno] for permno in trades.index])
+            / 2
+        ).sum(),
+    )
+
+
+def get_cohort_returns_per_month(
+    data: pd.DataFrame,
+    start_year: int,
+    end_year: int,
+    cost_sensitivity: int = 0,
+    formation_months: int = 12,
+    skip_months: int = 0,
+    holding_months: int = 1,
+) -> dict:
+    """
+    Computes monthly returns of a J-k-K momentum strategy per weighting:
+    each month-end sort forms a cohort held for the next holding_months
+    months, and the live cohorts are netted into one position per stock.
+    Every sort is run once and shared by all months its cohort is held,
+    costs are charged on the net trades only. Months before all cohorts
+    are live are left out
+    """
+    cum_returns_per_month = find_returns_per_mo_stock(data)
+    cohorts = {weighting: deque(maxlen=holding_months) for weighting in WEIGHTINGS}
+    prev_positions = {weighting: pd.Series(dtype=float) for weighting in WEIGHTINGS}
+    returns_per_month = {weighting: dict() for weighting in WEIGHTINGS}
+    quoted_spreads = dict()
+
+    # The month after end_year has no returns in the data and is left out
+    for date in pd.date_range(
+        start=datetime(start_year, 12, 31), end=datetime(end_year, 11, 30), freq="ME"
+    ):
+        print(date)
+        stock_returns = get_stock_returns(
+            data[get_formation_window_mask(data, date, formation_months, skip_months)],
+            with_daily_returns=False,
+        )
+        long_split, short_split = get_final_split_permnos(
+            stock_returns, cost_sensitivity
+        )
+        quoted_spreads.update(
+            stock_returns["avg_quoted_spread"][
+                long_split.index.union(short_split.index)
+            ].to_dict()
+        )
+
+        holding_month = date + pd.offsets.MonthEnd(1)
+        year, month = holding_month.year, holding_month.month
+        prev_month = date.year, date.month
+
+        for weighting in WEIGHTINGS:
+            cohorts[weighting].append(
+                get_cohort_weights(
+                    stock_returns, long_split, short_split, weighting == "equal"
+                )
+            )
+            net_positions = get_net_positions(cohorts[weighting], holding_months)
+
+            # Previous positions drift with their returns up to the rebalance
+            drifted_positions = prev_positions[weighting] * (
+                1
+                + get_holding_returns(
+                    cum_returns_per_month, *prev_month, prev_positions[weighting].index
+                )
+            )
+            turnover, total_cost = get_net_trade_costs(
+                net_positions, drifted_positions, quoted_spreads
+            )
+            prev_positions[weighting] = net_positions
+
+            if len(cohorts[weighting]) < holding_months:
+                continue
+            returns_per_month[weighting][(year, month)] = {
+                "total_return": net_positions.to_numpy()
+                @ get_holding_returns(
+                    cum_returns_per_month, year, month, net_positions.index
+                ),
+                "total_cost": total_cost,
+                "turnover": turnover,
+            }
+
+    return returns_per_month
+
+
+def run_cohort_strategies(
+    start_year: int = 2005,
+    end_year: int = 2024,
+    variants: tuple = ((12, 1, 3), (6, 1, 6)),
+    cost_sensitivities: tuple = (0, 1, 6, 12),
+) -> None:
+    """
+    Runs J-k-K variants of the strategy and saves their monthly returns
+    """
+    data = extract_data(f"{start_year}-{end_year} v2.csv")
+
+    for formation_months, skip_months, holding_months in variants:
+        for cost_sensitivity in cost_sensitivities:
+            returns_per_month = get_cohort_returns_per_month(
+                data,
+                start_year,
+                end_year,
+                cost_sensitivity,
+                formation_months,
+                skip_months,
+                holding_months,
+            )
+            for weighting, returns in returns_per_month.items():
+                pd.DataFrame.from_dict(returns, orient="index").rename_axis(
+                    ["year", "month"]
+                ).to_csv(
+                    f"ret_cost_jt_{formation_months}_{skip_months}_{holding_months}"
+                    + f"_{weighting}_{start_year}_{end_year}_lambda_{cost_sensitivity}.csv"
+                )
+
+
+if __name__ == "__main__":
+    run_cohort_strategies()
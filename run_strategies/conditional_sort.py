@@ -0,0 +1,293 @@
+from utils import (
+    extract_data,
+    get_split_path,
+    get_year_month,
+    write_splits,
+)
+from run_strategies.two_stage_momentum import (
+    get_daily_returns_for_permnos,
+    gather_split_payload,
+    iterate_formation_windows,
+    pick_random_day,
+)
+from run_strategies.universe_index import load_eligibility_index
+from typing import Iterator
+import pandas as pd
+import numpy as np
+
+
+CONDITIONING_COLS = {"size": "avg_market_cap", "liquidity": "avg_quoted_spread"}
+
+
+def get_stock_month_stats(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Gets gross return, sampled quoted spread and average market cap for
+    each permno and calendar month of the data
+    """
+    year, month = get_year_month(data)
+
+    return (
+        data.assign(gross_return=data["DlyRet"] + 1)
+        .groupby(["PERMNO", (year * 12 + month - 1).rename("month_num")], sort=False)
+        .agg(
+            gross_return=("gross_return", "prod"),
+            day_quoted_spread=("quoted_spread", lambda group: pick_random_day(group)),
+            avg_market_cap=("DlyCap", "mean"),
+        )
+        .reset_index()
+    )
+
+
+def get_stacked_stock_returns(
+    data: pd.DataFrame, start_year: int, end_year: int, window_months: int = 12
+) -> pd.DataFrame:
+    """
+    Returns formation statistics of all month-ends stacked in one frame
+    indexed by date and permno, in one grouped computation: each stock
+    month is sampled once and counted in the windows of the month-ends
+    that cover it. Each date keeps the order of get_stock_returns
+    """
+    stock_months = get_stock_month_stats(data)
+    end_nums = (
+        stock_months["month_num"].to_numpy()[:, None] + np.arange(window_months)
+    ).ravel()
+    rows = np.repeat(np.arange(len(stock_months)), window_months)
+    is_sorted = (end_nums >= start_year * 12 + 11) & (end_nums <= end_year * 12 + 11)
+
+    stacked_months = (
+        stock_months.iloc[rows[is_sorted]]
+        .assign(end_num=end_nums[is_sorted])
+        .sort_values("end_num", kind="stable")
+    )
+    stacked_returns = stacked_months.groupby(["end_num", "PERMNO"], sort=False).agg(
+        cumulative_return=("gross_return", "prod"),
+        avg_quoted_spread=("day_quoted_spread", "mean"),
+        avg_market_cap=("avg_market_cap", "mean"),
+    )
+    stacked_returns["cumulative_return"] -= 1
+
+    # Month numbers count from year 0, datetime64 months from 1970
+    end_nums = stacked_returns.index.get_level_values("end_num").to_numpy()
+    month_ends = (end_nums + 1 - 1970 * 12).astype("datetime64[M]").astype(
+        "datetime64[D]"
+    ) - np.timedelta64(1, "D")
+
+    return stacked_returns.set_axis(
+        pd.MultiIndex.from_arrays(
+            [
+                np.datetime_as_string(month_ends),
+                stacked_returns.index.get_level_values("PERMNO"),
+            ],
+            names=["date", "PERMNO"],
+        )
+    )
+
+
+def get_conditioning_buckets(
+    stacked_returns: pd.DataFrame, conditioning: str, num_buckets: int
+) -> np.ndarray:
+    """
+    Assigns stocks to equally sized buckets of the conditioning variable
+    within each month-end, bucket 1 holds the smallest values
+    """
+    pct_ranks = stacked_returns.groupby(level="date", sort=False)[
+        CONDITIONING_COLS[conditioning]
+    ].rank(method="first", pct=True)
+
+    return np.ceil(pct_ranks.to_numpy() * num_buckets).astype(np.int64)
+
+
+def get_grouped_selection(
+    scores: pd.Series, group_keys: list, proportion: float, largest: bool
+) -> np.ndarray:
+    """
+    Marks the given proportion of largest or smallest scores of every
+    group, ties go to the earliest rows
+    """
+    grouped_scores = scores.groupby(group_keys, sort=False)
+    ranks = grouped_scores.rank(method="first", ascending=not largest)
+    num_selected = np.floor(grouped_scores.transform("size") * proportion)
+
+    return (ranks <= num_selected).to_numpy()
+
+
+def find_conditional_momentum_split(
+    stacked_returns: pd.DataFrame,
+    conditioning: str,
+    num_buckets: int = 5,
+    long_split_proportion: float = 0.2,
+    short_split_proportion: float = 0.2,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the first stage legs of all month-ends at once, ranking
+    cumulative returns within buckets of size or liquidity instead of
+    across the whole cross-section
+    """
+    group_keys = [
+        stacked_returns.index.get_level_values("date"),
+        get_conditioning_buckets(stacked_returns, conditioning, num_buckets),
+    ]
+    cumulative_returns = stacked_returns["cumulative_return"]
+
+    return (
+        get_grouped_selection(
+            cumulative_returns, group_keys, long_split_proportion, largest=True
+        ),
+        get_grouped_selection(
+            cumulative_returns, group_keys, short_split_proportion, largest=False
+        ),
+    )
+
+
+def select_cost_adjusted_leg(
+    stacked_returns: pd.DataFrame,
+    is_in_leg: np.ndarray,
+    cost_sensitivity: float,
+    keep: float,
+    largest: bool,
+) -> pd.Series:
+    """
+    Runs the second stage cost sort on one leg of all month-ends and
+    returns the kept cost-adjusted returns, ordered per date like
+    get_final_split_permnos
+    """
+    leg_returns = stacked_returns[is_in_leg]
+    sign = -1 if largest else 1
+    cost_adjusted_returns = (
+        leg_returns["cumulative_return"]
+        + sign * cost_sensitivity * leg_returns["avg_quoted_spread"]
+    )
+    dates = cost_adjusted_returns.index.get_level_values("date")
+    is_kept = get_grouped_selection(cost_adjusted_returns, [dates], keep, largest)
+
+    kept_returns = cost_adjusted_returns[is_kept]
+    kept_dates = dates[is_kept]
+    order = np.lexsort(
+        (
+            np.arange(len(kept_returns)),
+            sign * kept_returns.to_numpy(),
+            pd.factorize(kept_dates)[0],
+        )
+    )
+
+    return kept_returns.iloc[order]
+
+
+def get_conditional_final_split_permnos(
+    stacked_returns: pd.DataFrame,
+    cost_sensitivity: int,
+    conditioning: str,
+    num_buckets: int = 5,
+    keep_long: float = 0.5,
+    keep_short: float = 0.5,
+) -> tuple[pd.Series, pd.Series]:
+    """
+    Selects final long and short legs of all month-ends with the
+    conditional first stage and the standard second stage cost sort
+    """
+    is_long, is_short = find_conditional_momentum_split(
+        stacked_returns, conditioning, num_buckets
+    )
+
+    return (
+        select_cost_adjusted_leg(
+            stacked_returns, is_long, cost_sensitivity, keep_long, largest=True
+        ),
+        select_cost_adjusted_leg(
+            stacked_returns, is_short, cost_sensitivity, keep_short, largest=False
+        ),
+    )
+
+
+def iterate_conditional_splits(
+    data: pd.DataFrame,
+    start_year: int,
+    end_year: int,
+    cost_sensitivity: int,
+    conditioning: str,
+    num_buckets: int = 5,
+    eligibility_index: dict = None,
+) -> Iterator[tuple[str, dict]]:
+    """
+    Yields the conditional double sort legs date by date, in the layout
+    of iterate_splits_per_date. With the eligibility index of the data,
+    formation windows are taken from its monthly blocks
+    """
+    stacked_returns = get_stacked_stock_returns(data, start_year, end_year)
+    long_splits, short_splits = (
+        dict(iter(splits.groupby(level="date", sort=False)))
+        for splits in get_conditional_final_split_permnos(
+            stacked_returns, cost_sensitivity, conditioning, num_buckets
+        )
+    )
+    dates = stacked_returns.index.unique(level="date")
+
+    for (date, stock_returns), (_, window_data, _) in zip(
+        stacked_returns.groupby(level="date", sort=False),
+        iterate_formation_windows(
+            data, [pd.Timestamp(date) for date in dates], eligibility_index
+        ),
+    ):
+        print(date)
+        stock_returns = stock_returns.droplevel("date")
+        long_split, short_split = (
+            (
+                splits_per_date[date].droplevel("date")
+                if date in splits_per_date
+                else pd.Series(dtype=float)
+            )
+            for splits_per_date in (long_splits, short_splits)
+        )
+        daily_returns = get_daily_returns_for_permnos(
+            window_data, long_split.index.union(short_split.index)
+        )
+
+        yield date, {
+            "long_split": gather_split_payload(
+                long_split, stock_returns, daily_returns
+            ),
+            "short_split": gather_split_payload(
+                short_split, stock_returns, daily_returns
+            ),
+        }
+
+
+def get_conditional_momentum_splits(
+    start_year: int = 2019,
+    end_year: int = 2024,
+    cost_sensitivity: int = 0,
+    conditioning: str = "size",
+    num_buckets: int = 5,
+    data: pd.DataFrame = None,
+) -> str:
+    """
+    Extracts conditional double sort legs for each date of the given
+    period to a json lines file and returns its path, read it back with
+    read_splits and the conditioning variable. Data of the period is
+    loaded unless it is given
+    """
+    data_path = f"{start_year}-{end_year} v2.csv"
+    if data is None:
+        data = extract_data(data_path)
+
+    split_path = get_split_path(start_year, end_year, cost_sensitivity, conditioning)
+    write_splits(
+        iterate_conditional_splits(
+            data,
+            start_year,
+            end_year,
+            cost_sensitivity,
+            conditioning,
+            num_buckets,
+            load_eligibility_index(data_path),
+        ),
+        split_path,
+    )
+
+    return split_path
+
+
+if __name__ == "__main__":
+    for conditioning in CONDITIONING_COLS:
+        for split in [(1993, 2005), (2005, 2024)]:
+            get_conditional_momentum_splits(*split, conditioning=conditioning)
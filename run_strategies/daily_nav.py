@@ -0,0 +1,240 @@
+from utils import (
+    LAMBDAS,
+    MODEL_NAMES,
+    WEIGHTINGS,
+    compact_data_cols,
+    extract_data,
+    get_holdings_path,
+    is_compact,
+)
+from run_strategies.holdings_store import align_permnos, load_holdings
+from scipy import sparse
+import pandas as pd
+import numpy as np
+import os
+
+
+NAV_LEGS = ["long", "short", "wml", "wml_net"]
+PERIODS = [(1993, 2005), (2005, 2024)]
+
+
+def get_month_numbers(dates: np.ndarray) -> np.ndarray:
+    """
+    Returns month numbers, months since 1970-01, of dates or day numbers
+    """
+    return (
+        np.asarray(dates)
+        .astype("datetime64[D]")
+        .astype("datetime64[M]")
+        .astype("int64")
+    )
+
+
+def get_holdings_grid(holdings_per_strategy: dict) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the union of the rebalancing dates and of the permnos of
+    all strategies
+    """
+    return (
+        np.unique(np.concatenate([h["dates"] for h in holdings_per_strategy.values()])),
+        np.unique(
+            np.concatenate([h["permnos"] for h in holdings_per_strategy.values()])
+        ),
+    )
+
+
+def get_stacked_weights(
+    holdings_per_strategy: dict, dates: np.ndarray, permnos: np.ndarray
+) -> tuple[sparse.csr_matrix, np.ndarray]:
+    """
+    Stacks the weights of all strategies on a common date x permno grid,
+    rows are strategy major, and returns the trade costs per row
+    """
+    weights, costs = [], []
+
+    for holdings in holdings_per_strategy.values():
+        rows = np.searchsorted(dates, holdings["dates"])
+        # Scatters the strategy's rebalancing dates onto the common dates
+        scatter = sparse.csr_matrix(
+            (np.ones(len(rows)), (rows, np.arange(len(rows)))),
+            shape=(len(dates), len(rows)),
+        )
+        weights.append(
+            scatter @ align_permnos(holdings["weights"], holdings["permnos"], permnos)
+        )
+        costs.append(scatter @ np.asarray(holdings["trade_costs"].sum(axis=1)).ravel())
+
+    return sparse.vstack(weights, format="csr"), np.concatenate(costs)
+
+
+def get_daily_returns_panel(
+    data: pd.DataFrame, permnos: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns the trading days, their permno columns and returns of the
+    held stocks, sorted by day, as flat arrays
+    """
+    if not is_compact(data):
+        data = compact_data_cols(data)
+
+    days, data_permnos, returns = (
+        data[col].to_numpy() for col in ["DlyCalDt", "PERMNO", "DlyRet"]
+    )
+    cols = np.searchsorted(permnos, data_permnos)
+    is_held = (cols < len(permnos)) & (
+        permnos[np.minimum(cols, len(permnos) - 1)] == data_permnos
+    )
+    order = np.argsort(days[is_held], kind="stable")
+
+    return days[is_held][order], cols[is_held][order], returns[is_held][order]
+
+
+def get_leg_values(
+    weights: sparse.csr_matrix, growth: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns per row and day the buy-and-hold value of the long leg, the
+    short leg and the whole position relative to the start of the month,
+    legs per unit of gross leg weight
+    """
+    long_weights, short_weights = weights.maximum(0), weights.minimum(0)
+    long_gross = np.asarray(long_weights.sum(axis=1)).ravel()
+    short_gross = -np.asarray(short_weights.sum(axis=1)).ravel()
+    long_pnl, short_pnl = (
+        np.asarray(leg_weights @ growth)
+        for leg_weights in (long_weights, short_weights)
+    )
+
+    return (
+        1 + long_pnl / np.maximum(long_gross, 1e-300)[:, None],
+        1 + short_pnl / np.maximum(short_gross, 1e-300)[:, None],
+        1 + long_pnl + short_pnl,
+    )
+
+
+def get_daily_navs(holdings_per_strategy: dict, data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Marks the positions of all strategies to market every trading day.
+    Each month-end's weights are held buy-and-hold over the next month,
+    so a stock's value grows with its cumulative product of daily returns
+    since the rebalance, and the NAVs compound month over month. The
+    WML NAV at each month-end equals the compounded monthly total_return,
+    the net WML NAV pays the month's trade costs at the rebalance
+    """
+    dates, permnos = get_holdings_grid(holdings_per_strategy)
+    weights, costs = get_stacked_weights(holdings_per_strategy, dates, permnos)
+    num_rows, num_strategies = weights.shape[0], len(holdings_per_strategy)
+    days, cols, returns = get_daily_returns_panel(data, permnos)
+
+    # Holdings of a month-end are held in the month after it
+    holding_months = get_month_numbers(dates) + 1
+    day_months = get_month_numbers(days)
+    month_bounds = np.searchsorted(
+        day_months, np.concatenate([holding_months, [holding_months[-1] + 1]])
+    )
+
+    trading_days = np.unique(days[month_bounds[0] : month_bounds[-1]])
+    navs = np.ones((num_strategies, len(NAV_LEGS), len(trading_days)))
+    start_navs = np.ones((num_strategies, len(NAV_LEGS)))
+
+    for date_num, holding_month in enumerate(holding_months):
+        month_start, month_end = month_bounds[date_num], month_bounds[date_num + 1]
+        if month_end == month_start:
+            continue
+        month_days, day_rows = np.unique(
+            days[month_start:month_end], return_inverse=True
+        )
+        # Stocks without a return on a day keep their value
+        month_returns = np.zeros((len(permnos), len(month_days)))
+        month_returns[cols[month_start:month_end], day_rows] = returns[
+            month_start:month_end
+        ]
+        growth = np.cumprod(1 + month_returns, axis=1) - 1
+
+        rows = np.arange(date_num, num_rows, len(dates))
+        long_values, short_values, wml_values = get_leg_values(weights[rows], growth)
+        month_values = np.stack(
+            [long_values, short_values, wml_values, wml_values - costs[rows, None]],
+            axis=1,
+        )
+        month_navs = start_navs[:, :, None] * month_values
+
+        day_positions = np.searchsorted(trading_days, month_days)
+        navs[:, :, day_positions] = month_navs
+        start_navs = month_navs[:, :, -1]
+
+    return pd.DataFrame(
+        navs.reshape(num_strategies * len(NAV_LEGS), -1).T,
+        index=pd.DatetimeIndex(trading_days.astype("datetime64[D]"), name="date"),
+        columns=pd.MultiIndex.from_product(
+            [list(holdings_per_strategy), NAV_LEGS], names=["strategy", "leg"]
+        ),
+    )
+
+
+def get_daily_nav_stats(navs: pd.DataFrame, days_per_year: int = 252) -> pd.DataFrame:
+    """
+    Returns annualized realized volatility, maximum drawdown and worst
+    intramonth drawdown of each daily NAV series
+    """
+    nav_values = navs.to_numpy()
+    daily_returns = nav_values[1:] / nav_values[:-1] - 1
+    drawdowns = nav_values / np.maximum.accumulate(nav_values, axis=0) - 1
+
+    months = navs.index.to_period("M")
+    month_peaks = navs.groupby(months).cummax()
+
+    return pd.DataFrame(
+        {
+            "annualized_volatility": daily_returns.std(axis=0, ddof=1)
+            * np.sqrt(days_per_year),
+            "max_drawdown": drawdowns.min(axis=0),
+            "max_intramonth_drawdown": (navs / month_peaks - 1).min().to_numpy(),
+        },
+        index=navs.columns,
+    )
+
+
+def load_strategy_holdings(
+    start_year: int, end_year: int, cost_sensitivities: list = LAMBDAS
+) -> dict:
+    """
+    Loads the stored holdings of every model, weighting and cost
+    sensitivity of a period that has been run
+    """
+    holdings_per_strategy = dict()
+
+    for cost_sensitivity in cost_sensitivities:
+        for model_name in MODEL_NAMES.values():
+            for weighting in WEIGHTINGS:
+                path = get_holdings_path(
+                    model_name, weighting, start_year, end_year, cost_sensitivity
+                )
+                if os.path.exists(path):
+                    holdings_per_strategy[
+                        f"{model_name}_{weighting}_lambda_{cost_sensitivity}"
+                    ] = load_holdings(path)
+
+    return holdings_per_strategy
+
+
+def run_daily_navs(periods: list = PERIODS) -> None:
+    """
+    Computes daily NAVs of all stored strategies per period and saves
+    them with their daily risk statistics
+    """
+    for start_year, end_year in periods:
+        holdings_per_strategy = load_strategy_holdings(start_year, end_year)
+        if not holdings_per_strategy:
+            continue
+
+        navs = get_daily_navs(
+            holdings_per_strategy,
+            extract_data(f"{start_year}-{end_year} v2.csv", compact=True),
+        )
+        navs.to_csv(f"daily_nav_{start_year}_{end_year}.csv")
+        get_daily_nav_stats(navs).to_csv(f"daily_nav_stats_{start_year}_{end_year}.csv")
+
+
+if __name__ == "__main__":
+    run_daily_navs()
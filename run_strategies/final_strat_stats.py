@@ -1,91 +1,265 @@
 import pandas as pd
 import numpy as np
 from collections import defaultdict
+from numpy.lib.stride_tricks import sliding_window_view
 import json
-from utils import WEIGHTINGS, HEDGING
+import os
+from utils import WEIGHTINGS, HEDGING, get_holdings_path
+from run_strategies.holdings_store import get_turnover, load_holdings
 
 
 STRATEGY_COMPOSITIONS = [(strat, weight) for strat in HEDGING for weight in WEIGHTINGS]
+PERIODS = [(1993, 2005), (2005, 2024)]
 
 
-def evaluate_strategy_performance(lbda: int, strategy: str, weight: str) -> tuple:
+def get_strategy_stats(strategy_results: pd.DataFrame) -> dict:
     """
-    Evaluates strategy performance in terms of: return, volatility, costs
+    Computes monthly return, volatility and cost statistics of a strategy
+    from its monthly total returns and costs
     """
-    gross_return_list, net_return_list, cost_list = [], [], []
+    gross_returns = strategy_results["total_return"].to_numpy()
+    costs = strategy_results["total_cost"].to_numpy()
+    net_returns = gross_returns - costs
 
-    for start_year, end_year in [(1993, 2005), (2005, 2024)]:
-        strategy_results = pd.read_csv(
-            f"ret_cost_{strategy}_{weight}_{start_year}_{end_year}_lambda_{lbda}.csv"
+    return {
+        "monthly_gross_return": float(gross_returns.mean()),
+        "monthly_gross_return_std": float(gross_returns.std()),
+        "monthly_net_return": float(net_returns.mean()),
+        "monthly_net_return_std": float(net_returns.std()),
+        "monthly_cost": float(costs.mean()),
+        "annualized_net_sharpe": float(
+            np.sqrt(12) * net_returns.mean() / net_returns.std()
+        ),
+    }
+
+
+def get_month_ends(strategy_results: pd.DataFrame) -> pd.DatetimeIndex:
+    """
+    Returns month-end dates of the year and month columns of a result file
+    """
+    return pd.DatetimeIndex(
+        pd.to_datetime(
+            pd.DataFrame(
+                {
+                    "year": strategy_results["year"],
+                    "month": strategy_results["month"],
+                    "day": 1,
+                }
+            )
+        )
+        + pd.offsets.MonthEnd(0),
+        name="date",
+    )
+
+
+def load_strategy_turnover(
+    lbda: int, strategy: str, weight: str, start_year: int, end_year: int
+) -> pd.Series:
+    """
+    Returns monthly turnover from the stored holdings of a run, indexed by
+    the month-end of the holding month, empty if they were not stored
+    """
+    path = get_holdings_path(strategy, weight, start_year, end_year, lbda)
+    if not os.path.exists(path):
+        return pd.Series(dtype=float)
+
+    turnover = get_turnover(load_holdings(path))
+    turnover.index = pd.DatetimeIndex(turnover.index) + pd.offsets.MonthEnd(1)
+
+    return turnover
+
+
+def load_strategy_series(
+    lambdas: tuple = (0, 1, 6, 12), periods: list = PERIODS
+) -> dict:
+    """
+    Loads monthly gross returns, costs and turnover of all strategies as
+    (months x strategies) frames indexed by the month-ends in the data,
+    turnover covers the same months as the returns
+    """
+    series = {"gross_return": dict(), "costs": dict(), "turnover": dict()}
+
+    for lbda in lambdas:
+        for strategy, weight in STRATEGY_COMPOSITIONS:
+            period_results, period_turnover = [], []
+            for start_year, end_year in periods:
+                strategy_results = pd.read_csv(
+                    f"ret_cost_{strategy}_{weight}_{start_year}_{end_year}_lambda_{lbda}.csv"
+                )
+                # The month after end_year is not part of the period
+                strategy_results = strategy_results[
+                    strategy_results["year"] <= end_year
+                ]
+                month_ends = get_month_ends(strategy_results)
+                period_results.append(strategy_results.set_index(month_ends))
+                period_turnover.append(
+                    load_strategy_turnover(
+                        lbda, strategy, weight, start_year, end_year
+                    ).reindex(month_ends)
+                )
+
+            strategy_results = pd.concat(period_results)
+            series["gross_return"][(lbda, strategy, weight)] = strategy_results[
+                "total_return"
+            ]
+            series["costs"][(lbda, strategy, weight)] = strategy_results["total_cost"]
+            series["turnover"][(lbda, strategy, weight)] = pd.concat(period_turnover)
+
+    return {
+        name: pd.DataFrame(curr_series).rename_axis(
+            columns=["lambda", "strategy", "weighting"]
         )
+        for name, curr_series in series.items()
+    }
+
 
-        if strategy_results.iloc[-1]["year"] > end_year:
-            strategy_results = strategy_results.iloc[:-1]
+def get_max_drawdowns(returns: np.ndarray) -> np.ndarray:
+    """
+    Computes maximum drawdown of the compounded returns along the first
+    axis, for any number of trailing axes
+    """
+    wealth = np.cumprod(1 + returns, axis=0)
+    peaks = np.maximum(np.maximum.accumulate(wealth, axis=0), 1)
+
+    return (wealth / peaks - 1).min(axis=0)
 
-        gross_return_list += list(strategy_results["total_return"])
-        net_return_list += list(
-            strategy_results["total_return"] - strategy_results["total_cost"]
+
+def get_return_metrics(returns: np.ndarray) -> dict:
+    """
+    Computes return metrics along the first axis: monthly mean and
+    volatility, annualized Sharpe and Sortino ratios and max drawdown
+    """
+    means = returns.mean(axis=0)
+    stds = returns.std(axis=0)
+    downside_stds = np.sqrt((np.minimum(returns, 0) ** 2).mean(axis=0))
+
+    return {
+        "mean": means,
+        "std": stds,
+        "sharpe": np.sqrt(12) * means / stds,
+        "sortino": np.sqrt(12) * means / downside_stds,
+        "max_drawdown": get_max_drawdowns(returns),
+    }
+
+
+def get_strategy_metrics(
+    gross_returns: pd.DataFrame, costs: pd.DataFrame, turnover: pd.DataFrame = None
+) -> pd.DataFrame:
+    """
+    Computes gross and net return metrics, cost drag and turnover of all
+    strategies at once, one row per strategy
+    """
+    gross = gross_returns.to_numpy()
+    cost_values = costs[gross_returns.columns].to_numpy()
+    metrics = {
+        **{
+            f"gross_{name}": values
+            for name, values in get_return_metrics(gross).items()
+        },
+        **{
+            f"net_{name}": values
+            for name, values in get_return_metrics(gross - cost_values).items()
+        },
+        "annualized_cost_drag": 12 * cost_values.mean(axis=0),
+    }
+    if turnover is not None:
+        metrics["monthly_turnover"] = (
+            turnover.reindex(index=gross_returns.index, columns=gross_returns.columns)
+            .mean()
+            .to_numpy()
         )
 
-        cost_list += list(strategy_results["total_cost"])
+    return pd.DataFrame(metrics, index=gross_returns.columns)
 
-    avg_gross_return = sum(gross_return_list) / len(gross_return_list)
-    avg_net_return = sum(net_return_list) / len(net_return_list)
-    gross_return_std = float(np.array(gross_return_list).std())
-    net_return_std = float(np.array(net_return_list).std())
 
-    return (
-        avg_gross_return,
-        gross_return_std,
-        avg_net_return,
-        net_return_std,
-        gross_return_list,
-        cost_list,
+def get_rolling_metrics(
+    gross_returns: pd.DataFrame, costs: pd.DataFrame, window: int = 36
+) -> pd.DataFrame:
+    """
+    Computes the metrics of get_strategy_metrics over rolling windows of
+    months, all windows at once on a strided view of the returns
+    """
+    gross = gross_returns.to_numpy()
+    cost_values = costs[gross_returns.columns].to_numpy()
+    # (windows x months x strategies) view, months on the first axis
+    gross_windows, cost_windows = (
+        np.moveaxis(sliding_window_view(values, window, axis=0), -1, 0)
+        for values in (gross, cost_values)
+    )
+    metrics = {
+        **{
+            f"gross_{name}": values
+            for name, values in get_return_metrics(gross_windows).items()
+        },
+        **{
+            f"net_{name}": values
+            for name, values in get_return_metrics(gross_windows - cost_windows).items()
+        },
+        "annualized_cost_drag": 12 * cost_windows.mean(axis=0),
+    }
+
+    return pd.concat(
+        {
+            name: pd.DataFrame(
+                values,
+                index=gross_returns.index[window - 1 :],
+                columns=gross_returns.columns,
+            )
+            for name, values in metrics.items()
+        },
+        axis=1,
+        names=["metric"],
     )
 
 
-def get_series_and_strat_results() -> tuple[defaultdict, defaultdict]:
+def get_series_and_strat_results(series: dict = None) -> tuple[dict, defaultdict]:
     """
     Gets time series and aggregate strategy results
     """
-    time_series_results = defaultdict()
+    if series is None:
+        series = load_strategy_series()
+
+    gross_returns, costs = series["gross_return"], series["costs"]
+    net_returns = gross_returns - costs
+    time_series_results = dict()
     strategy_agg_results = defaultdict(lambda: defaultdict(dict))
-    for lbda in [0, 1, 6, 12]:
-        for strategy, weight in STRATEGY_COMPOSITIONS:
-            (
-                strat_return,
-                strat_std,
-                strat_net_return,
-                strat_net_std,
-                gross_returns,
-                costs,
-            ) = evaluate_strategy_performance(lbda, strategy, weight)
-            strategy_agg_results[lbda][strategy][weight] = {
-                "monthly_gross_return": strat_return,
-                "monthly_gross_return_std": strat_std,
-                "monthly_net_return": strat_net_return,
-                "monthly_net_return_std": strat_net_std,
-            }
-            time_series_results[(lbda, strategy, weight, "gross_return")] = (
-                gross_returns
-            )
-            time_series_results[(lbda, strategy, weight, "costs")] = costs
+
+    gross_means, gross_stds = gross_returns.mean(), gross_returns.std(ddof=0)
+    net_means, net_stds = net_returns.mean(), net_returns.std(ddof=0)
+    for lbda, strategy, weight in gross_returns.columns:
+        column = (lbda, strategy, weight)
+        strategy_agg_results[lbda][strategy][weight] = {
+            "monthly_gross_return": float(gross_means[column]),
+            "monthly_gross_return_std": float(gross_stds[column]),
+            "monthly_net_return": float(net_means[column]),
+            "monthly_net_return_std": float(net_stds[column]),
+        }
+        time_series_results[(*column, "gross_return")] = gross_returns[column]
+        time_series_results[(*column, "costs")] = costs[column]
 
     return time_series_results, strategy_agg_results
 
 
-def get_final_strategy_stats() -> None:
+def get_final_strategy_stats(rolling_window: int = 36) -> None:
     """
-    Gets final strategy statistics
+    Gets final strategy statistics, with their full-sample and rolling
+    performance metrics
     """
-    time_series_results, strategy_agg_results = get_series_and_strat_results()
+    series = load_strategy_series()
+    time_series_results, strategy_agg_results = get_series_and_strat_results(series)
 
     with open("strategy_performances.json", "w") as file:
         json.dump(strategy_agg_results, file)
-    pd.DataFrame(
-        time_series_results,
-        index=pd.date_range(start="1994-01", periods=(2024 - 1994 + 1) * 12, freq="ME"),
-    ).to_csv("ret_cost_ts.csv", index=True, header=True)
+    # Unnamed index keeps the four header rows the analysis scripts expect
+    pd.DataFrame(time_series_results).rename_axis(None).to_csv(
+        "ret_cost_ts.csv", index=True, header=True
+    )
+    get_strategy_metrics(
+        series["gross_return"], series["costs"], series["turnover"]
+    ).to_csv("strategy_metrics.csv")
+    get_rolling_metrics(series["gross_return"], series["costs"], rolling_window).to_csv(
+        f"strategy_metrics_rolling_{rolling_window}.csv"
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,132 @@
+from typing import Callable, Union
+import numpy as np
+import hashlib
+import sqlite3
+import math
+import time
+import os
+
+
+FORECAST_CACHE_PATH = "vol_forecast_cache.sqlite"
+MAX_CACHED_FORECASTS = 200_000
+EVICTION_INTERVAL = 1_000
+
+connections = dict()
+puts_since_eviction = 0
+
+
+def get_forecast_key(window: np.ndarray, model_spec: str) -> str:
+    """
+    Hashes the model specification together with the exact input window
+    """
+    digest = hashlib.sha256(model_spec.encode())
+    digest.update(np.ascontiguousarray(window, dtype=np.float64).tobytes())
+
+    return digest.hexdigest()
+
+
+def get_cache_connection(path: str = FORECAST_CACHE_PATH) -> sqlite3.Connection:
+    """
+    Returns this process' connection to the cache, creating the cache if
+    needed. Processes share the file through sqlite locking, in WAL mode
+    so that readers do not block the writer
+    """
+    # Connections must not be shared with forked worker processes
+    connection_key = (path, os.getpid())
+    if connection_key not in connections:
+        connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS forecasts "
+            + "(key TEXT PRIMARY KEY, forecast REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS forecasts_last_used ON forecasts (last_used)"
+        )
+        connections[connection_key] = connection
+
+    return connections[connection_key]
+
+
+def get_cached_forecast(
+    key: str, path: str = FORECAST_CACHE_PATH
+) -> Union[float, None]:
+    """
+    Returns the cached forecast of a key and marks it as recently used,
+    None if it is not cached
+    """
+    connection = get_cache_connection(path)
+    row = connection.execute(
+        "SELECT forecast FROM forecasts WHERE key = ?", (key,)
+    ).fetchone()
+    if row is None:
+        return None
+
+    connection.execute(
+        "UPDATE forecasts SET last_used = ? WHERE key = ?", (time.time(), key)
+    )
+
+    return row[0]
+
+
+def evict_forecasts(
+    path: str = FORECAST_CACHE_PATH, max_forecasts: int = MAX_CACHED_FORECASTS
+) -> int:
+    """
+    Deletes the least recently used forecasts beyond max_forecasts and
+    returns how many were deleted
+    """
+    return (
+        get_cache_connection(path)
+        .execute(
+            "DELETE FROM forecasts WHERE key IN (SELECT key FROM forecasts "
+            + "ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (max_forecasts,),
+        )
+        .rowcount
+    )
+
+
+def put_cached_forecast(
+    key: str,
+    forecast: float,
+    path: str = FORECAST_CACHE_PATH,
+    max_forecasts: int = MAX_CACHED_FORECASTS,
+) -> None:
+    """
+    Caches a forecast, evicting old forecasts every EVICTION_INTERVAL puts
+    """
+    global puts_since_eviction
+
+    get_cache_connection(path).execute(
+        "INSERT OR REPLACE INTO forecasts VALUES (?, ?, ?)",
+        (key, forecast, time.time()),
+    )
+
+    puts_since_eviction += 1
+    if puts_since_eviction >= EVICTION_INTERVAL:
+        evict_forecasts(path, max_forecasts)
+        puts_since_eviction = 0
+
+
+def get_or_compute_forecast(
+    window: np.ndarray,
+    model_spec: str,
+    forecast_func: Callable,
+    path: str = FORECAST_CACHE_PATH,
+    max_forecasts: int = MAX_CACHED_FORECASTS,
+) -> float:
+    """
+    Returns the cached forecast of the window under the model, fitting
+    and caching it only on a miss
+    """
+    key = get_forecast_key(window, model_spec)
+    forecast = get_cached_forecast(key, path)
+
+    if forecast is None:
+        forecast = float(forecast_func(window))
+        # Failed fits are not cached, so that they are retried
+        if math.isfinite(forecast):
+            put_cached_forecast(key, forecast, path, max_forecasts)
+
+    return forecast
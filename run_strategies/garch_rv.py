@@ -1,5 +1,15 @@
 from arch import arch_model
+from scipy.signal import lfilter
+from run_strategies.forecast_cache import get_or_compute_forecast
 import numpy as np
+import arch
+
+
+# Part of the cache key, so that forecasts of other specifications or
+# library versions are never reused
+GARCH_MODEL_SPEC = (
+    f"garch(1,1) zero mean normal window=500 horizon=21 arch={arch.__version__}"
+)
 
 
 def sigma_hat_rv(sum_sq_ret: list) -> float:
@@ -9,12 +19,12 @@ def sigma_hat_rv(sum_sq_ret: list) -> float:
     return np.sqrt(sum_sq_ret * 21 / 126)
 
 
-def sigma_hat_garch(daily_returns: list) -> float:
+def fit_garch_forecast(window: list) -> float:
     """
-    Returns next months volatility estimate, based on GARCH
+    Fits GARCH(1,1) on the window and returns next months volatility
     """
     model = arch_model(
-        daily_returns[-500:],
+        window,
         mean="Zero",
         vol="Garch",
         p=1,
@@ -29,3 +39,134 @@ def sigma_hat_garch(daily_returns: list) -> float:
     next_period_vol = np.sqrt(next_period_var) * np.sqrt(21)
 
     return next_period_vol
+
+
+def sigma_hat_garch(daily_returns: list, use_cache: bool = True) -> float:
+    """
+    Returns next months volatility estimate, based on GARCH, fits of
+    previously seen windows are taken from the forecast cache
+    """
+    if not use_cache:
+        return fit_garch_forecast(daily_returns[-500:])
+
+    return get_or_compute_forecast(
+        np.asarray(daily_returns[-500:], dtype=float),
+        GARCH_MODEL_SPEC,
+        fit_garch_forecast,
+    )
+
+
+def rolling_rv_forecaster(window: int = 125, horizon: int = 21):
+    """
+    Returns forecaster scaling the mean squared return of the last
+    window days to the horizon
+    """
+
+    def forecast(daily_returns: np.ndarray, month_ends: np.ndarray) -> np.ndarray:
+        cum_sq_ret = np.concatenate([[0], np.cumsum(daily_returns**2)])
+        window_starts = np.maximum(month_ends - window, 0)
+
+        return np.sqrt(
+            horizon
+            * (cum_sq_ret[month_ends] - cum_sq_ret[window_starts])
+            / (month_ends - window_starts)
+        )
+
+    return forecast
+
+
+def ewma_forecaster(decay: float = 0.94, horizon: int = 21):
+    """
+    Returns RiskMetrics-style forecaster, running the EWMA variance
+    recursion once over the whole daily series
+    """
+
+    def forecast(daily_returns: np.ndarray, month_ends: np.ndarray) -> np.ndarray:
+        sq_ret = daily_returns**2
+        # The recursion starts from the first squared return
+        variance, _ = lfilter([1 - decay], [1, -decay], sq_ret, zi=[decay * sq_ret[0]])
+
+        return np.sqrt(horizon * variance[month_ends - 1])
+
+    return forecast
+
+
+def get_trailing_means(values: np.ndarray, window: int) -> np.ndarray:
+    """
+    Computes trailing means of a daily series, missing until a full
+    window is available
+    """
+    sums = np.concatenate([[0], np.cumsum(values)])
+    trailing_means = np.full(len(values), np.nan)
+    trailing_means[window - 1 :] = (sums[window:] - sums[:-window]) / window
+
+    return trailing_means
+
+
+def har_rv_forecaster(horizon: int = 21, fit_window: int = 252, ridge: float = 1e-12):
+    """
+    Returns HAR-RV forecaster, the daily, weekly and monthly squared return
+    components are built once over the whole daily series and fitted by
+    least squares on the fit_window days before each month-end, from
+    running sums of the normal equations
+    """
+
+    def forecast(daily_returns: np.ndarray, month_ends: np.ndarray) -> np.ndarray:
+        sq_ret = daily_returns**2
+        features = np.column_stack(
+            [
+                np.ones_like(sq_ret),
+                sq_ret,
+                get_trailing_means(sq_ret, 5),
+                get_trailing_means(sq_ret, 22),
+            ]
+        )
+        # Day t's features explain day t + 1's squared return
+        regressors, targets = features[:-1], sq_ret[1:]
+        usable = ~np.isnan(regressors).any(axis=1)
+        regressors = np.where(usable[:, None], regressors, 0)
+        targets = np.where(usable, targets, 0)
+
+        cum_gram, cum_moments = (
+            np.concatenate([np.zeros((1, *values.shape[1:])), np.cumsum(values, 0)])
+            for values in (
+                np.einsum("tk,tl->tkl", regressors, regressors),
+                regressors * targets[:, None],
+            )
+        )
+        fit_ends = month_ends - 1
+        fit_starts = np.maximum(fit_ends - fit_window, 0)
+        coefs = np.linalg.solve(
+            cum_gram[fit_ends]
+            - cum_gram[fit_starts]
+            + ridge * np.eye(features.shape[1]),
+            (cum_moments[fit_ends] - cum_moments[fit_starts])[:, :, None],
+        )[:, :, 0]
+        last_features = features[month_ends - 1]
+        variance = np.einsum("mk,mk->m", coefs, np.nan_to_num(last_features))
+        # Falls back to the monthly component if the fit is not positive
+        variance = np.where(variance > 0, variance, last_features[:, 3])
+
+        return np.sqrt(horizon * variance)
+
+    return forecast
+
+
+VOL_MODELS = dict()
+
+
+def register_vol_model(name: str, forecaster) -> None:
+    """
+    Registers a volatility model, a forecaster maps the whole daily WML
+    series and the end position of each month in it to next month's
+    volatility per month
+    """
+    VOL_MODELS[name] = forecaster
+
+
+register_vol_model("rv_125", rolling_rv_forecaster(125))
+register_vol_model("rv_63", rolling_rv_forecaster(63))
+register_vol_model("rv_21", rolling_rv_forecaster(21))
+register_vol_model("ewma_0.94", ewma_forecaster(0.94))
+register_vol_model("ewma_0.97", ewma_forecaster(0.97))
+register_vol_model("har_rv", har_rv_forecaster())
@@ -0,0 +1,335 @@
+from scipy import sparse
+import pandas as pd
+import numpy as np
+
+
+HOLDINGS_MATRICES = ["weights", "trades", "trade_costs"]
+
+
+def get_holding_return(
+    cum_returns_per_month: dict, year: int, month: int, permno: int
+) -> float:
+    """
+    Returns compound return of a stock over the holding month, zero for
+    stocks without observations
+    """
+    return cum_returns_per_month.get((year, month, permno), {}).get(
+        "cumulative_return", 0
+    )
+
+
+def get_stock_trades_for_date(
+    weights: dict,
+    prev_weights: dict,
+    quoted_spreads: dict,
+    prev_quoted_spreads: dict,
+    cum_returns_per_month: dict,
+    year: int,
+    month: int,
+    drift_return: float = None,
+) -> dict:
+    """
+    Returns the trade and its cost, half spread times absolute trade, per
+    permno of one leg. These are the trades priced in
+    compute_total_cost_for_date: rebalancing from previous weights drifted
+    with the holding returns, unless a drift return is given, and
+    liquidation of stocks that left the leg
+    """
+    trades = dict()
+
+    for permno, weight in weights.items():
+        stock_drift = (
+            get_holding_return(cum_returns_per_month, year, month, permno)
+            if drift_return is None
+            else drift_return
+        )
+        trade = weight - prev_weights.get(permno, 0) * (1 + stock_drift)
+        trades[permno] = (trade, abs(trade) * quoted_spreads[permno] / 2)
+    for permno, prev_weight in prev_weights.items():
+        if permno not in weights:
+            trade = -prev_weight * (
+                1 + get_holding_return(cum_returns_per_month, year, month, permno)
+            )
+            trades[permno] = (trade, abs(trade) * prev_quoted_spreads[permno] / 2)
+
+    return trades
+
+
+def build_holdings(
+    weights_per_date: dict, spreads_per_date: dict, cum_returns_per_month: dict
+) -> dict:
+    """
+    Builds sparse date x permno matrices of the signed weights, trades and
+    trade costs of a run, a stock switching legs has its trades summed
+    """
+    dates = list(weights_per_date)
+    legs_per_date = [
+        [
+            (
+                {int(permno): weight for permno, weight in leg_weights.items()},
+                {int(permno): spread for permno, spread in leg_spreads.items()},
+            )
+            for leg_weights, leg_spreads in zip(
+                weights_per_date[date], spreads_per_date[date]
+            )
+        ]
+        for date in dates
+    ]
+    permnos = np.array(
+        sorted(
+            {
+                permno
+                for legs in legs_per_date
+                for leg_weights, _ in legs
+                for permno in leg_weights
+            }
+        ),
+        dtype=np.int64,
+    )
+    permno_cols = {permno: col for col, permno in enumerate(permnos)}
+    weight_entries, trade_entries = ([], [], []), ([], [], [], [])
+    prev_legs = [({}, {}), ({}, {})]
+
+    for row, (date, legs) in enumerate(zip(dates, legs_per_date)):
+        year, month, _ = date.split("-")
+        year, month = (
+            (int(year), int(month) + 1) if int(month) < 12 else (int(year) + 1, 1)
+        )
+        # Short weights drift with the return of the last long stock,
+        # as in compute_total_cost_for_date
+        long_weights = legs[0][0]
+        drift_returns = (
+            None,
+            (
+                get_holding_return(
+                    cum_returns_per_month, year, month, list(long_weights)[-1]
+                )
+                if long_weights
+                else 0
+            ),
+        )
+
+        for (leg_weights, leg_spreads), (prev_weights, prev_spreads), drift in zip(
+            legs, prev_legs, drift_returns
+        ):
+            for permno, weight in leg_weights.items():
+                for entries, val in zip(
+                    weight_entries, (row, permno_cols[permno], weight)
+                ):
+                    entries.append(val)
+
+            for permno, (trade, trade_cost) in get_stock_trades_for_date(
+                leg_weights,
+                prev_weights,
+                leg_spreads,
+                prev_spreads,
+                cum_returns_per_month,
+                year,
+                month,
+                drift,
+            ).items():
+                for entries, val in zip(
+                    trade_entries, (row, permno_cols[permno], trade, trade_cost)
+                ):
+                    entries.append(val)
+
+        prev_legs = legs
+
+    shape = (len(dates), len(permnos))
+    rows, cols, weights = weight_entries
+    trade_rows, trade_cols, trades, trade_costs = trade_entries
+
+    return {
+        "dates": np.array(dates),
+        "permnos": permnos,
+        "weights": sparse.csr_matrix((weights, (rows, cols)), shape=shape),
+        "trades": sparse.csr_matrix((trades, (trade_rows, trade_cols)), shape=shape),
+        "trade_costs": sparse.csr_matrix(
+            (trade_costs, (trade_rows, trade_cols)), shape=shape
+        ),
+    }
+
+
+def save_holdings(holdings: dict, path: str) -> None:
+    """
+    Saves holdings to a single compressed npz file, storing the csr
+    components of each matrix
+    """
+    components = {"dates": holdings["dates"], "permnos": holdings["permnos"]}
+    for name in HOLDINGS_MATRICES:
+        matrix = holdings[name]
+        components[f"{name}_data"] = matrix.data
+        components[f"{name}_indices"] = matrix.indices
+        components[f"{name}_indptr"] = matrix.indptr
+
+    np.savez_compressed(path, **components)
+
+
+def load_holdings(path: str) -> dict:
+    """
+    Loads holdings saved by save_holdings
+    """
+    with np.load(path) as components:
+        shape = (len(components["dates"]), len(components["permnos"]))
+
+        return {
+            "dates": components["dates"],
+            "permnos": components["permnos"],
+            **{
+                name: sparse.csr_matrix(
+                    (
+                        components[f"{name}_data"],
+                        components[f"{name}_indices"],
+                        components[f"{name}_indptr"],
+                    ),
+                    shape=shape,
+                )
+                for name in HOLDINGS_MATRICES
+            },
+        }
+
+
+def get_leg_weights(holdings: dict, leg: str = None) -> sparse.csr_matrix:
+    """
+    Returns weights of the long or the short leg, or of both
+    """
+    weights = holdings["weights"]
+    if leg == "long":
+        return weights.maximum(0)
+    if leg == "short":
+        return weights.minimum(0)
+
+    return weights
+
+
+def get_held_matrix(holdings: dict, leg: str = None) -> sparse.csr_matrix:
+    """
+    Returns 0/1 date x permno matrix of the held stocks
+    """
+    held = get_leg_weights(holdings, leg) != 0
+
+    return held.astype(np.int64)
+
+
+def align_permnos(
+    matrix: sparse.csr_matrix, permnos: np.ndarray, new_permnos: np.ndarray
+) -> sparse.csr_matrix:
+    """
+    Moves matrix columns to a new permno axis through a sparse selection
+    matrix, permnos missing from the new axis are dropped
+    """
+    new_cols = np.searchsorted(new_permnos, permnos)
+    is_kept = (new_cols < len(new_permnos)) & (
+        new_permnos[np.minimum(new_cols, len(new_permnos) - 1)] == permnos
+    )
+    selection = sparse.csr_matrix(
+        (np.ones(is_kept.sum()), (np.flatnonzero(is_kept), new_cols[is_kept])),
+        shape=(len(permnos), len(new_permnos)),
+    )
+
+    return matrix @ selection
+
+
+def get_turnover(holdings: dict) -> pd.Series:
+    """
+    Returns the sum of absolute traded weights per date
+    """
+    return pd.Series(
+        np.asarray(abs(holdings["trades"]).sum(axis=1)).ravel(),
+        index=holdings["dates"],
+        name="turnover",
+    )
+
+
+def get_holding_periods(holdings: dict, leg: str = None) -> pd.DataFrame:
+    """
+    Returns per permno the months held, the number of separate holding
+    spells and the average spell length in months
+    """
+    held = get_held_matrix(holdings, leg)
+    # Shift matrix moves each date's holdings to the next date
+    shift = sparse.eye(held.shape[0], k=-1, format="csr", dtype=np.int64)
+    entries = (held - shift @ held).maximum(0)
+    months_held = np.asarray(held.sum(axis=0)).ravel()
+    num_spells = np.asarray(entries.sum(axis=0)).ravel()
+
+    holding_periods = pd.DataFrame(
+        {
+            "months_held": months_held,
+            "num_spells": num_spells,
+            "avg_holding_period": months_held / np.maximum(num_spells, 1),
+        },
+        index=pd.Index(holdings["permnos"], name="PERMNO"),
+    )
+
+    return holding_periods[holding_periods["months_held"] > 0]
+
+
+def get_name_overlap(
+    holdings: dict, other_holdings: dict, leg: str = None
+) -> pd.Series:
+    """
+    Returns per date the share of names held by either run that both
+    runs hold, for example for two cost sensitivities
+    """
+    permnos = np.union1d(holdings["permnos"], other_holdings["permnos"])
+    dates = np.intersect1d(holdings["dates"], other_holdings["dates"])
+    held, other_held = (
+        align_permnos(
+            get_held_matrix(curr_holdings, leg)[
+                np.searchsorted(curr_holdings["dates"], dates)
+            ],
+            curr_holdings["permnos"],
+            permnos,
+        )
+        for curr_holdings in (holdings, other_holdings)
+    )
+    num_common = np.asarray(held.multiply(other_held).sum(axis=1)).ravel()
+    num_either = (
+        np.asarray(held.sum(axis=1)).ravel()
+        + np.asarray(other_held.sum(axis=1)).ravel()
+        - num_common
+    )
+
+    return pd.Series(
+        num_common / np.maximum(num_either, 1), index=dates, name="name_overlap"
+    )
+
+
+def get_concentration(holdings: dict) -> pd.DataFrame:
+    """
+    Returns per date and leg the Herfindahl index of the weights, the
+    effective number of stocks and the largest absolute weight
+    """
+    concentration = dict()
+
+    for leg in ["long", "short"]:
+        weights = abs(get_leg_weights(holdings, leg))
+        gross_weights = np.asarray(weights.sum(axis=1)).ravel()
+        herfindahl = np.asarray(weights.multiply(weights).sum(axis=1)).ravel() / (
+            np.maximum(gross_weights, 1e-300) ** 2
+        )
+        concentration[f"{leg}_herfindahl"] = herfindahl
+        concentration[f"{leg}_effective_stocks"] = 1 / np.maximum(herfindahl, 1e-300)
+        concentration[f"{leg}_max_weight"] = weights.max(axis=1).toarray().ravel()
+
+    return pd.DataFrame(concentration, index=holdings["dates"])
+
+
+def get_cost_attribution(holdings: dict, by: str = "permno") -> pd.Series:
+    """
+    Attributes trading costs to stocks or to dates, per date these add
+    up to the run's total costs
+    """
+    costs = holdings["trade_costs"]
+
+    if by == "date":
+        return pd.Series(
+            np.asarray(costs.sum(axis=1)).ravel(), index=holdings["dates"], name="cost"
+        )
+
+    return pd.Series(
+        np.asarray(costs.sum(axis=0)).ravel(),
+        index=pd.Index(holdings["permnos"], name="PERMNO"),
+        name="cost",
+    ).sort_values(ascending=False)
@@ -0,0 +1,326 @@
+from datetime import datetime
+from utils import (
+    extract_data,
+    get_split_path,
+    read_splits,
+    write_splits,
+    MODEL_NAMES,
+    WEIGHTINGS,
+)
+from run_strategies.two_stage_momentum import get_final_splits
+from run_strategies.portfolio_return import (
+    find_returns_per_mo_stock,
+    get_equal_weights,
+    get_value_weights,
+    get_weighted_daily_returns,
+    get_prev_quoted_spreads,
+    compute_total_return_for_date,
+    compute_total_cost_for_date,
+    compute_sum_sq_ret,
+)
+from run_strategies.garch_rv import sigma_hat_rv, sigma_hat_garch
+import pandas as pd
+import json
+import math
+import os
+import sys
+
+
+BUFFER_PATH = "update_buffer.pkl"
+
+
+def get_state_path(cost_sensitivity: int) -> str:
+    """
+    Returns path of the persisted update state for given lambda
+    """
+    return f"update_state_lambda_{cost_sensitivity}.json"
+
+
+def get_month_end(year: int, month: int) -> pd.Timestamp:
+    """
+    Returns the month-end date for given year and month
+    """
+    return pd.Timestamp(datetime(year, month, 1)) + pd.offsets.MonthEnd(0)
+
+
+def get_weighting_func(is_weighting_func_equal: bool):
+    """
+    Returns the standard weighting function
+    """
+    return get_equal_weights if is_weighting_func_equal else get_value_weights
+
+
+def get_strategy_weights(
+    strategy_state: dict,
+    two_stage_date_dict: dict,
+    is_weighting_func_equal: bool,
+    hedged: bool,
+    sigma_model_rv: bool,
+    date: str,
+    sigma_target: float = 0.12 / math.sqrt(12),
+) -> tuple[dict, dict]:
+    """
+    Gets long and short weights for date, updating the strategy's
+    hedging history in place
+    """
+    weighting_func = get_weighting_func(is_weighting_func_equal)
+    long_weights, short_weights = weighting_func(two_stage_date_dict)
+
+    if not hedged:
+        return long_weights, short_weights
+
+    # GARCH only ever looks at the last 500 days
+    strategy_state["daily_returns"] = (
+        strategy_state["daily_returns"]
+        + get_weighted_daily_returns(two_stage_date_dict, long_weights, short_weights)
+    )[-500:]
+    sigma_hat = (
+        sigma_hat_rv(
+            compute_sum_sq_ret(two_stage_date_dict, long_weights, short_weights)
+        )
+        if sigma_model_rv
+        else sigma_hat_garch(strategy_state["daily_returns"])
+    )
+    strategy_state["vol_predictions"][date] = float(sigma_hat)
+
+    return weighting_func(two_stage_date_dict, sigma_target / sigma_hat)
+
+
+def get_month_record(
+    strategy_state: dict,
+    state: dict,
+    cum_returns_per_month: dict,
+    year: int,
+    month: int,
+) -> dict:
+    """
+    Computes realized return, cost and sum of squared returns of the
+    portfolio formed at the last rebalancing date
+    """
+    two_stage_date_dict = state["split"]
+    long_weights = strategy_state["long_weights"]
+    short_weights = strategy_state["short_weights"]
+
+    return {
+        "total_return": compute_total_return_for_date(
+            two_stage_date_dict,
+            cum_returns_per_month,
+            year,
+            month,
+            long_weights,
+            short_weights,
+        ),
+        "total_cost": compute_total_cost_for_date(
+            two_stage_date_dict,
+            cum_returns_per_month,
+            state["prev_long_quoted_spreads"],
+            state["prev_short_quoted_spreads"],
+            year,
+            month,
+            long_weights,
+            short_weights,
+            strategy_state["prev_long_weights"],
+            strategy_state["prev_short_weights"],
+        ),
+        "sum_squared_return": compute_sum_sq_ret(
+            two_stage_date_dict, long_weights, short_weights
+        ),
+    }
+
+
+def rebalance_state(state: dict, new_split: dict, date: str) -> None:
+    """
+    Rolls the state forward to a new rebalancing date
+    """
+    state["prev_long_quoted_spreads"] = get_prev_quoted_spreads(
+        state["split"]["long_split"]
+    )
+    state["prev_short_quoted_spreads"] = get_prev_quoted_spreads(
+        state["split"]["short_split"]
+    )
+    state["split"] = new_split
+    state["date"] = date
+
+    for (hedged, sigma_model_rv), model_name in MODEL_NAMES.items():
+        for weighting in WEIGHTINGS:
+            strategy_state = state["strategies"][f"{model_name}_{weighting}"]
+            strategy_state["prev_long_weights"] = strategy_state["long_weights"]
+            strategy_state["prev_short_weights"] = strategy_state["short_weights"]
+            (
+                strategy_state["long_weights"],
+                strategy_state["short_weights"],
+            ) = get_strategy_weights(
+                strategy_state,
+                new_split,
+                weighting == "equal",
+                hedged,
+                sigma_model_rv,
+                date,
+            )
+
+
+def to_json_split(split: dict) -> dict:
+    """
+    Converts split output to the json layout of the split files
+    (string PERMNO keys, plain floats)
+    """
+    return json.loads(json.dumps(split))
+
+
+def initialize_update_state(
+    start_year: int = 2005, end_year: int = 2024, cost_sensitivity: int = 0
+) -> dict:
+    """
+    Builds the update state from the outputs of a full run, so that
+    later months can be appended without rerunning the full history
+    """
+    strategies = {
+        f"{model_name}_{weighting}": {
+            "long_weights": None,
+            "short_weights": None,
+            "daily_returns": [],
+            "vol_predictions": dict(),
+        }
+        for model_name in MODEL_NAMES.values()
+        for weighting in WEIGHTINGS
+    }
+    last_splits = []
+
+    # Only the unscaled series enters the GARCH history, the last two
+    # dates are rebalanced below
+    for date, two_stage_date_dict in read_splits(
+        start_year, end_year, cost_sensitivity
+    ):
+        last_splits.append((date, two_stage_date_dict))
+        if len(last_splits) <= 2:
+            continue
+
+        _, two_stage_date_dict = last_splits.pop(0)
+        for weighting in WEIGHTINGS:
+            weighting_func = get_weighting_func(weighting == "equal")
+            daily_returns = get_weighted_daily_returns(
+                two_stage_date_dict, *weighting_func(two_stage_date_dict)
+            )
+            for model_name in MODEL_NAMES.values():
+                strategy_state = strategies[f"{model_name}_{weighting}"]
+                strategy_state["daily_returns"] = (
+                    strategy_state["daily_returns"] + daily_returns
+                )[-500:]
+
+    (prev_date, prev_split), (last_date, last_split) = last_splits
+    state = {
+        "date": prev_date,
+        "split": prev_split,
+        "prev_long_quoted_spreads": None,
+        "prev_short_quoted_spreads": None,
+        "strategies": strategies,
+    }
+    for (hedged, sigma_model_rv), model_name in MODEL_NAMES.items():
+        for weighting in WEIGHTINGS:
+            strategy_state = strategies[f"{model_name}_{weighting}"]
+            (
+                strategy_state["long_weights"],
+                strategy_state["short_weights"],
+            ) = get_strategy_weights(
+                strategy_state,
+                prev_split,
+                weighting == "equal",
+                hedged,
+                sigma_model_rv,
+                prev_date,
+            )
+
+    rebalance_state(state, last_split, last_date)
+
+    data = extract_data(f"{start_year}-{end_year} v2.csv")
+    data = data[data["DlyCalDt"] > pd.Timestamp(last_date) - pd.DateOffset(years=1)]
+    data.to_pickle(BUFFER_PATH)
+
+    with open(get_state_path(cost_sensitivity), "w") as file:
+        json.dump(state, file)
+
+    return state
+
+
+def append_month_record(record: dict, path: str, year: int, month: int) -> None:
+    """
+    Appends the month record to the existing return and cost output,
+    replacing the placeholder row of a full run if present
+    """
+    new_row = pd.DataFrame.from_dict({(year, month): record}, orient="index")
+    new_row = new_row.rename_axis(["year", "month"])
+
+    if os.path.exists(path):
+        results = pd.read_csv(path, index_col=["year", "month"])
+        results = results[results.index != (year, month)]
+        new_row = pd.concat([results, new_row])
+
+    new_row.to_csv(path)
+
+
+def run_monthly_update(
+    new_month_path: str,
+    start_year: int = 2005,
+    end_year: int = 2024,
+    cost_sensitivities: tuple = (0, 1, 6, 12),
+) -> None:
+    """
+    Ingests one new month of daily data, appends its realized returns and
+    costs to the outputs and rebalances all strategies at its month-end
+    """
+    new_data = extract_data(new_month_path)
+    year = int(new_data["year"].max())
+    month = int(new_data[new_data["year"] == year]["month"].max())
+    new_data = new_data[(new_data["year"] == year) & (new_data["month"] == month)]
+    month_end = get_month_end(year, month)
+
+    data = pd.concat([pd.read_pickle(BUFFER_PATH), new_data])
+    data = data[data["DlyCalDt"] > month_end - pd.DateOffset(years=1)]
+    cum_returns_per_month = find_returns_per_mo_stock(new_data)
+
+    for cost_sensitivity in cost_sensitivities:
+        print(f"updating {year}-{month:02d} for lambda = {cost_sensitivity}")
+        with open(get_state_path(cost_sensitivity)) as file:
+            state = json.load(file)
+
+        if pd.Timestamp(state["date"]) != month_end - pd.offsets.MonthEnd(1):
+            raise ValueError(
+                f"State for lambda = {cost_sensitivity} is at {state["date"]}, "
+                + f"cannot append {year}-{month:02d}"
+            )
+
+        for model_name in MODEL_NAMES.values():
+            for weighting in WEIGHTINGS:
+                append_month_record(
+                    get_month_record(
+                        state["strategies"][f"{model_name}_{weighting}"],
+                        state,
+                        cum_returns_per_month,
+                        year,
+                        month,
+                    ),
+                    f"ret_cost_{model_name}_{weighting}_{start_year}_{end_year}_lambda_{cost_sensitivity}.csv",
+                    year,
+                    month,
+                )
+
+        long_split, short_split = get_final_splits(
+            data, cost_sensitivity=cost_sensitivity
+        )
+        new_split = to_json_split(
+            {"long_split": long_split, "short_split": short_split}
+        )
+        rebalance_state(state, new_split, str(month_end.date()))
+
+        split_path = get_split_path(start_year, end_year, cost_sensitivity)
+        if os.path.exists(split_path):
+            write_splits([(state["date"], new_split)], split_path, mode="a")
+
+        with open(get_state_path(cost_sensitivity), "w") as file:
+            json.dump(state, file)
+
+    data.to_pickle(BUFFER_PATH)
+
+
+if __name__ == "__main__":
+    run_monthly_update(sys.argv[1])
@@ -0,0 +1,199 @@
+from collections import deque
+from datetime import datetime
+from utils import prepare_data, get_split_path, write_splits
+from run_strategies.two_stage_momentum import (
+    get_stock_month_returns,
+    combine_stock_month_returns,
+    get_final_splits,
+)
+from typing import Iterator
+import pandas as pd
+import shutil
+import glob
+import os
+
+
+PARTITION_DIR = "year_partitions"
+STOCK_MONTH_DIR = "stock_month_returns"
+
+
+def partition_data_by_year(
+    paths: list, partition_dir: str = PARTITION_DIR, chunksize: int = 1_000_000
+) -> list:
+    """
+    Streams raw data files in chunks, prepares each chunk and spills it
+    to per-year partitions, returns the years found
+    """
+    years = set()
+
+    for file_num, path in enumerate(paths):
+        for chunk_num, chunk in enumerate(pd.read_csv(path, chunksize=chunksize)):
+            chunk = prepare_data(chunk)
+
+            for year, year_data in chunk.groupby("year"):
+                os.makedirs(os.path.join(partition_dir, str(year)), exist_ok=True)
+                year_data.to_pickle(
+                    os.path.join(
+                        partition_dir, str(year), f"{file_num}_{chunk_num}.pkl"
+                    )
+                )
+                years.add(int(year))
+
+    return sorted(years)
+
+
+def load_year_partition(year: int, partition_dir: str = PARTITION_DIR) -> pd.DataFrame:
+    """
+    Loads one year of prepared data, observations present in several
+    overlapping data files are kept once
+    """
+    return (
+        pd.concat(
+            [
+                pd.read_pickle(piece)
+                for piece in sorted(
+                    glob.glob(os.path.join(partition_dir, str(year), "*.pkl"))
+                )
+            ]
+        )
+        .drop_duplicates(["PERMNO", "DlyCalDt"], keep="last")
+        .sort_values(["PERMNO", "DlyCalDt"], kind="stable")
+    )
+
+
+def get_stock_month_path(year: int, month: int, stock_month_dir: str) -> str:
+    """
+    Returns path of the spilled stock returns of a month
+    """
+    return os.path.join(stock_month_dir, f"{year}-{month:02d}.pkl")
+
+
+def spill_stock_month_returns(
+    years: list,
+    partition_dir: str = PARTITION_DIR,
+    stock_month_dir: str = STOCK_MONTH_DIR,
+) -> None:
+    """
+    Computes per-stock monthly aggregates one year partition at a time
+    and spills them to disk, one file per month
+    """
+    os.makedirs(stock_month_dir, exist_ok=True)
+
+    for year in years:
+        print(f"aggregating {year}")
+        year_data = load_year_partition(year, partition_dir)
+
+        for month, month_data in year_data.groupby("month"):
+            get_stock_month_returns(month_data).to_pickle(
+                get_stock_month_path(year, month, stock_month_dir)
+            )
+
+
+def prepare_out_of_core(
+    paths: list,
+    partition_dir: str = PARTITION_DIR,
+    stock_month_dir: str = STOCK_MONTH_DIR,
+    chunksize: int = 1_000_000,
+) -> None:
+    """
+    Partitions the raw data files by year and spills per-stock monthly
+    aggregates, this is shared by all cost sensitivities. Both directories
+    are cleared first, so that pieces of earlier runs are never read back
+    """
+    for directory in (partition_dir, stock_month_dir):
+        shutil.rmtree(directory, ignore_errors=True)
+
+    spill_stock_month_returns(
+        partition_data_by_year(paths, partition_dir, chunksize),
+        partition_dir,
+        stock_month_dir,
+    )
+
+
+def iterate_out_of_core_splits(
+    start_year: int,
+    end_year: int,
+    cost_sensitivity: int,
+    stock_month_dir: str = STOCK_MONTH_DIR,
+) -> Iterator[tuple[str, dict]]:
+    """
+    Yields the two-stage sorting legs date by date, sliding a 12-month
+    buffer of spilled monthly aggregates over the history
+    """
+    window = deque(maxlen=12)
+
+    for date in pd.date_range(
+        start=datetime(start_year, 1, 31), end=datetime(end_year, 12, 31), freq="ME"
+    ):
+        path = get_stock_month_path(date.year, date.month, stock_month_dir)
+        window.append(pd.read_pickle(path) if os.path.exists(path) else None)
+        if date < datetime(start_year, 12, 31):
+            continue
+
+        print(date)
+        long_split, short_split = get_final_splits(
+            None,
+            cost_sensitivity=cost_sensitivity,
+            stock_returns=combine_stock_month_returns(
+                pd.concat([month for month in window if month is not None])
+            ),
+        )
+
+        yield str(date.to_pydatetime().date()), {
+            "long_split": long_split,
+            "short_split": short_split,
+        }
+
+
+def get_out_of_core_splits(
+    start_year: int,
+    end_year: int,
+    cost_sensitivity: int = 0,
+    stock_month_dir: str = STOCK_MONTH_DIR,
+) -> str:
+    """
+    Extracts final long and short splits of the given period to a json
+    lines file from the spilled aggregates, memory stays bounded by the
+    formation window whatever the length of the history
+    """
+    split_path = get_split_path(start_year, end_year, cost_sensitivity)
+    write_splits(
+        iterate_out_of_core_splits(
+            start_year, end_year, cost_sensitivity, stock_month_dir
+        ),
+        split_path,
+    )
+
+    return split_path
+
+
+def get_out_of_core_returns_per_month(
+    start_year: int, end_year: int, stock_month_dir: str = STOCK_MONTH_DIR
+) -> dict:
+    """
+    Gets compound return of each stock and month of the period from the
+    spilled aggregates, in the layout of find_returns_per_mo_stock
+    """
+    cum_returns_per_month = dict()
+
+    for date in pd.date_range(
+        start=datetime(start_year, 1, 31), end=datetime(end_year, 12, 31), freq="ME"
+    ):
+        path = get_stock_month_path(date.year, date.month, stock_month_dir)
+        if not os.path.exists(path):
+            continue
+
+        for (permno, _), cumulative_return in pd.read_pickle(path)[
+            "cumulative_return"
+        ].items():
+            cum_returns_per_month[(date.year, date.month, permno)] = {
+                "cumulative_return": cumulative_return
+            }
+
+    return cum_returns_per_month
+
+
+if __name__ == "__main__":
+    prepare_out_of_core(["1993-2005 v2.csv", "2005-2024 v2.csv"])
+    for cost_sensitivity in [0, 1, 6, 12]:
+        get_out_of_core_splits(1993, 2024, cost_sensitivity)
@@ -0,0 +1,458 @@
+from utils import extract_data
+from run_strategies.two_stage_momentum import (
+    compare_float32_splits,
+    find_splits_per_date,
+    reset_random_day_rng,
+)
+from run_strategies.portfolio_return import (
+    find_returns_per_mo_stock,
+    compute_portfolio_returns,
+    get_batch_garch_forecasts,
+    reset_hedging_state,
+    garch_predictions,
+    rv_predictions,
+)
+from datetime import datetime
+import pandas as pd
+import json
+import sys
+
+
+DEFAULT_TOLERANCES = {
+    "cost_adjusted_return": 1e-10,
+    "avg_market_cap": 1e-10,
+    "avg_quoted_spread": 1e-10,
+    "daily_returns": 1e-12,
+    "weight": 1e-12,
+    "total_return": 1e-10,
+    "total_cost": 1e-10,
+    "sum_squared_return": 1e-10,
+    "sigma_hat": 1e-8,
+}
+SPLIT_FIELDS = ["cost_adjusted_return", "avg_market_cap", "avg_quoted_spread"]
+RETURN_FIELDS = ["total_return", "total_cost", "sum_squared_return"]
+
+
+def find_reference_splits(
+    data_path: str, start_year: int, end_year: int, cost_sensitivity: int
+) -> dict:
+    """
+    Finds splits with the reference data layout
+    """
+    return find_splits_per_date(
+        extract_data(data_path),
+        start_year,
+        end_year,
+        cost_sensitivity,
+    )
+
+
+def find_compact_splits(
+    data_path: str, start_year: int, end_year: int, cost_sensitivity: int
+) -> dict:
+    """
+    Finds splits with the compact data layout
+    """
+    return find_splits_per_date(
+        extract_data(data_path, compact=True),
+        start_year,
+        end_year,
+        cost_sensitivity,
+    )
+
+
+def find_compact_float32_splits(
+    data_path: str, start_year: int, end_year: int, cost_sensitivity: int
+) -> dict:
+    """
+    Finds splits with the compact float32 data layout
+    """
+    return find_splits_per_date(
+        extract_data(data_path, compact=True, use_float32=True),
+        start_year,
+        end_year,
+        cost_sensitivity,
+    )
+
+
+def compute_reference_portfolio_returns(
+    two_stage_output: dict,
+    cum_returns_per_month: dict,
+    is_weighting_func_equal: bool,
+    hedged: bool,
+    sigma_model_rv: bool,
+    weights_per_date: dict,
+) -> dict:
+    """
+    Computes portfolio returns with the serial reference loop
+    """
+    return compute_portfolio_returns(
+        is_weighting_func_equal,
+        two_stage_output,
+        cum_returns_per_month,
+        hedged,
+        sigma_model_rv,
+        weights_per_date=weights_per_date,
+    )
+
+
+def compute_batch_garch_portfolio_returns(
+    two_stage_output: dict,
+    cum_returns_per_month: dict,
+    is_weighting_func_equal: bool,
+    hedged: bool,
+    sigma_model_rv: bool,
+    weights_per_date: dict,
+) -> dict:
+    """
+    Computes portfolio returns with GARCH forecasts fitted in parallel.
+    The candidate always fits, since the reference run fills the
+    forecast cache with the same windows
+    """
+    return compute_portfolio_returns(
+        is_weighting_func_equal,
+        two_stage_output,
+        cum_returns_per_month,
+        hedged,
+        sigma_model_rv,
+        (
+            get_batch_garch_forecasts(
+                two_stage_output, is_weighting_func_equal, use_cache=False
+            )
+            if hedged and not sigma_model_rv
+            else None
+        ),
+        weights_per_date=weights_per_date,
+    )
+
+
+SPLIT_ENGINES = {
+    "reference": find_reference_splits,
+    "compact": find_compact_splits,
+    "compact_float32": find_compact_float32_splits,
+}
+PORTFOLIO_ENGINES = {
+    "reference": compute_reference_portfolio_returns,
+    "batch_garch": compute_batch_garch_portfolio_returns,
+}
+
+
+def is_divergent(reference: float, candidate: float, tolerance: float) -> bool:
+    """
+    Checks whether values differ by more than the tolerance, relative
+    to the reference value once it exceeds one in magnitude
+    """
+    return abs(reference - candidate) > tolerance * max(1, abs(reference))
+
+
+def get_divergence(
+    stage: str, date: str, permno: str, field: str, reference, candidate
+) -> dict:
+    """
+    Returns a divergence record
+    """
+    return {
+        "stage": stage,
+        "date": date,
+        "permno": permno,
+        "field": field,
+        "reference": reference,
+        "candidate": candidate,
+    }
+
+
+def compare_splits(
+    reference_splits: dict, candidate_splits: dict, tolerances: dict
+) -> list:
+    """
+    Diffs leg membership and per-stock fields of two split outputs
+    """
+    divergences = []
+
+    for date, reference_date_dict in reference_splits.items():
+        candidate_date_dict = candidate_splits.get(date, {})
+
+        for leg in ["long_split", "short_split"]:
+            reference_leg = {
+                str(permno): val for permno, val in reference_date_dict[leg].items()
+            }
+            candidate_leg = {
+                str(permno): val
+                for permno, val in candidate_date_dict.get(leg, {}).items()
+            }
+
+            for permno in sorted(reference_leg.keys() ^ candidate_leg.keys()):
+                divergences.append(
+                    get_divergence(
+                        "splits",
+                        date,
+                        permno,
+                        f"{leg}_membership",
+                        permno in reference_leg,
+                        permno in candidate_leg,
+                    )
+                )
+
+            for permno in sorted(reference_leg.keys() & candidate_leg.keys()):
+                reference_stock, candidate_stock = (
+                    reference_leg[permno],
+                    candidate_leg[permno],
+                )
+                for field in SPLIT_FIELDS:
+                    if is_divergent(
+                        reference_stock[field],
+                        candidate_stock[field],
+                        tolerances[field],
+                    ):
+                        divergences.append(
+                            get_divergence(
+                                "splits",
+                                date,
+                                permno,
+                                f"{leg}_{field}",
+                                reference_stock[field],
+                                candidate_stock[field],
+                            )
+                        )
+
+                reference_returns = reference_stock["daily_returns"]
+                candidate_returns = candidate_stock["daily_returns"]
+                if len(reference_returns) != len(candidate_returns) or any(
+                    is_divergent(ref, cand, tolerances["daily_returns"])
+                    for ref, cand in zip(reference_returns, candidate_returns)
+                ):
+                    divergences.append(
+                        get_divergence(
+                            "splits",
+                            date,
+                            permno,
+                            f"{leg}_daily_returns",
+                            len(reference_returns),
+                            len(candidate_returns),
+                        )
+                    )
+
+    return divergences
+
+
+def compare_weights(
+    reference_weights: dict, candidate_weights: dict, tolerances: dict
+) -> list:
+    """
+    Diffs long and short weights per date and PERMNO
+    """
+    divergences = []
+
+    for date, reference_legs in reference_weights.items():
+        candidate_legs = candidate_weights.get(date, ({}, {}))
+
+        for leg, reference_leg, candidate_leg in zip(
+            ["long", "short"], reference_legs, candidate_legs
+        ):
+            for permno in sorted(reference_leg.keys() | candidate_leg.keys()):
+                reference, candidate = (
+                    reference_leg.get(permno, 0),
+                    candidate_leg.get(permno, 0),
+                )
+                if is_divergent(reference, candidate, tolerances["weight"]):
+                    divergences.append(
+                        get_divergence(
+                            "weights",
+                            date,
+                            permno,
+                            f"{leg}_weight",
+                            reference,
+                            candidate,
+                        )
+                    )
+
+    return divergences
+
+
+def compare_portfolio_returns(
+    reference_returns: dict, candidate_returns: dict, tolerances: dict
+) -> list:
+    """
+    Diffs monthly returns, costs and sums of squared returns
+    """
+    divergences = []
+
+    for (year, month), reference_month in reference_returns.items():
+        candidate_month = candidate_returns.get((year, month), {})
+
+        for field in RETURN_FIELDS:
+            if field not in candidate_month or is_divergent(
+                reference_month[field], candidate_month[field], tolerances[field]
+            ):
+                divergences.append(
+                    get_divergence(
+                        "returns",
+                        f"{year}-{month:02d}",
+                        None,
+                        field,
+                        reference_month[field],
+                        candidate_month.get(field),
+                    )
+                )
+
+    return divergences
+
+
+def compare_vol_forecasts(
+    reference_forecasts: dict, candidate_forecasts: dict, tolerances: dict
+) -> list:
+    """
+    Diffs volatility forecasts per date
+    """
+    return [
+        get_divergence(
+            "vol_forecasts",
+            date,
+            None,
+            "sigma_hat",
+            reference,
+            candidate_forecasts.get(date),
+        )
+        for date, reference in reference_forecasts.items()
+        if date not in candidate_forecasts
+        or is_divergent(reference, candidate_forecasts[date], tolerances["sigma_hat"])
+    ]
+
+
+def run_split_engine(
+    engine: str,
+    data_path: str,
+    start_year: int,
+    end_year: int,
+    cost_sensitivity: int,
+) -> dict:
+    """
+    Runs a split engine with freshly seeded spread day sampling
+    """
+    reset_random_day_rng()
+    splits = SPLIT_ENGINES[engine](data_path, start_year, end_year, cost_sensitivity)
+
+    # Json round trip gives the splits the layout read back from file
+    return json.loads(json.dumps(splits))
+
+
+def run_portfolio_engine(
+    engine: str,
+    two_stage_output: dict,
+    cum_returns_per_month: dict,
+    is_weighting_func_equal: bool,
+    hedged: bool,
+    sigma_model_rv: bool,
+) -> tuple[dict, dict, dict]:
+    """
+    Runs a portfolio engine from a clean hedging state and returns its
+    monthly returns, weights and volatility forecasts
+    """
+    reset_hedging_state()
+    weights_per_date = dict()
+    portfolio_returns = PORTFOLIO_ENGINES[engine](
+        two_stage_output,
+        cum_returns_per_month,
+        is_weighting_func_equal,
+        hedged,
+        sigma_model_rv,
+        weights_per_date,
+    )
+    vol_forecasts = dict(rv_predictions if sigma_model_rv else garch_predictions)
+
+    return portfolio_returns, weights_per_date, vol_forecasts
+
+
+def compare_float32_layout(
+    data_path: str, start_year: int, end_year: int, cost_sensitivity: int
+) -> pd.DataFrame:
+    """
+    Compares the float32 layout's splits with the float64 compact splits
+    per date, with the same spread days, and saves the comparison
+    """
+    comparison = compare_float32_splits(
+        extract_data(data_path, compact=True),
+        extract_data(data_path, use_float32=True),
+        pd.date_range(
+            start=datetime(start_year, 12, 31),
+            end=datetime(end_year, 12, 31),
+            freq="ME",
+        ),
+        cost_sensitivity,
+    )
+    comparison.to_csv(
+        f"float32_split_comparison_{start_year}_{end_year}"
+        + f"_lambda_{cost_sensitivity}.csv"
+    )
+    print(
+        "float32 splits: lowest membership overlap "
+        + f"{comparison["membership_overlap"].min():.4f}, largest return "
+        + f"difference {comparison["max_return_difference"].max():.2e}"
+    )
+
+    return comparison
+
+
+def run_parity_check(
+    data_path: str,
+    start_year: int,
+    end_year: int,
+    cost_sensitivity: int = 0,
+    split_engine: str = "compact",
+    portfolio_engine: str = "batch_garch",
+    is_weighting_func_equal: bool = True,
+    hedged: bool = True,
+    sigma_model_rv: bool = False,
+    tolerances: dict = DEFAULT_TOLERANCES,
+) -> pd.DataFrame:
+    """
+    Runs the reference path and the selected fast engines on the same data
+    and reports every divergence beyond the per-field tolerances, the
+    portfolio engines are both run on the reference splits. The float32
+    split engine is also compared with float64 splits date by date
+    """
+    if split_engine == "compact_float32":
+        compare_float32_layout(data_path, start_year, end_year, cost_sensitivity)
+
+    reference_splits, candidate_splits = (
+        run_split_engine(engine, data_path, start_year, end_year, cost_sensitivity)
+        for engine in ("reference", split_engine)
+    )
+
+    cum_returns_per_month = find_returns_per_mo_stock(extract_data(data_path))
+    reference_run, candidate_run = (
+        run_portfolio_engine(
+            engine,
+            reference_splits,
+            cum_returns_per_month,
+            is_weighting_func_equal,
+            hedged,
+            sigma_model_rv,
+        )
+        for engine in ("reference", portfolio_engine)
+    )
+
+    divergences = pd.DataFrame(
+        compare_splits(reference_splits, candidate_splits, tolerances)
+        + compare_weights(reference_run[1], candidate_run[1], tolerances)
+        + compare_portfolio_returns(reference_run[0], candidate_run[0], tolerances)
+        + compare_vol_forecasts(reference_run[2], candidate_run[2], tolerances),
+        columns=["stage", "date", "permno", "field", "reference", "candidate"],
+    )
+
+    for stage in ["splits", "weights", "returns", "vol_forecasts"]:
+        stage_divergences = divergences[divergences["stage"] == stage]
+        if stage_divergences.empty:
+            print(f"{stage}: no divergences")
+            continue
+        first = stage_divergences.iloc[0]
+        print(
+            f"{stage}: {len(stage_divergences)} divergences, first on "
+            + f"{first["date"]} for PERMNO {first["permno"]} ({first["field"]})"
+        )
+
+    return divergences
+
+
+if __name__ == "__main__":
+    run_parity_check(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]))
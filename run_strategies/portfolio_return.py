@@ -1,22 +1,58 @@
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
 import pandas as pd
 from utils import compute_compound_return
+import itertools
 import json
-from utils import extract_data
+from utils import (
+    MODEL_NAMES,
+    WEIGHTINGS,
+    extract_data,
+    get_year_month,
+    read_splits,
+    get_holdings_path,
+)
+from run_strategies.holdings_store import build_holdings, save_holdings
+from typing import Iterable, Union
 from run_strategies.garch_rv import *
 import math
 
 
 garch_predictions = dict()
 rv_predictions = dict()
+vol_model_predictions = defaultdict(dict)
 daily_returns_list = []
 
 
+def reset_hedging_state() -> None:
+    """
+    Clears the hedging history and recorded volatility predictions
+    """
+    daily_returns_list.clear()
+    garch_predictions.clear()
+    rv_predictions.clear()
+    vol_model_predictions.clear()
+
+
+def iterate_two_stage_output(two_stage_output: Union[dict, Iterable]) -> Iterable:
+    """
+    Iterates (date, splits) pairs of loaded or streamed two-stage output
+    """
+    return (
+        two_stage_output.items()
+        if isinstance(two_stage_output, dict)
+        else two_stage_output
+    )
+
+
 def find_returns_per_mo_stock(data: pd.DataFrame) -> dict:
     """
     Computes compount return for each stock for each month
     """
     return (
-        data.groupby(["year", "month", "PERMNO"], sort=False)[["DlyRet"]]
+        data.groupby([*get_year_month(data), "PERMNO"], sort=False)[["DlyRet"]]
         .agg(cumulative_return=("DlyRet", compute_compound_return))
         .to_dict(orient="index")
     )
@@ -254,14 +290,13 @@ def compute_sum_sq_ret(
     return sum([ret**2 for ret in ret_per_day])
 
 
-def update_daily_returns_list(
+def get_weighted_daily_returns(
     two_stage_date_dict: dict, long_weights: dict, short_weights: dict
-) -> None:
+) -> list:
     """
-    Updates daily ret list
+    Returns daily returns of WML strategy over the formation period
     """
     ret_per_day = [0] * 260
-    global daily_returns_list
 
     for permno, val in two_stage_date_dict["long_split"].items():
         for j in range(len(val["daily_returns"])):
@@ -274,7 +309,20 @@ def update_daily_returns_list(
     while ret_per_day and ret_per_day[-1] == 0:
         ret_per_day.pop()
 
-    daily_returns_list += ret_per_day
+    return ret_per_day
+
+
+def update_daily_returns_list(
+    two_stage_date_dict: dict, long_weights: dict, short_weights: dict
+) -> None:
+    """
+    Updates daily ret list
+    """
+    global daily_returns_list
+
+    daily_returns_list += get_weighted_daily_returns(
+        two_stage_date_dict, long_weights, short_weights
+    )
 
 
 def adjust_weights_with_hedging(
@@ -285,24 +333,29 @@ def adjust_weights_with_hedging(
     two_stage_date_dict: dict,
     date: str,
     sigma_target: float = 0.12 / math.sqrt(12),
+    sigma_forecasts: pd.Series = None,
 ) -> tuple[dict, dict]:
     """
-    Adjusts weights with hedging
+    Adjusts weights with hedging, looking the volatility forecast up
+    in sigma_forecasts when these are precomputed
     """
     global daily_returns_list
-    update_daily_returns_list(two_stage_date_dict, long_weights, short_weights)
-    sigma_hat = (
-        sigma_hat_rv(
-            compute_sum_sq_ret(two_stage_date_dict, long_weights, short_weights)
+    if sigma_forecasts is not None:
+        sigma_hat = sigma_forecasts[date]
+    else:
+        update_daily_returns_list(two_stage_date_dict, long_weights, short_weights)
+        sigma_hat = (
+            sigma_hat_rv(
+                compute_sum_sq_ret(two_stage_date_dict, long_weights, short_weights)
+            )
+            if sigma_model_rv
+            else sigma_hat_garch(daily_returns_list)
         )
-        if sigma_model_rv
-        else sigma_hat_garch(daily_returns_list)
-    )
 
-    if sigma_model_rv:
-        rv_predictions[date] = sigma_hat
-    else:
-        garch_predictions[date] = sigma_hat
+        if sigma_model_rv:
+            rv_predictions[date] = sigma_hat
+        else:
+            garch_predictions[date] = sigma_hat
 
     return (
         get_equal_weights(two_stage_date_dict, sigma_target / sigma_hat)
@@ -317,6 +370,7 @@ def get_final_weights_for_date(
     hedged: bool,
     sigma_model_rv: bool,
     date: str,
+    sigma_forecasts: pd.Series = None,
 ) -> tuple[dict, dict]:
     """
     Get final long and short weights for date
@@ -335,12 +389,111 @@ def get_final_weights_for_date(
             sigma_model_rv,
             two_stage_date_dict,
             date,
+            sigma_forecasts=sigma_forecasts,
         )
         if hedged
         else (long_weights, short_weights)
     )
 
 
+def get_garch_windows(
+    two_stage_output: Union[dict, Iterable],
+    is_weighting_func_equal: bool,
+    window_length: int = 500,
+) -> dict:
+    """
+    Builds the GARCH input window of every month-end up front, these only
+    depend on the unscaled weights
+    """
+    windows = dict()
+    daily_returns = []
+
+    for date, two_stage_date_dict in iterate_two_stage_output(two_stage_output):
+        long_weights, short_weights = (
+            get_equal_weights(two_stage_date_dict)
+            if is_weighting_func_equal
+            else get_value_weights(two_stage_date_dict)
+        )
+        daily_returns = (
+            daily_returns
+            + get_weighted_daily_returns(
+                two_stage_date_dict, long_weights, short_weights
+            )
+        )[-window_length:]
+        windows[date] = daily_returns
+
+    return windows
+
+
+def get_batch_garch_forecasts(
+    two_stage_output: Union[dict, Iterable],
+    is_weighting_func_equal: bool,
+    max_workers: int = None,
+    use_cache: bool = True,
+) -> pd.Series:
+    """
+    Fits GARCH on all month-end windows in parallel and returns
+    the date-indexed volatility forecasts, fits are taken from the
+    forecast cache unless use_cache is off
+    """
+    windows = get_garch_windows(two_stage_output, is_weighting_func_equal)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        forecasts = list(
+            executor.map(
+                partial(sigma_hat_garch, use_cache=use_cache),
+                windows.values(),
+                chunksize=8,
+            )
+        )
+
+    return pd.Series(forecasts, index=list(windows.keys()))
+
+
+def get_daily_returns_series(
+    two_stage_output: Union[dict, Iterable], is_weighting_func_equal: bool
+) -> tuple[list, np.ndarray, np.ndarray]:
+    """
+    Concatenates the daily WML returns of each month-end, unscaled weights,
+    into the series GARCH is fitted on, with the end position of each
+    month-end's returns
+    """
+    dates, rows = [], []
+
+    for date, two_stage_date_dict in iterate_two_stage_output(two_stage_output):
+        long_weights, short_weights = (
+            get_equal_weights(two_stage_date_dict)
+            if is_weighting_func_equal
+            else get_value_weights(two_stage_date_dict)
+        )
+        dates.append(date)
+        rows.append(
+            get_weighted_daily_returns(two_stage_date_dict, long_weights, short_weights)
+        )
+
+    return (
+        dates,
+        np.asarray(list(itertools.chain(*rows)), dtype=float),
+        np.cumsum([len(row) for row in rows]),
+    )
+
+
+def get_vol_model_forecasts(
+    two_stage_output: Union[dict, Iterable],
+    is_weighting_func_equal: bool,
+    vol_model: str,
+) -> pd.Series:
+    """
+    Returns date-indexed forecasts of a registered volatility model,
+    all month-ends are read from one pass over the daily series
+    """
+    dates, daily_returns, month_ends = get_daily_returns_series(
+        two_stage_output, is_weighting_func_equal
+    )
+
+    return pd.Series(VOL_MODELS[vol_model](daily_returns, month_ends), index=dates)
+
+
 def get_prev_quoted_spreads(two_stage_date_dict: dict) -> dict:
     """
     Get previous quoted bid-ask spreds
@@ -353,28 +506,48 @@ def get_prev_quoted_spreads(two_stage_date_dict: dict) -> dict:
 
 def compute_portfolio_returns(
     is_weighting_func_equal: bool,
-    two_stage_output: dict,
+    two_stage_output: Union[dict, Iterable],
     cum_returns_per_month: dict,
     hedged: bool = False,
     sigma_model_rv: bool = True,
+    sigma_forecasts: pd.Series = None,
+    vol_model: str = None,
+    weights_per_date: dict = None,
+    spreads_per_date: dict = None,
+    save_predictions: bool = True,
 ) -> dict:
     """
-    Computes portfolio total monthly returns of WML
+    Computes portfolio total monthly returns of WML, hedged portfolios
+    use the registered vol_model if one is named. Two-stage output can
+    be streamed date by date, then only two months of holdings are kept.
+    Final weights and quoted spreads are collected in weights_per_date
+    and spreads_per_date if these are passed. Volatility predictions are
+    written to a json file unless save_predictions is off
     """
+    if hedged and vol_model is not None and sigma_forecasts is None:
+        if not isinstance(two_stage_output, dict):
+            raise ValueError(
+                "Streamed two-stage output needs precomputed sigma_forecasts"
+            )
+        sigma_forecasts = get_vol_model_forecasts(
+            two_stage_output, is_weighting_func_equal, vol_model
+        )
+
     portfolio_return_per_month = dict()
     prev_long_weights, prev_short_weights = None, None
     prev_long_quoted_spreads, prev_short_quoted_spreads = None, None
 
-    for date, _ in two_stage_output.items():
-        two_stage_date_dict = two_stage_output[date]
-
+    for date, two_stage_date_dict in iterate_two_stage_output(two_stage_output):
         long_weights, short_weights = get_final_weights_for_date(
             two_stage_date_dict,
             is_weighting_func_equal,
             hedged,
             sigma_model_rv,
             date,
+            sigma_forecasts,
         )
+        if weights_per_date is not None:
+            weights_per_date[date] = (long_weights, short_weights)
 
         year, month, _ = date.split("-")
         year, month = (
@@ -420,53 +593,149 @@ def compute_portfolio_returns(
         prev_short_quoted_spreads = get_prev_quoted_spreads(
             two_stage_date_dict["short_split"]
         )
+        if spreads_per_date is not None:
+            spreads_per_date[date] = (
+                prev_long_quoted_spreads,
+                prev_short_quoted_spreads,
+            )
+
+    if vol_model is not None:
+        predictions, prediction_name = vol_model_predictions[vol_model], vol_model
+    elif sigma_model_rv:
+        predictions, prediction_name = rv_predictions, "RV"
+    else:
+        predictions, prediction_name = garch_predictions, "GARCH"
+    if hedged and sigma_forecasts is not None:
+        predictions.update(sigma_forecasts.astype(float).to_dict())
 
-    with open(
-        f"vol_predictions_{"RV" if sigma_model_rv else "GARCH"}.json", "w"
-    ) as file:
-        json.dump(rv_predictions if sigma_model_rv else garch_predictions, file)
+    if save_predictions:
+        with open(f"vol_predictions_{prediction_name}.json", "w") as file:
+            json.dump(predictions, file)
     return portfolio_return_per_month
 
 
+def get_precomputed_sigma_forecasts(
+    split_args: tuple,
+    is_weighting_func_equal: bool,
+    hedged: bool,
+    sigma_model_rv: bool,
+    batch_garch: bool,
+    vol_model: str,
+) -> pd.Series:
+    """
+    Computes volatility forecasts of all dates in a separate pass over
+    the split file, if the chosen model allows for it
+    """
+    if not hedged:
+        return None
+    if vol_model is not None:
+        return get_vol_model_forecasts(
+            read_splits(*split_args), is_weighting_func_equal, vol_model
+        )
+    if batch_garch and not sigma_model_rv:
+        return get_batch_garch_forecasts(
+            read_splits(*split_args), is_weighting_func_equal
+        )
+
+    return None
+
+
+def get_model_name(hedged: bool, sigma_model_rv: bool, vol_model: str) -> str:
+    """
+    Returns name of the hedging model used in output file names
+    """
+    if not hedged:
+        return "standard"
+    if vol_model is not None:
+        return f"hedged_{vol_model}"
+
+    return MODEL_NAMES[(hedged, sigma_model_rv)]
+
+
+def compute_and_store_portfolio_returns(
+    is_weighting_func_equal: bool,
+    two_stage_output: Union[dict, Iterable],
+    cum_returns_per_month: dict,
+    hedged: bool,
+    sigma_model_rv: bool,
+    sigma_forecasts: pd.Series,
+    vol_model: str,
+    holdings_path: str,
+) -> dict:
+    """
+    Computes portfolio returns and stores the holdings and trades of
+    the run as sparse matrices
+    """
+    weights_per_date, spreads_per_date = dict(), dict()
+    portfolio_returns = compute_portfolio_returns(
+        is_weighting_func_equal,
+        two_stage_output,
+        cum_returns_per_month,
+        hedged,
+        sigma_model_rv,
+        sigma_forecasts,
+        vol_model,
+        weights_per_date=weights_per_date,
+        spreads_per_date=spreads_per_date,
+    )
+    save_holdings(
+        build_holdings(weights_per_date, spreads_per_date, cum_returns_per_month),
+        holdings_path,
+    )
+
+    return portfolio_returns
+
+
 def get_equal_and_value_portfolios_return_per_month(
     start_year: int = 2019,
     end_year: int = 2024,
     hedged: bool = False,
     sigma_model_rv: bool = True,
     cost_sensitivity: int = 0,
+    compact: bool = False,
+    batch_garch: bool = False,
+    vol_model: str = None,
+    cum_returns_per_month: dict = None,
+    conditioning: str = None,
 ) -> tuple[dict, dict]:
     """
-    Returns portfolio returns for equal and value weighted functions
+    Returns portfolio returns for equal and value weighted functions,
+    with batch_garch all GARCH forecasts are fitted in parallel up front,
+    vol_model selects a registered volatility model for hedging instead.
+    Monthly stock returns are computed from the period's data unless
+    given. Holdings and trades of each run are stored for later queries.
+    With conditioning, the conditional double sort legs of that variable
+    are held
     """
-    two_stage_output = dict()
-    with open(
-        f"final_split_{start_year}_{end_year}_lambda_{cost_sensitivity}.json"
-    ) as json_file:
-        two_stage_output = json.load(json_file)
-
-    cum_returns_per_month = find_returns_per_mo_stock(
-        extract_data(f"{start_year}-{end_year} v2.csv")
-    )
+    split_args = (start_year, end_year, cost_sensitivity, conditioning)
+    if cum_returns_per_month is None:
+        cum_returns_per_month = find_returns_per_mo_stock(
+            extract_data(f"{start_year}-{end_year} v2.csv", compact=compact)
+        )
 
-    return (
-        (
-            compute_portfolio_returns(
-                True, two_stage_output, cum_returns_per_month, sigma_model_rv
-            )
-            if not hedged
-            else compute_portfolio_returns(
-                True, two_stage_output, cum_returns_per_month, True, sigma_model_rv
-            )
-        ),
-        (
-            compute_portfolio_returns(
-                False, two_stage_output, cum_returns_per_month, sigma_model_rv
-            )
-            if not hedged
-            else compute_portfolio_returns(
-                False, two_stage_output, cum_returns_per_month, True, sigma_model_rv
-            )
-        ),
+    return tuple(
+        compute_and_store_portfolio_returns(
+            is_weighting_func_equal,
+            read_splits(*split_args),
+            cum_returns_per_month,
+            hedged,
+            sigma_model_rv,
+            get_precomputed_sigma_forecasts(
+                split_args,
+                is_weighting_func_equal,
+                hedged,
+                sigma_model_rv,
+                batch_garch,
+                vol_model,
+            ),
+            vol_model,
+            get_holdings_path(
+                get_model_name(hedged, sigma_model_rv, vol_model),
+                weighting,
+                *split_args,
+            ),
+        )
+        for is_weighting_func_equal, weighting in zip((True, False), WEIGHTINGS)
     )
 
 
@@ -0,0 +1,129 @@
+from typing import Callable, Iterator
+from utils import extract_data
+import pandas as pd
+import numpy as np
+import threading
+import queue
+import os
+
+
+MAX_PREFETCHED = 1
+MEMORY_BUDGET = 4 * 2**30
+
+
+def get_nbytes(inputs) -> int:
+    """
+    Estimates the memory held by loaded inputs
+    """
+    if isinstance(inputs, pd.DataFrame):
+        return int(inputs.memory_usage(deep=True).sum())
+    if isinstance(inputs, np.ndarray):
+        return inputs.nbytes
+    if isinstance(inputs, (tuple, list)):
+        return sum(get_nbytes(item) for item in inputs)
+
+    return 0
+
+
+def get_period_path(period: tuple) -> str:
+    """
+    Returns path of the data file of a (start year, end year) period
+    """
+    start_year, end_year = period
+
+    return f"{start_year}-{end_year} v2.csv"
+
+
+def load_period_data(period: tuple) -> pd.DataFrame:
+    """
+    Loads the data of a (start year, end year) period
+    """
+    return extract_data(get_period_path(period))
+
+
+def estimate_period_nbytes(period: tuple) -> int:
+    """
+    Estimates the memory of a period's loaded data by its file size, the
+    prepared frame keeps fewer columns than the file
+    """
+    return os.path.getsize(get_period_path(period))
+
+
+def prefetch(
+    jobs: list,
+    load_func: Callable,
+    max_prefetched: int = MAX_PREFETCHED,
+    memory_budget: int = MEMORY_BUDGET,
+    estimate_func: Callable = None,
+) -> Iterator[tuple]:
+    """
+    Yields (job, inputs) pairs while a background thread loads the inputs
+    of the next jobs. At most max_prefetched loaded inputs wait in the
+    queue. Memory of an input is reserved, by the estimate_func estimate,
+    before it is loaded and released once the consumer asks for the next
+    pair, so inputs being loaded, waiting and consumed all count. A load
+    only starts within memory_budget bytes, or when nothing is reserved
+    """
+    loaded = queue.Queue(maxsize=max_prefetched)
+    budget = threading.Condition()
+    stop = threading.Event()
+    reserved_bytes = [0]
+
+    def put(item: tuple) -> bool:
+        # Timeouts let the loader notice that the consumer stopped
+        while not stop.is_set():
+            try:
+                loaded.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def load_jobs() -> None:
+        for job in jobs:
+            estimate = estimate_func(job) if estimate_func is not None else 0
+            with budget:
+                budget.wait_for(
+                    lambda: stop.is_set()
+                    or reserved_bytes[0] == 0
+                    or reserved_bytes[0] + estimate <= memory_budget
+                )
+                reserved_bytes[0] += estimate
+            if stop.is_set():
+                return
+            try:
+                inputs = load_func(job)
+            except Exception as error:
+                put((job, None, error))
+                return
+
+            nbytes = get_nbytes(inputs)
+            # The reservation is corrected to the loaded size
+            with budget:
+                reserved_bytes[0] += nbytes - estimate
+            if not put((job, inputs, nbytes)):
+                return
+
+        put(None)
+
+    loader = threading.Thread(target=load_jobs, daemon=True)
+    loader.start()
+
+    try:
+        while (item := loaded.get()) is not None:
+            job, inputs, nbytes = item
+            if isinstance(nbytes, Exception):
+                raise nbytes
+
+            yield job, inputs
+            # The consumer is done with the inputs once it asks for more
+            del inputs
+            with budget:
+                reserved_bytes[0] -= nbytes
+                budget.notify_all()
+    finally:
+        stop.set()
+        with budget:
+            budget.notify_all()
+        loader.join()
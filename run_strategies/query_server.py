@@ -0,0 +1,580 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from utils import WEIGHTINGS, compact_data_cols, extract_data, is_compact
+from run_strategies import shared_data
+from run_strategies.shared_data import (
+    get_panel_arrays,
+    init_shared_worker,
+    shared_arrays,
+)
+from run_strategies.two_stage_momentum import (
+    gather_split_payload,
+    get_final_split_permnos,
+    get_stock_returns,
+    reset_random_day_rng,
+)
+from run_strategies.portfolio_return import (
+    compute_portfolio_returns,
+    reset_hedging_state,
+)
+from run_strategies.final_strat_stats import get_strategy_stats
+import pandas as pd
+import numpy as np
+import asyncio
+import socket
+import signal
+import json
+import math
+import sys
+import os
+
+
+SOCKET_PATH = "strategy_server.sock"
+QUERY_DEFAULTS = {
+    "cost_sensitivity": 0,
+    "keep_long": 0.5,
+    "keep_short": 0.5,
+    "weighting": "equal",
+    "hedged": False,
+    "start_year": None,
+    "end_year": None,
+}
+FORMATION_STATS_COLS = ["cumulative_return", "avg_quoted_spread", "avg_market_cap"]
+MAX_CACHED_RESULTS = 1_000
+MAX_CACHED_SPLIT_BYTES = 64 * 2**20
+MIN_CHUNK_DATES = 12
+
+# Selected permnos with their cost-adjusted returns of each worker per
+# (date, cost sensitivity, keep) setting, daily returns are not cached
+worker_splits = OrderedDict()
+worker_splits_nbytes = 0
+
+
+def sort_panel_by_date(data: pd.DataFrame) -> tuple[pd.DataFrame, np.ndarray]:
+    """
+    Returns the compact panel sorted by day, so that every formation
+    window is a contiguous slice, and the original position of each row
+    """
+    if not is_compact(data):
+        data = compact_data_cols(data)
+    row_order = np.argsort(data["DlyCalDt"].to_numpy(), kind="stable")
+
+    return data.iloc[row_order].reset_index(drop=True), row_order
+
+
+def get_window_days(date: pd.Timestamp) -> tuple[int, int]:
+    """
+    Returns the day numbers bounding the one-year formation window ending
+    at date, as get_date_range_mask selects it
+    """
+    return tuple(
+        int(np.datetime64(curr_date.date(), "D").astype("int32"))
+        for curr_date in (date - pd.DateOffset(years=1), date)
+    )
+
+
+def get_window_bounds(panel: pd.DataFrame, date: pd.Timestamp) -> tuple[int, int]:
+    """
+    Returns the rows of the one-year formation window ending at date of a
+    panel sorted by day
+    """
+    return tuple(
+        np.searchsorted(panel["DlyCalDt"].to_numpy(), get_window_days(date), "right")
+    )
+
+
+def get_stock_day_keys(permnos: np.ndarray, days: np.ndarray) -> np.ndarray:
+    """
+    Returns int64 keys ordered by permno and then by day
+    """
+    return (np.asarray(permnos, dtype=np.int64) << 32) | (
+        np.asarray(days, dtype=np.int64) + 2**31
+    )
+
+
+def get_stock_day_arrays(panel: pd.DataFrame) -> dict:
+    """
+    Returns daily returns ordered by permno and day with their sorted
+    keys, so that the daily returns of a stock over a window are one slice
+    """
+    keys = get_stock_day_keys(panel["PERMNO"].to_numpy(), panel["DlyCalDt"].to_numpy())
+    key_order = np.argsort(keys, kind="stable")
+
+    return {
+        "stock_day_keys": keys[key_order],
+        "stock_day_returns": panel["DlyRet"].to_numpy()[key_order],
+    }
+
+
+def get_sort_dates(panel: pd.DataFrame) -> pd.DatetimeIndex:
+    """
+    Returns month-ends with a full year of data before them, from December
+    of the first year of the panel
+    """
+    first_day, last_day = (
+        pd.Timestamp(np.datetime64(int(day), "D"))
+        for day in (panel["DlyCalDt"].iloc[0], panel["DlyCalDt"].iloc[-1])
+    )
+
+    return pd.date_range(
+        start=datetime(first_day.year, 12, 31), end=last_day, freq="ME"
+    )
+
+
+def get_month_cum_returns_arrays(panel: pd.DataFrame) -> dict:
+    """
+    Returns compound stock returns per month as sorted int64 keys of
+    month number and permno, with the returns alongside, computed on the
+    whole panel at once
+    """
+    months = (
+        panel["DlyCalDt"]
+        .to_numpy()
+        .astype("datetime64[D]")
+        .astype("datetime64[M]")
+        .astype(np.int64)
+        + 1970 * 12
+    )
+    keys = (months << 32) | panel["PERMNO"].to_numpy().astype(np.int64)
+    cum_returns = (1 + panel["DlyRet"]).groupby(keys).prod() - 1
+
+    return {
+        "cum_return_keys": cum_returns.index.to_numpy(dtype=np.int64),
+        "cum_returns": cum_returns.to_numpy(),
+    }
+
+
+def get_cum_returns_for_splits(arrays: dict, two_stage_output: dict) -> dict:
+    """
+    Builds the compound returns dict of find_returns_per_mo_stock for the
+    stocks held, or held the month before, in each holding month only
+    """
+    keys, prev_permnos = [], []
+    for date, two_stage_date_dict in two_stage_output.items():
+        permnos = [
+            *two_stage_date_dict["long_split"],
+            *two_stage_date_dict["short_split"],
+        ]
+        # Holdings of a month-end are held over the next month
+        month = pd.Timestamp(date).year * 12 + pd.Timestamp(date).month
+        keys.append((month << 32) | np.array([*permnos, *prev_permnos], np.int64))
+        prev_permnos = permnos
+
+    keys = np.unique(np.concatenate(keys)) if keys else np.empty(0, np.int64)
+    positions = np.minimum(
+        np.searchsorted(arrays["cum_return_keys"], keys),
+        len(arrays["cum_return_keys"]) - 1,
+    )
+    is_found = arrays["cum_return_keys"][positions] == keys
+
+    return {
+        (int(key >> 32) // 12, int(key >> 32) % 12 + 1, int(key & 0xFFFFFFFF)): {
+            "cumulative_return": float(cum_return)
+        }
+        for key, cum_return in zip(
+            keys[is_found], arrays["cum_returns"][positions[is_found]]
+        )
+    }
+
+
+def init_query_worker(spec: dict) -> None:
+    """
+    Attaches a worker to the published arrays
+    """
+    init_shared_worker(spec)
+    # Interrupts stop the server, which shuts the workers down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def get_formation_stats_for_date(stats_job: tuple) -> pd.DataFrame:
+    """
+    Computes formation statistics of one month-end on the shared panel,
+    spread days are sampled with the date's own seed
+    """
+    date, seed = stats_job
+    reset_random_day_rng(seed)
+    start, end = get_window_bounds(shared_data.worker_panel, date)
+    # Rows in their original order sample the same spread days as the sort
+    window_order = np.argsort(shared_data.worker_arrays["row_order"][start:end])
+
+    return get_stock_returns(
+        shared_data.worker_panel.iloc[start + window_order], with_daily_returns=False
+    )[FORMATION_STATS_COLS]
+
+
+def get_formation_stats_arrays(
+    stats_per_date: list, sort_dates: pd.DatetimeIndex
+) -> dict:
+    """
+    Stacks formation statistics of all month-ends into flat arrays with
+    offsets per date
+    """
+    return {
+        "sort_days": sort_dates.to_numpy().astype("datetime64[D]").astype(np.int64),
+        "stats_offsets": np.cumsum([0, *map(len, stats_per_date)]),
+        "stats_permnos": np.concatenate(
+            [stats.index.to_numpy(dtype=np.int64) for stats in stats_per_date]
+        ),
+        "stats_values": np.concatenate([stats.to_numpy() for stats in stats_per_date]),
+    }
+
+
+def get_formation_stats(date_num: int) -> pd.DataFrame:
+    """
+    Returns the formation statistics of a month-end from the shared arrays
+    """
+    arrays = shared_data.worker_arrays
+    start, end = arrays["stats_offsets"][date_num : date_num + 2]
+
+    return pd.DataFrame(
+        arrays["stats_values"][start:end],
+        index=pd.Index(arrays["stats_permnos"][start:end], name="PERMNO"),
+        columns=FORMATION_STATS_COLS,
+    )
+
+
+def get_split_permnos_for_date(
+    date_num: int, cost_sensitivity: float, keep_long: float, keep_short: float
+) -> tuple[pd.Series, pd.Series]:
+    """
+    Returns the cost-adjusted returns of the final legs of a month-end,
+    only the second stage is computed per setting
+    """
+    global worker_splits_nbytes
+    key = (date_num, cost_sensitivity, keep_long, keep_short)
+    if key in worker_splits:
+        worker_splits.move_to_end(key)
+        return worker_splits[key]
+
+    worker_splits[key] = get_final_split_permnos(
+        get_formation_stats(date_num), cost_sensitivity, keep_long, keep_short
+    )
+    worker_splits_nbytes += sum(split.memory_usage() for split in worker_splits[key])
+    while worker_splits_nbytes > MAX_CACHED_SPLIT_BYTES and len(worker_splits) > 1:
+        worker_splits_nbytes -= sum(
+            split.memory_usage() for split in worker_splits.popitem(last=False)[1]
+        )
+
+    return worker_splits[key]
+
+
+def get_daily_returns(permnos: pd.Index, date: pd.Timestamp) -> dict:
+    """
+    Returns the daily return lists of the given permnos over the
+    formation window ending at date, sliced from the shared panel
+    """
+    keys = shared_data.worker_arrays["stock_day_keys"]
+    starts, ends = (
+        np.searchsorted(
+            keys, get_stock_day_keys(permnos, np.full(len(permnos), day)), "right"
+        )
+        for day in get_window_days(date)
+    )
+    returns = shared_data.worker_arrays["stock_day_returns"]
+
+    return {
+        permno: returns[start:end].tolist()
+        for permno, start, end in zip(permnos, starts, ends)
+    }
+
+
+def get_splits_for_date(
+    date_num: int,
+    date: pd.Timestamp,
+    cost_sensitivity: float,
+    keep_long: float,
+    keep_short: float,
+) -> dict:
+    """
+    Returns the final splits of a month-end
+    """
+    long_split, short_split = get_split_permnos_for_date(
+        date_num, cost_sensitivity, keep_long, keep_short
+    )
+    stock_returns = get_formation_stats(date_num)
+    daily_returns = get_daily_returns(long_split.index.union(short_split.index), date)
+
+    return {
+        "long_split": gather_split_payload(long_split, stock_returns, daily_returns),
+        "short_split": gather_split_payload(short_split, stock_returns, daily_returns),
+    }
+
+
+def get_query_date_nums(query: dict, sort_dates: pd.DatetimeIndex) -> np.ndarray:
+    """
+    Returns positions of the month-ends sorted at for the holding months
+    of the query's years
+    """
+    return np.flatnonzero(
+        (sort_dates >= datetime(query["start_year"] - 1, 12, 31))
+        & (sort_dates < datetime(query["end_year"], 12, 31))
+    )
+
+
+def evaluate_dates(query: dict, date_nums: list, prev_date_num: int = None) -> dict:
+    """
+    Computes the monthly returns of a query over the holding months of
+    the given consecutive month-ends. The legs of the month-end before
+    them, if given, only enter the costs of the first rebalancing
+    """
+    sort_dates = pd.DatetimeIndex(
+        shared_data.worker_arrays["sort_days"].astype("datetime64[D]")
+    )
+    run_date_nums = date_nums if prev_date_num is None else [prev_date_num, *date_nums]
+
+    two_stage_output = {
+        str(sort_dates[date_num].date()): get_splits_for_date(
+            date_num,
+            sort_dates[date_num],
+            query["cost_sensitivity"],
+            query["keep_long"],
+            query["keep_short"],
+        )
+        for date_num in run_date_nums
+    }
+    reset_hedging_state()
+    returns_per_month = compute_portfolio_returns(
+        query["weighting"] == "equal",
+        two_stage_output,
+        get_cum_returns_for_splits(shared_data.worker_arrays, two_stage_output),
+        hedged=query["hedged"],
+        save_predictions=False,
+    )
+    if prev_date_num is not None:
+        del returns_per_month[next(iter(returns_per_month))]
+
+    return returns_per_month
+
+
+async def evaluate_query(
+    query: dict,
+    executor: ProcessPoolExecutor,
+    sort_dates: pd.DatetimeIndex,
+    num_workers: int,
+) -> dict:
+    """
+    Evaluates a strategy over the holding months of the query's years,
+    sorting at the month-ends before them. Runs of consecutive month-ends
+    are evaluated in parallel, each starting from the legs before it
+    """
+    date_nums = get_query_date_nums(query, sort_dates)
+    chunks = np.array_split(
+        date_nums, max(min(num_workers, len(date_nums) // MIN_CHUNK_DATES), 1)
+    )
+    loop = asyncio.get_running_loop()
+    returns_per_chunk = await asyncio.gather(
+        *(
+            loop.run_in_executor(
+                executor,
+                evaluate_dates,
+                query,
+                chunk.tolist(),
+                int(chunk[0]) - 1 if chunk_num > 0 else None,
+            )
+            for chunk_num, chunk in enumerate(chunks)
+        )
+    )
+    returns_per_month = {
+        year_month: values
+        for chunk_returns in returns_per_chunk
+        for year_month, values in chunk_returns.items()
+    }
+    strategy_results = pd.DataFrame.from_dict(returns_per_month, orient="index")
+
+    return {
+        "query": query,
+        "stats": get_strategy_stats(strategy_results),
+        "monthly": [
+            {"year": year, "month": month, **values}
+            for (year, month), values in returns_per_month.items()
+        ],
+    }
+
+
+def replace_non_finite(value):
+    """
+    Replaces non-finite floats of a json response by None
+    """
+    if isinstance(value, dict):
+        return {key: replace_non_finite(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [replace_non_finite(item) for item in value]
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+
+    return value
+
+
+def normalize_query(request: dict, sort_dates: pd.DatetimeIndex) -> dict:
+    """
+    Fills in defaults and checks a query, raises ValueError if invalid
+    """
+    unknown_keys = set(request) - set(QUERY_DEFAULTS)
+    if unknown_keys:
+        raise ValueError(f"unknown query keys {sorted(unknown_keys)}")
+
+    query = {**QUERY_DEFAULTS, **request}
+    first_year, last_year = sort_dates[0].year + 1, sort_dates[-1].year
+    query["start_year"] = int(query["start_year"] or first_year)
+    query["end_year"] = int(query["end_year"] or last_year)
+    query["cost_sensitivity"] = float(query["cost_sensitivity"])
+    query["keep_long"], query["keep_short"] = (
+        float(query["keep_long"]),
+        float(query["keep_short"]),
+    )
+    query["hedged"] = bool(query["hedged"])
+
+    if not all(
+        math.isfinite(query[key])
+        for key in ["cost_sensitivity", "keep_long", "keep_short"]
+    ):
+        raise ValueError("cost_sensitivity, keep_long and keep_short must be finite")
+
+    if query["weighting"] not in WEIGHTINGS:
+        raise ValueError(f"weighting must be one of {WEIGHTINGS}")
+    if not first_year <= query["start_year"] <= query["end_year"] <= last_year:
+        raise ValueError(f"years must lie within {first_year}-{last_year}")
+    if not (0 < query["keep_long"] <= 1 and 0 < query["keep_short"] <= 1):
+        raise ValueError("keep_long and keep_short must lie in (0, 1]")
+
+    return query
+
+
+async def answer_query(
+    line: bytes,
+    executor: ProcessPoolExecutor,
+    results: OrderedDict,
+    sort_dates: pd.DatetimeIndex,
+    num_workers: int,
+) -> dict:
+    """
+    Answers one json query, from the results cache if it was asked
+    before; identical queries in flight share one evaluation
+    """
+    try:
+        query = normalize_query(json.loads(line), sort_dates)
+    except (ValueError, TypeError, OverflowError) as error:
+        return {"error": str(error)}
+
+    key = json.dumps(query, sort_keys=True)
+    if key not in results:
+        results[key] = asyncio.ensure_future(
+            evaluate_query(query, executor, sort_dates, num_workers)
+        )
+        if len(results) > MAX_CACHED_RESULTS:
+            results.popitem(last=False)
+    results.move_to_end(key)
+
+    try:
+        return await asyncio.shield(results[key])
+    except Exception as error:
+        results.pop(key, None)
+        return {"error": repr(error)}
+
+
+async def serve_queries(
+    executor: ProcessPoolExecutor,
+    sort_dates: pd.DatetimeIndex,
+    num_workers: int,
+    socket_path: str = SOCKET_PATH,
+) -> None:
+    """
+    Serves json line queries on a Unix socket until cancelled, each
+    connection may send any number of queries. Non-finite numbers are
+    answered as null
+    """
+    results = OrderedDict()
+
+    async def handle_connection(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        while line := await reader.readline():
+            response = await answer_query(
+                line, executor, results, sort_dates, num_workers
+            )
+            writer.write(
+                (
+                    json.dumps(replace_non_finite(response), allow_nan=False) + "\n"
+                ).encode()
+            )
+            await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_unix_server(
+        handle_connection, path=socket_path, limit=2**20
+    )
+    print(f"serving queries on {socket_path}")
+    async with server:
+        await server.serve_forever()
+
+
+def run_query_server(
+    data_path: str = "2005-2024 v2.csv",
+    socket_path: str = SOCKET_PATH,
+    max_workers: int = None,
+) -> None:
+    """
+    Loads the panel once, computes the formation statistics of every
+    month-end in parallel and serves strategy queries from memory. The
+    panel, its daily returns ordered by stock, monthly stock returns and
+    statistics are shared with the workers, results are cached per query
+    """
+    panel, row_order = sort_panel_by_date(extract_data(data_path, compact=True))
+    sort_dates = get_sort_dates(panel)
+    panel_arrays = {
+        **get_panel_arrays(panel),
+        **get_month_cum_returns_arrays(panel),
+        **get_stock_day_arrays(panel),
+        "row_order": row_order,
+    }
+    del panel
+
+    num_workers = max_workers or os.cpu_count()
+
+    with shared_arrays(panel_arrays) as panel_spec:
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            initializer=init_query_worker,
+            initargs=(panel_spec,),
+        ) as executor:
+            # Each date has its own seed, as in find_splits_per_date_parallel
+            stats_per_date = list(
+                executor.map(
+                    get_formation_stats_for_date,
+                    [(date, 1 + date_num) for date_num, date in enumerate(sort_dates)],
+                )
+            )
+
+        with shared_arrays(
+            get_formation_stats_arrays(stats_per_date, sort_dates)
+        ) as stats_spec, ProcessPoolExecutor(
+            max_workers=num_workers,
+            initializer=init_query_worker,
+            initargs=({**panel_spec, **stats_spec},),
+        ) as executor:
+            del stats_per_date
+            try:
+                asyncio.run(
+                    serve_queries(executor, sort_dates, num_workers, socket_path)
+                )
+            except KeyboardInterrupt:
+                pass
+            finally:
+                if os.path.exists(socket_path):
+                    os.remove(socket_path)
+
+
+def query_server(query: dict, socket_path: str = SOCKET_PATH) -> dict:
+    """
+    Sends one query to a running server and returns its answer
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        connection.sendall((json.dumps(query) + "\n").encode())
+        with connection.makefile("rb") as response:
+            return json.loads(response.readline())
+
+
+if __name__ == "__main__":
+    run_query_server(*sys.argv[1:2])
@@ -0,0 +1,241 @@
+from utils import (
+    MODEL_NAMES,
+    WEIGHTINGS,
+    compact_data_cols,
+    extract_data,
+    get_holdings_path,
+    is_compact,
+)
+from run_strategies.holdings_store import load_holdings
+from scipy import sparse
+import pandas as pd
+import numpy as np
+
+
+# Rules after the first measure the spread on a fixed day of the month
+SPREAD_DAY_RULES = ["random", "last", "mean"]
+
+
+def get_trade_parts(holdings: dict) -> tuple[sparse.coo_matrix, sparse.coo_matrix]:
+    """
+    Splits the stored trades into the trades into each date's legs, priced
+    at the date's spreads, and the liquidations of stocks that left a leg,
+    priced at the previous date's spreads. A stock switching legs has
+    both in one stored trade
+    """
+    weights, trades = holdings["weights"], holdings["trades"]
+    shift = sparse.eye(weights.shape[0], k=-1, format="csr")
+    prev_weights = shift @ weights
+
+    is_held = (weights != 0).astype(np.int8)
+    # Same sign on consecutive dates means the stock stayed in its leg
+    is_kept = (weights.multiply(prev_weights) > 0).astype(np.int8)
+    is_entered = is_held - is_kept
+
+    leg_trades = trades.multiply(is_kept) + weights.multiply(is_entered)
+    liquidations = trades - leg_trades
+    liquidations.eliminate_zeros()
+
+    return sparse.coo_matrix(leg_trades), sparse.coo_matrix(liquidations)
+
+
+def get_costs_for_spreads(
+    trades: sparse.coo_matrix, spreads: np.ndarray, row_offset: int = 0
+) -> np.ndarray:
+    """
+    Returns (scenarios x dates) costs, half spread times absolute trade,
+    of sparse trades under (scenarios x dates x permnos) spreads read
+    row_offset dates earlier
+    """
+    spread_rows = trades.row - row_offset
+    trade_spreads = spreads[:, np.maximum(spread_rows, 0), trades.col]
+    entry_costs = np.abs(trades.data) * trade_spreads / 2
+    # Sums the entries of each date for all scenarios at once
+    row_sums = sparse.csr_matrix(
+        (np.ones(len(trades.row)), (trades.row, np.arange(len(trades.row)))),
+        shape=(trades.shape[0], len(trades.row)),
+    )
+
+    return (row_sums @ entry_costs.T).T
+
+
+def recost_with_spreads(holdings: dict, spreads: np.ndarray) -> np.ndarray:
+    """
+    Reprices the stored trades of a run under spread scenarios, given as
+    (scenarios x dates x permnos) average quoted spreads on the holdings
+    grid, and returns (scenarios x dates) trading costs
+    """
+    spreads = np.nan_to_num(
+        np.asarray(spreads, dtype=float).reshape(-1, *holdings["weights"].shape)
+    )
+    leg_trades, liquidations = get_trade_parts(holdings)
+
+    return get_costs_for_spreads(leg_trades, spreads) + get_costs_for_spreads(
+        liquidations, spreads, row_offset=1
+    )
+
+
+def recost_with_multipliers(holdings: dict, multipliers: list) -> np.ndarray:
+    """
+    Returns (multipliers x dates) trading costs with all spreads scaled,
+    costs are linear in the spreads so the stored costs are scaled
+    """
+    costs = np.asarray(holdings["trade_costs"].sum(axis=1)).ravel()
+
+    return np.asarray(multipliers, dtype=float)[:, None] * costs[None, :]
+
+
+def get_month_spreads(data: pd.DataFrame, day_rule: str, seed: int) -> pd.DataFrame:
+    """
+    Returns (months x permnos) quoted spreads measured on one day of each
+    month: a random day of the last 15, as in the sort, the last day, or
+    the average of the last 15 days
+    """
+    if not is_compact(data):
+        data = compact_data_cols(data)
+
+    data = data.sort_values(["PERMNO", "DlyCalDt"], kind="stable")
+    months = data["DlyCalDt"].to_numpy().astype("datetime64[D]").astype("datetime64[M]")
+    permnos, spreads = data["PERMNO"].to_numpy(), data["quoted_spread"].to_numpy()
+
+    is_group_end = np.ones(len(data), dtype=bool)
+    is_group_end[:-1] = (permnos[1:] != permnos[:-1]) | (months[1:] != months[:-1])
+    group_ends = np.flatnonzero(is_group_end) + 1
+    group_starts = np.concatenate([[0], group_ends[:-1]])
+    num_last_days = np.minimum(group_ends - group_starts, 15)
+
+    if day_rule == "random":
+        rng = np.random.default_rng(seed)
+        picked = (
+            group_ends - 1 - (rng.random(len(group_ends)) * num_last_days).astype(int)
+        )
+        month_spreads = spreads[picked]
+    elif day_rule == "last":
+        month_spreads = spreads[group_ends - 1]
+    else:
+        cum_spreads = np.concatenate([[0], np.cumsum(spreads)])
+        month_spreads = (
+            cum_spreads[group_ends] - cum_spreads[group_ends - num_last_days]
+        ) / num_last_days
+
+    return pd.Series(
+        month_spreads,
+        index=pd.MultiIndex.from_arrays(
+            [months[group_ends - 1], permnos[group_ends - 1]], names=["month", "PERMNO"]
+        ),
+    ).unstack("PERMNO")
+
+
+def get_formation_spreads(
+    data: pd.DataFrame, day_rule: str = "random", seed: int = 1
+) -> pd.DataFrame:
+    """
+    Returns (months x permnos) average quoted spreads of the one-year
+    formation windows, with the spread of each month measured by day_rule
+    """
+    return get_month_spreads(data, day_rule, seed).rolling(12, min_periods=1).mean()
+
+
+def get_scenario_spreads(formation_spreads: pd.DataFrame, holdings: dict) -> np.ndarray:
+    """
+    Returns (dates x permnos) formation window spreads on the holdings grid
+    """
+    rebalance_months = (
+        pd.DatetimeIndex(holdings["dates"]).to_numpy().astype("datetime64[M]")
+    )
+
+    return formation_spreads.reindex(
+        index=rebalance_months, columns=holdings["permnos"]
+    ).to_numpy()
+
+
+def get_recosted_returns(
+    holdings: dict,
+    strategy_results: pd.DataFrame,
+    multipliers: list = None,
+    scenario_spreads: dict = None,
+) -> pd.DataFrame:
+    """
+    Returns monthly net returns of a stored run under every spread
+    multiplier and spread scenario, the legs are not sorted again.
+    A multiplier m on the sort's spreads as well equals sorting with
+    cost sensitivity m * lambda, so such scenarios are existing runs
+    """
+    if multipliers is None:
+        multipliers = [1, 1.5, 2]
+    scenario_names = [f"spread_x{multiplier}" for multiplier in multipliers]
+    costs = [recost_with_multipliers(holdings, multipliers)]
+    if scenario_spreads:
+        scenario_names += list(scenario_spreads)
+        costs.append(
+            recost_with_spreads(holdings, np.stack(list(scenario_spreads.values())))
+        )
+
+    # Costs of a rebalancing date are paid in the month after it
+    gross_returns = strategy_results["total_return"].to_numpy()[
+        : len(holdings["dates"])
+    ]
+
+    return pd.DataFrame(
+        gross_returns[:, None] - np.concatenate(costs).T,
+        index=strategy_results.index[: len(holdings["dates"])],
+        columns=scenario_names,
+    )
+
+
+def run_recosting(
+    start_year: int = 2005,
+    end_year: int = 2024,
+    cost_sensitivity: int = 0,
+    multipliers: list = None,
+    seeds: list = None,
+) -> None:
+    """
+    Recosts all stored runs of a period and cost sensitivity under spread
+    multipliers, other sampled spread days and month-end or average
+    spreads. The spreads of each scenario are computed once for all runs
+    """
+    if multipliers is None:
+        multipliers = [1, 1.25, 1.5, 2]
+    if seeds is None:
+        seeds = [2, 3, 4]
+
+    data = extract_data(f"{start_year}-{end_year} v2.csv", compact=True)
+    formation_spreads = {
+        **{
+            f"random_day_seed_{seed}": get_formation_spreads(data, "random", seed)
+            for seed in seeds
+        },
+        **{
+            f"{day_rule}_day": get_formation_spreads(data, day_rule)
+            for day_rule in SPREAD_DAY_RULES[1:]
+        },
+    }
+    del data
+
+    for model_name in MODEL_NAMES.values():
+        for weighting in WEIGHTINGS:
+            holdings = load_holdings(
+                get_holdings_path(
+                    model_name, weighting, start_year, end_year, cost_sensitivity
+                )
+            )
+            scenario_spreads = {
+                name: get_scenario_spreads(spreads, holdings)
+                for name, spreads in formation_spreads.items()
+            }
+            strategy_results = pd.read_csv(
+                f"ret_cost_{model_name}_{weighting}_{start_year}_{end_year}"
+                + f"_lambda_{cost_sensitivity}.csv",
+                index_col=["year", "month"],
+            )
+            get_recosted_returns(
+                holdings, strategy_results, multipliers, scenario_spreads
+            ).to_csv(
+                f"recosted_{model_name}_{weighting}_{start_year}_{end_year}"
+                + f"_lambda_{cost_sensitivity}.csv"
+            )
+
+
+if __name__ == "__main__":
+    run_recosting()
@@ -0,0 +1,190 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from utils import (
+    COMPACT_FLOAT_COLS,
+    compact_data_cols,
+    is_compact,
+    get_date_range_mask,
+)
+from run_strategies.two_stage_momentum import get_final_splits, reset_random_day_rng
+from typing import Iterator
+import pandas as pd
+import numpy as np
+import sys
+
+
+PANEL_INT_COLS = ["PERMNO", "DlyCalDt"]
+
+# Segments stay referenced for the life of the process, their buffers
+# back the attached arrays
+attached_segments = []
+worker_arrays = dict()
+worker_panel = None
+
+
+def publish_arrays(arrays: dict) -> tuple[dict, list]:
+    """
+    Copies arrays once into new shared memory segments, returns the spec
+    workers attach with and the segments
+    """
+    spec, segments = dict(), []
+
+    for name, array in arrays.items():
+        segment = SharedMemory(create=True, size=max(array.nbytes, 1))
+        segments.append(segment)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[...] = array
+        spec[name] = (segment.name, array.dtype.str, array.shape)
+
+    return spec, segments
+
+
+def release_segments(segments: list) -> None:
+    """
+    Closes and removes published segments
+    """
+    for segment in segments:
+        segment.close()
+        try:
+            segment.unlink()
+        except FileNotFoundError:
+            pass
+
+
+@contextmanager
+def shared_arrays(arrays: dict) -> Iterator[dict]:
+    """
+    Publishes arrays for the duration of the block and removes them after
+    it, also when it raises; segments left by a killed process are removed
+    by the multiprocessing resource tracker once all processes exit
+    """
+    spec, segments = publish_arrays(arrays)
+    try:
+        yield spec
+    finally:
+        release_segments(segments)
+
+
+def attach_segment(segment_name: str) -> SharedMemory:
+    """
+    Attaches to a published segment without registering it with the
+    resource tracker, so that an exiting worker never removes or reports
+    a segment the publishing process owns
+    """
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name=segment_name, track=False)
+
+    # Before 3.13 attaching registers the segment as creating it does
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return SharedMemory(name=segment_name)
+    finally:
+        resource_tracker.register = register
+
+
+def attach_arrays(spec: dict) -> dict:
+    """
+    Attaches to published arrays by name, without copying them
+    """
+    arrays = dict()
+
+    for name, (segment_name, dtype, shape) in spec.items():
+        segment = attach_segment(segment_name)
+        attached_segments.append(segment)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+        arrays[name].flags.writeable = False
+
+    return arrays
+
+
+def get_panel_arrays(data: pd.DataFrame) -> dict:
+    """
+    Returns the arrays of the panel in the compact layout, one array per
+    dtype with a row per column
+    """
+    if not is_compact(data):
+        data = compact_data_cols(data)
+
+    return {
+        "int_cols": np.ascontiguousarray(data[PANEL_INT_COLS].to_numpy().T),
+        "float_cols": np.ascontiguousarray(data[COMPACT_FLOAT_COLS].to_numpy().T),
+    }
+
+
+def get_panel_from_arrays(arrays: dict) -> pd.DataFrame:
+    """
+    Builds the compact panel as a view on attached arrays, every column
+    is a row of the shared arrays and is not copied
+    """
+    return pd.DataFrame(
+        {
+            **dict(zip(PANEL_INT_COLS, arrays["int_cols"])),
+            **dict(zip(COMPACT_FLOAT_COLS, arrays["float_cols"])),
+        },
+        copy=False,
+    )
+
+
+def init_shared_worker(spec: dict) -> None:
+    """
+    Attaches a worker to the published arrays once, at startup
+    """
+    global worker_arrays, worker_panel
+
+    worker_arrays = attach_arrays(spec)
+    if "float_cols" in worker_arrays:
+        worker_panel = get_panel_from_arrays(worker_arrays)
+
+
+def sort_date_from_shared_panel(sort_job: tuple) -> tuple[str, dict]:
+    """
+    Runs the two-stage sort of one date on the shared panel
+    """
+    date, cost_sensitivity, seed = sort_job
+    reset_random_day_rng(seed)
+    long_split, short_split = get_final_splits(
+        worker_panel[
+            get_date_range_mask(worker_panel, date - pd.DateOffset(years=1), date)
+        ],
+        cost_sensitivity=cost_sensitivity,
+    )
+
+    return str(date.to_pydatetime().date()), {
+        "long_split": long_split,
+        "short_split": short_split,
+    }
+
+
+def find_splits_per_date_parallel(
+    data: pd.DataFrame,
+    start_year: int,
+    end_year: int,
+    cost_sensitivity: int,
+    max_workers: int = None,
+    seed: int = 1,
+) -> dict:
+    """
+    Finds the two-stage sorting legs of all dates in parallel, workers
+    read the panel from shared memory. Spread days are sampled with a
+    seed per date, so results do not depend on the number of workers
+    but differ from the serial run's single random stream
+    """
+    dates = pd.date_range(
+        start=datetime(start_year, 12, 31), end=datetime(end_year, 12, 31), freq="ME"
+    )
+
+    with shared_arrays(get_panel_arrays(data)) as spec, ProcessPoolExecutor(
+        max_workers=max_workers, initializer=init_shared_worker, initargs=(spec,)
+    ) as executor:
+        return dict(
+            executor.map(
+                sort_date_from_shared_panel,
+                [
+                    (date, cost_sensitivity, seed + date_num)
+                    for date_num, date in enumerate(dates)
+                ],
+            )
+        )
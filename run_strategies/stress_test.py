@@ -0,0 +1,274 @@
+from concurrent.futures import ProcessPoolExecutor
+from pandas.tseries.holiday import USFederalHolidayCalendar
+from pandas.tseries.offsets import CustomBusinessDay
+from scipy.signal import lfilter
+from utils import MODEL_NAMES, WEIGHTINGS, prepare_data
+from run_strategies.two_stage_momentum import find_splits_per_date, reset_random_day_rng
+from run_strategies.portfolio_return import (
+    find_returns_per_mo_stock,
+    compute_portfolio_returns,
+    reset_hedging_state,
+)
+from run_strategies.final_strat_stats import get_strategy_stats
+import pandas as pd
+import numpy as np
+import tempfile
+import sys
+import os
+
+
+MARKET_PARAMS = {
+    "num_stocks": 200,
+    "start_year": 2000,
+    "end_year": 2004,
+    "market_drift": 0.0003,
+    "market_vol": 0.01,
+    "idiosyncratic_vol": 0.02,
+    # Stock drifts follow a monthly AR(1), persistence drives momentum
+    "momentum_persistence": 0.9,
+    "momentum_vol": 0.0005,
+    # In a crash month past winners lose crash_reversal times their drift
+    "crash_probability": 0.0,
+    "crash_reversal": 2.0,
+    # Daily log spreads follow an AR(1) around a size-dependent mean
+    "spread_mean": 0.01,
+    "spread_size_elasticity": 0.3,
+    "spread_persistence": 0.98,
+    "spread_vol": 0.05,
+    "spread_multiplier": 1.0,
+    "log_cap_mean": 20,
+    "log_cap_vol": 1.5,
+}
+STRESS_SCENARIOS = {
+    "baseline": {},
+    "high_spreads": {"spread_multiplier": 3.0},
+    "momentum_crashes": {"crash_probability": 0.05},
+    "thin_universe": {"num_stocks": 50},
+}
+CRSP_FLAGS = {
+    "ShareType": "NS",
+    "SecurityType": "EQTY",
+    "SecuritySubType": "COM",
+    "USIncFlg": "Y",
+    "IssuerType": "CORP",
+    "PrimaryExch": "N",
+    "ConditionalType": "RW",
+    "TradingStatusFlg": "A",
+}
+
+
+def get_trading_days(start_year: int, end_year: int) -> pd.DatetimeIndex:
+    """
+    Returns weekdays of the period excluding US federal holidays
+    """
+    return pd.date_range(
+        f"{start_year}-01-01",
+        f"{end_year}-12-31",
+        freq=CustomBusinessDay(calendar=USFederalHolidayCalendar()),
+    )
+
+
+def simulate_daily_returns(
+    params: dict, days: pd.DatetimeIndex, rng: np.random.Generator
+) -> np.ndarray:
+    """
+    Simulates daily stock returns as market plus persistent stock drift
+    plus idiosyncratic noise, with drifts reversed in crash months
+    """
+    num_days, num_stocks = len(days), params["num_stocks"]
+    month_of_day = np.unique(days.to_period("M"), return_inverse=True)[1]
+    num_months = month_of_day.max() + 1
+
+    drifts = lfilter(
+        [1],
+        [1, -params["momentum_persistence"]],
+        rng.normal(0, params["momentum_vol"], (num_months, num_stocks)),
+        axis=0,
+    )
+    is_crash = rng.random(num_months) < params["crash_probability"]
+    is_crash[0] = False
+    drifts[1:][is_crash[1:]] = -params["crash_reversal"] * drifts[:-1][is_crash[1:]]
+
+    returns = (
+        rng.normal(params["market_drift"], params["market_vol"], (num_days, 1))
+        + drifts[month_of_day]
+        + rng.normal(0, params["idiosyncratic_vol"], (num_days, num_stocks))
+    )
+
+    return np.maximum(returns, -0.99)
+
+
+def simulate_quoted_spreads(
+    params: dict, log_caps: np.ndarray, num_days: int, rng: np.random.Generator
+) -> np.ndarray:
+    """
+    Simulates daily relative quoted spreads, wider for smaller stocks
+    """
+    size_scores = (log_caps - log_caps.mean()) / max(log_caps.std(), 1e-12)
+    log_spread_means = (
+        np.log(params["spread_mean"]) - params["spread_size_elasticity"] * size_scores
+    )
+    log_spreads = log_spread_means + lfilter(
+        [1],
+        [1, -params["spread_persistence"]],
+        rng.normal(0, params["spread_vol"], (num_days, len(log_caps))),
+        axis=0,
+    )
+
+    return params["spread_multiplier"] * np.exp(log_spreads)
+
+
+def generate_synthetic_panel(params: dict, seed: int) -> pd.DataFrame:
+    """
+    Generates a daily stock panel in the raw CRSP schema
+    """
+    rng = np.random.default_rng(seed)
+    days = get_trading_days(params["start_year"], params["end_year"])
+    num_days, num_stocks = len(days), params["num_stocks"]
+
+    returns = simulate_daily_returns(params, days, rng)
+    log_caps = rng.normal(params["log_cap_mean"], params["log_cap_vol"], num_stocks)
+    spreads = simulate_quoted_spreads(params, log_caps, num_days, rng)
+    prices = 20 * np.cumprod(1 + returns, axis=0)
+
+    panel = pd.DataFrame(
+        {
+            "PERMNO": np.tile(np.arange(10001, 10001 + num_stocks), num_days),
+            "DlyCalDt": np.repeat(days.strftime("%Y-%m-%d"), num_stocks),
+            "DlyRet": returns.ravel(),
+            "DlyPrc": prices.ravel(),
+            "DlyBid": (prices * (1 - spreads / 2)).ravel(),
+            "DlyAsk": (prices * (1 + spreads / 2)).ravel(),
+            "DlyCap": (prices * np.exp(log_caps) / 20).ravel(),
+        }
+    )
+    for col, val in CRSP_FLAGS.items():
+        panel[col] = val
+
+    return panel
+
+
+def run_stress_path(path_job: tuple) -> list:
+    """
+    Runs the full strategy on one synthetic path and returns the
+    statistics of each cost sensitivity, hedging and weighting
+    """
+    scenario, path_num, params, seed, cost_sensitivities = path_job
+    data = prepare_data(generate_synthetic_panel(params, seed))
+    cum_returns_per_month = find_returns_per_mo_stock(data)
+    path_results = []
+
+    for cost_sensitivity in cost_sensitivities:
+        reset_random_day_rng(seed)
+        two_stage_output = find_splits_per_date(
+            data, params["start_year"], params["end_year"], cost_sensitivity
+        )
+
+        for (hedged, sigma_model_rv), strategy in MODEL_NAMES.items():
+            for weighting in WEIGHTINGS:
+                reset_hedging_state()
+                strategy_results = pd.DataFrame.from_dict(
+                    compute_portfolio_returns(
+                        weighting == "equal",
+                        two_stage_output,
+                        cum_returns_per_month,
+                        hedged,
+                        sigma_model_rv,
+                    ),
+                    orient="index",
+                )
+                path_results.append(
+                    {
+                        "scenario": scenario,
+                        "path": path_num,
+                        "seed": seed,
+                        "lambda": cost_sensitivity,
+                        "strategy": strategy,
+                        "weighting": weighting,
+                        # The month after the last sort falls outside the panel
+                        **get_strategy_stats(
+                            strategy_results[
+                                strategy_results.index.get_level_values(0)
+                                <= params["end_year"]
+                            ]
+                        ),
+                    }
+                )
+
+    return path_results
+
+
+def init_stress_worker(work_dir: str) -> None:
+    """
+    Moves a worker to its own directory, so that files written by the
+    pipeline do not clash, and silences its progress output
+    """
+    worker_dir = os.path.join(work_dir, str(os.getpid()))
+    os.makedirs(worker_dir, exist_ok=True)
+    os.chdir(worker_dir)
+    sys.stdout = open(os.devnull, "w")
+
+
+def get_stress_path_jobs(
+    scenarios: tuple, num_paths: int, cost_sensitivities: tuple, seed: int
+) -> list:
+    """
+    Gets one job per scenario and path, path seeds are shared across
+    scenarios so that scenarios are compared on the same random draws
+    """
+    path_seeds = np.random.SeedSequence(seed).generate_state(num_paths)
+
+    return [
+        (
+            scenario,
+            path_num,
+            {**MARKET_PARAMS, **STRESS_SCENARIOS[scenario]},
+            int(path_seed),
+            cost_sensitivities,
+        )
+        for scenario in scenarios
+        for path_num, path_seed in enumerate(path_seeds)
+    ]
+
+
+def summarize_stress_results(stress_results: pd.DataFrame) -> pd.DataFrame:
+    """
+    Summarizes the distribution of path statistics per scenario and strategy
+    """
+    return stress_results.groupby(["scenario", "lambda", "strategy", "weighting"])[
+        ["monthly_net_return", "annualized_net_sharpe", "monthly_cost"]
+    ].quantile([0.05, 0.5, 0.95])
+
+
+def run_stress_test(
+    scenarios: tuple = tuple(STRESS_SCENARIOS),
+    num_paths: int = 100,
+    cost_sensitivities: tuple = (0, 1, 6, 12),
+    seed: int = 0,
+    max_workers: int = None,
+    results_path: str = "stress_test_results.csv",
+) -> pd.DataFrame:
+    """
+    Runs the full strategy on many synthetic paths of each scenario in
+    parallel and collects the per-path statistics into one table
+    """
+    path_jobs = get_stress_path_jobs(scenarios, num_paths, cost_sensitivities, seed)
+    stress_results = []
+
+    with tempfile.TemporaryDirectory() as work_dir, ProcessPoolExecutor(
+        max_workers=max_workers, initializer=init_stress_worker, initargs=(work_dir,)
+    ) as executor:
+        for (scenario, path_num, *_), path_results in zip(
+            path_jobs, executor.map(run_stress_path, path_jobs)
+        ):
+            print(f"finished {scenario} path {path_num}")
+            stress_results += path_results
+
+    stress_results = pd.DataFrame(stress_results)
+    stress_results.to_csv(results_path, index=False)
+
+    return stress_results
+
+
+if __name__ == "__main__":
+    print(summarize_stress_results(run_stress_test()))
@@ -1,7 +1,18 @@
 from datetime import datetime
-from utils import extract_data, compute_compound_return
+from utils import (
+    extract_data,
+    compute_compound_return,
+    get_year_month,
+    get_date_range_mask,
+    get_split_path,
+    write_splits,
+)
+from run_strategies.universe_index import (
+    iterate_window_data,
+    load_eligibility_index,
+)
+from typing import Iterable, Iterator, Union
 import pandas as pd
-import json
 import numpy as np
 import itertools
 
@@ -9,6 +20,16 @@ import itertools
 rng = np.random.default_rng(1)
 
 
+def reset_random_day_rng(seed: Union[int, tuple] = 1) -> None:
+    """
+    Resets the generator picking the quoted spread days, so that
+    repeated runs sample the same days. The seed is an int or a tuple of
+    non-negative ints
+    """
+    global rng
+    rng = np.random.default_rng(seed)
+
+
 def pick_random_day(group: pd.Series) -> float:
     """
     Picks random day from 15th until the end of the month
@@ -23,81 +44,199 @@ def get_year_daily_returns(returns: pd.Series) -> list:
     return list(itertools.chain(*returns))
 
 
-def get_stock_returns(stock_data: pd.DataFrame) -> dict:
+def get_stock_month_returns(
+    stock_data: pd.DataFrame, with_daily_returns: bool = True
+) -> pd.DataFrame:
+    """
+    Gets cumulative return, sampled quoted spread, average market cap and,
+    unless left out, daily returns for each permno and month
+    """
+    aggregations = {
+        "cumulative_return": ("DlyRet", compute_compound_return),
+        "day_quoted_spread": ("quoted_spread", lambda group: pick_random_day(group)),
+        "daily_returns": ("DlyRet", lambda ret: ret.tolist()),
+        "avg_market_cap": ("DlyCap", "mean"),
+    }
+    if not with_daily_returns:
+        del aggregations["daily_returns"]
+
+    return stock_data.groupby(["PERMNO", get_year_month(stock_data)[1]], sort=False)[
+        ["DlyRet", "quoted_spread", "DlyCap"]
+    ].agg(**aggregations)
+
+
+def combine_stock_month_returns(stock_month_returns: pd.DataFrame) -> pd.DataFrame:
     """
-    Gets cumulative stock returns for each permno together with a list
-    of daily returns
+    Combines monthly stock returns of a formation window per permno
     """
+    aggregations = {
+        "cumulative_return": ("cumulative_return", compute_compound_return),
+        "avg_quoted_spread": ("day_quoted_spread", "mean"),
+        "daily_returns": ("daily_returns", get_year_daily_returns),
+        "avg_market_cap": ("avg_market_cap", "mean"),
+    }
+    if "daily_returns" not in stock_month_returns.columns:
+        del aggregations["daily_returns"]
+
+    return stock_month_returns.groupby(["PERMNO"], sort=False).agg(**aggregations)
+
+
+def get_stock_returns(
+    stock_data: pd.DataFrame, with_daily_returns: bool = True
+) -> pd.DataFrame:
+    """
+    Gets cumulative stock returns for each permno together with, unless
+    left out, a list of daily returns
+    """
+    return combine_stock_month_returns(
+        get_stock_month_returns(stock_data, with_daily_returns)
+    )
+
+
+def get_daily_returns_for_permnos(
+    stock_data: pd.DataFrame, permnos: pd.Index
+) -> pd.Series:
+    """
+    Gathers the daily return lists of the given permnos only, in the
+    layout of get_stock_returns
+    """
+    selected_data = stock_data[stock_data["PERMNO"].isin(permnos)]
+
     return (
-        stock_data.groupby(["PERMNO", "month"], sort=False)[
-            ["DlyRet", "quoted_spread", "DlyCap"]
+        selected_data.groupby(["PERMNO", get_year_month(selected_data)[1]], sort=False)[
+            "DlyRet"
         ]
-        .agg(
-            cumulative_return=("DlyRet", compute_compound_return),
-            day_quoted_spread=(
-                "quoted_spread",
-                lambda group: pick_random_day(group),
-            ),
-            daily_returns=("DlyRet", lambda ret: ret.tolist()),
-            avg_market_cap=("DlyCap", "mean"),
-        )
-        .groupby(["PERMNO"], sort=False)
-        .agg(
-            cumulative_return=("cumulative_return", compute_compound_return),
-            avg_quoted_spread=("day_quoted_spread", "mean"),
-            daily_returns=("daily_returns", get_year_daily_returns),
-            avg_market_cap=("avg_market_cap", "mean"),
-        )
+        .agg(lambda ret: ret.tolist())
+        .groupby("PERMNO", sort=False)
+        .agg(get_year_daily_returns)
     )
 
 
+def select_extreme_positions(
+    scores: np.ndarray, num_selected: int, largest: bool
+) -> np.ndarray:
+    """
+    Returns positions of the num_selected largest or smallest scores with a
+    partial selection instead of a full sort, ordered and tie-broken like
+    nlargest and nsmallest
+    """
+    keys = -scores if largest else scores
+    num_selected = min(num_selected, np.count_nonzero(~np.isnan(keys)))
+    if num_selected <= 0:
+        return np.empty(0, dtype=np.intp)
+
+    # Ties on the cut-off score go to the earliest positions
+    threshold = np.partition(keys, num_selected - 1)[num_selected - 1]
+    below = np.flatnonzero(keys < threshold)
+    ties = np.flatnonzero(keys == threshold)[: num_selected - len(below)]
+    positions = np.concatenate([below, ties])
+
+    return positions[np.lexsort((positions, keys[positions]))]
+
+
 def find_momentum_split(
-    stock_data: pd.DataFrame,
+    stock_returns: pd.DataFrame,
     long_split_proportion: float = 0.2,
     short_split_proportion: float = 0.2,
-) -> tuple[pd.DataFrame, pd.DataFrame]:
+) -> tuple[pd.Index, pd.Index]:
     """
-    Finds standard momentum strategy long and short legs
+    Finds permnos of the standard momentum strategy long and short legs,
+    ranking on cumulative returns only
     """
-    stock_returns = get_stock_returns(stock_data)
+    cumulative_returns = stock_returns["cumulative_return"].to_numpy()
 
     return (
-        stock_returns.nlargest(
-            int(len(stock_returns) * long_split_proportion), "cumulative_return"
-        ),
-        stock_returns.nsmallest(
-            int(len(stock_returns) * short_split_proportion), "cumulative_return"
-        ),
+        stock_returns.index[
+            select_extreme_positions(
+                cumulative_returns,
+                int(len(stock_returns) * long_split_proportion),
+                largest=True,
+            )
+        ],
+        stock_returns.index[
+            select_extreme_positions(
+                cumulative_returns,
+                int(len(stock_returns) * short_split_proportion),
+                largest=False,
+            )
+        ],
     )
 
 
 def adjust_momentum_with_costs(
-    long_split: pd.DataFrame, short_split: pd.DataFrame, cost_sensitivity: float
-) -> tuple[pd.DataFrame, pd.DataFrame]:
+    stock_returns: pd.DataFrame,
+    long_permnos: pd.Index,
+    short_permnos: pd.Index,
+    cost_sensitivity: float,
+) -> tuple[pd.Series, pd.Series]:
     """
     Calculates cost-adjusted returns for each split
     """
-    new_long_split = pd.DataFrame(
-        {
-            "cost_adjusted_return": long_split["cumulative_return"]
-            - cost_sensitivity * long_split["avg_quoted_spread"]
-        }
+    cumulative_returns = stock_returns["cumulative_return"]
+    avg_quoted_spreads = stock_returns["avg_quoted_spread"]
+
+    return (
+        cumulative_returns[long_permnos]
+        - cost_sensitivity * avg_quoted_spreads[long_permnos],
+        cumulative_returns[short_permnos]
+        + cost_sensitivity * avg_quoted_spreads[short_permnos],
     )
-    new_long_split["daily_returns"] = long_split["daily_returns"]
-    new_long_split["avg_market_cap"] = long_split["avg_market_cap"]
-    new_long_split["avg_quoted_spread"] = long_split["avg_quoted_spread"]
-
-    new_short_split = pd.DataFrame(
-        {
-            "cost_adjusted_return": short_split["cumulative_return"]
-            + cost_sensitivity * short_split["avg_quoted_spread"]
-        }
+
+
+def get_final_split_permnos(
+    stock_returns: pd.DataFrame,
+    cost_sensitivity: int,
+    keep_long: float = 0.5,
+    keep_short: float = 0.5,
+) -> tuple[pd.Series, pd.Series]:
+    """
+    Selects final long and short legs on the numeric scores only and
+    returns their cost-adjusted returns indexed by permno
+    """
+    long_split, short_split = adjust_momentum_with_costs(
+        stock_returns, *find_momentum_split(stock_returns), cost_sensitivity
     )
-    new_short_split["daily_returns"] = short_split["daily_returns"]
-    new_short_split["avg_market_cap"] = short_split["avg_market_cap"]
-    new_short_split["avg_quoted_spread"] = short_split["avg_quoted_spread"]
 
-    return new_long_split, new_short_split
+    return (
+        long_split.iloc[
+            select_extreme_positions(
+                long_split.to_numpy(), int(len(long_split) * keep_long), largest=True
+            )
+        ],
+        short_split.iloc[
+            select_extreme_positions(
+                short_split.to_numpy(),
+                int(len(short_split) * keep_short),
+                largest=False,
+            )
+        ],
+    )
+
+
+def gather_split_payload(
+    split: pd.Series, stock_returns: pd.DataFrame, daily_returns: pd.Series
+) -> dict:
+    """
+    Builds the per-stock records of a selected leg
+    """
+    split_stats = stock_returns.loc[
+        split.index, ["avg_market_cap", "avg_quoted_spread"]
+    ]
+
+    return {
+        permno: {
+            "cost_adjusted_return": float(cost_adjusted_return),
+            "daily_returns": daily_returns[permno],
+            "avg_market_cap": float(avg_market_cap),
+            "avg_quoted_spread": float(avg_quoted_spread),
+        }
+        for permno, cost_adjusted_return, avg_market_cap, avg_quoted_spread in zip(
+            split.index,
+            split.to_numpy(),
+            split_stats["avg_market_cap"].to_numpy(),
+            split_stats["avg_quoted_spread"].to_numpy(),
+        )
+    }
 
 
 def get_final_splits(
@@ -105,94 +244,181 @@ def get_final_splits(
     cost_sensitivity: int,
     keep_long: float = 0.5,
     keep_short: float = 0.5,
+    stock_returns: pd.DataFrame = None,
 ) -> tuple[dict, dict]:
     """
-    Gets final long and short legs based on trading costs
-    and input parameters
+    Gets final long and short legs based on trading costs and input
+    parameters, stock returns are computed from data unless they are
+    given. Daily returns are only gathered for the selected stocks
     """
-    new_long_split, new_short_split = adjust_momentum_with_costs(
-        *find_momentum_split(data), cost_sensitivity
+    if stock_returns is None:
+        stock_returns = get_stock_returns(data, with_daily_returns=False)
+
+    long_split, short_split = get_final_split_permnos(
+        stock_returns, cost_sensitivity, keep_long, keep_short
     )
+    if "daily_returns" in stock_returns.columns:
+        daily_returns = stock_returns["daily_returns"]
+    else:
+        daily_returns = get_daily_returns_for_permnos(
+            data, long_split.index.union(short_split.index)
+        )
 
     return (
-        dict(
-            new_long_split.nlargest(
-                int(len(new_long_split) * keep_long), "cost_adjusted_return"
-            )[
-                [
-                    "cost_adjusted_return",
-                    "daily_returns",
-                    "avg_market_cap",
-                    "avg_quoted_spread",
-                ]
-            ].to_dict(
-                orient="index"
-            )
-        ),
-        dict(
-            new_short_split.nsmallest(
-                int(len(new_short_split) * keep_short), "cost_adjusted_return"
-            )[
-                [
-                    "cost_adjusted_return",
-                    "daily_returns",
-                    "avg_market_cap",
-                    "avg_quoted_spread",
-                ]
-            ].to_dict(
-                orient="index"
-            )
-        ),
+        gather_split_payload(long_split, stock_returns, daily_returns),
+        gather_split_payload(short_split, stock_returns, daily_returns),
     )
 
 
-def find_splits_per_date(
-    data: pd.DataFrame, start_year: int, end_year: int, cost_sensitivity: int
-) -> dict:
+def iterate_formation_windows(
+    data: pd.DataFrame, dates: Iterable[pd.Timestamp], eligibility_index: dict = None
+) -> Iterator[tuple[pd.Timestamp, pd.DataFrame, np.ndarray]]:
     """
-    Finds the two-stage sorting long and short legs
+    Yields per month-end date the observations of its one year formation
+    window, taken from the monthly blocks of the eligibility index if it
+    is given, with the permnos eligible in it, otherwise None
     """
-    splits = dict()
+    if eligibility_index is not None:
+        yield from iterate_window_data(data, eligibility_index, dates)
+        return
+
+    for date in dates:
+        yield (
+            date,
+            data[get_date_range_mask(data, date - pd.DateOffset(years=1), date)],
+            None,
+        )
 
-    for date in pd.date_range(
+
+def iterate_splits_per_date(
+    data: pd.DataFrame,
+    start_year: int,
+    end_year: int,
+    cost_sensitivity: int,
+    eligibility_index: dict = None,
+) -> Iterator[tuple[str, dict]]:
+    """
+    Yields the two-stage sorting long and short legs date by date. With
+    the eligibility index of the data, formation windows are taken from
+    its monthly blocks
+    """
+    dates = pd.date_range(
         start=datetime(start_year, 12, 31), end=datetime(end_year, 12, 31), freq="ME"
+    )
+    for date, window_data, window_permnos in iterate_formation_windows(
+        data, dates, eligibility_index
     ):
-        print(date)
+        if window_permnos is None:
+            print(date)
+        else:
+            print(date, f"{len(window_permnos)} eligible stocks")
         long_split, short_split = get_final_splits(
-            data[
-                (data["DlyCalDt"] <= date)
-                & (data["DlyCalDt"] > date - pd.DateOffset(years=1))
-            ],
-            cost_sensitivity=cost_sensitivity,
+            window_data, cost_sensitivity=cost_sensitivity
         )
 
-        splits[str(date.to_pydatetime().date())] = {
+        yield str(date.to_pydatetime().date()), {
             "long_split": long_split,
             "short_split": short_split,
         }
 
-    return splits
+
+def find_splits_per_date(
+    data: pd.DataFrame,
+    start_year: int,
+    end_year: int,
+    cost_sensitivity: int,
+    eligibility_index: dict = None,
+) -> dict:
+    """
+    Finds the two-stage sorting long and short legs
+    """
+    return dict(
+        iterate_splits_per_date(
+            data, start_year, end_year, cost_sensitivity, eligibility_index
+        )
+    )
+
+
+def compare_float32_splits(
+    data: pd.DataFrame,
+    data_float32: pd.DataFrame,
+    dates: list,
+    cost_sensitivity: int = 0,
+    seed: int = 1,
+) -> pd.DataFrame:
+    """
+    Compares final splits on float32 data against the float64 results:
+    leg membership overlap and largest cost-adjusted return difference.
+    Both layouts sample the same spread days of a date
+    """
+    comparison = dict()
+
+    for date_num, date in enumerate(dates):
+        date = pd.Timestamp(date)
+        splits, splits_float32 = [], []
+        for curr_data, curr_splits in [(data, splits), (data_float32, splits_float32)]:
+            reset_random_day_rng(seed + date_num)
+            curr_splits.extend(
+                get_final_splits(
+                    curr_data[
+                        get_date_range_mask(
+                            curr_data, date - pd.DateOffset(years=1), date
+                        )
+                    ],
+                    cost_sensitivity=cost_sensitivity,
+                )
+            )
+
+        for leg, split, split_float32 in zip(
+            ["long_split", "short_split"], splits, splits_float32
+        ):
+            common = split.keys() & split_float32.keys()
+            comparison[(str(date.date()), leg)] = {
+                "membership_overlap": len(common) / max(len(split), 1),
+                "max_return_difference": max(
+                    (
+                        abs(
+                            split[permno]["cost_adjusted_return"]
+                            - split_float32[permno]["cost_adjusted_return"]
+                        )
+                        for permno in common
+                    ),
+                    default=0,
+                ),
+            }
+
+    return pd.DataFrame.from_dict(comparison, orient="index")
 
 
 def get_two_stage_momentum_splits(
-    start_year: int = 2019, end_year: int = 2024, cost_sensitivity: int = 0
-) -> dict:
+    start_year: int = 2019,
+    end_year: int = 2024,
+    cost_sensitivity: int = 0,
+    compact: bool = False,
+    use_float32: bool = False,
+    data: pd.DataFrame = None,
+) -> str:
     """
-    Returns and extracts to a json file final long and short splits
-    for each date of the given period
+    Extracts final long and short splits for each date of the given period
+    to a json lines file, one record per date written as soon as it is
+    sorted, and returns its path. Data of the period is loaded unless it
+    is given
     """
-    splits_per_date = find_splits_per_date(
-        extract_data(f"{start_year}-{end_year} v2.csv"),
+    data_path = f"{start_year}-{end_year} v2.csv"
+    if data is None:
+        data = extract_data(data_path, compact=compact, use_float32=use_float32)
+
+    split_path = get_split_path(start_year, end_year, cost_sensitivity)
+    splits_per_date = iterate_splits_per_date(
+        data,
         start_year,
         end_year,
         cost_sensitivity=cost_sensitivity,
+        eligibility_index=load_eligibility_index(data_path),
     )
-    with open(
-        f"final_split_{start_year}_{end_year}_lambda_{cost_sensitivity}.json", "w"
-    ) as file:
-        json.dump(splits_per_date, file)
+    write_splits(splits_per_date, split_path)
 
-    return splits_per_date
+    return split_path
 
 
 if __name__ == "__main__":
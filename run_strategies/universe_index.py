@@ -0,0 +1,149 @@
+from utils import (
+    extract_data,
+    get_date_range_mask,
+    get_eligibility_index_path,
+    is_compact,
+    is_up_to_date,
+    read_eligibility_index,
+)
+from typing import Iterator, Union
+import pandas as pd
+import numpy as np
+
+
+def load_eligibility_index(data_path: str) -> dict:
+    """
+    Loads the eligibility index of a data file, ingesting the data file
+    only if the index is missing or out of date
+    """
+    index_path = get_eligibility_index_path(data_path)
+    if not is_up_to_date(index_path, data_path):
+        extract_data(data_path)
+
+    return read_eligibility_index(index_path)
+
+
+def get_month_row(index: dict, month: Union[str, pd.Timestamp]) -> int:
+    """
+    Returns the bitmap row of a month, given as a date or a yyyy-mm string
+    """
+    return int(np.datetime64(pd.Timestamp(month), "M") - index["months"][0])
+
+
+def get_eligible_permnos(index: dict, month: Union[str, pd.Timestamp]) -> np.ndarray:
+    """
+    Returns permnos eligible in a month
+    """
+    row = get_month_row(index, month)
+    if not 0 <= row < len(index["months"]):
+        return np.empty(0, dtype=np.int64)
+
+    is_eligible = np.unpackbits(index["bitmap"][row], count=len(index["permnos"]))
+
+    return index["permnos"][is_eligible.astype(bool)]
+
+
+def get_membership_deltas(
+    index: dict, month: Union[str, pd.Timestamp]
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns permnos entering and leaving the universe in a month
+    """
+    row = get_month_row(index, month)
+
+    return tuple(
+        index[f"{name}_permnos"][
+            index[f"{name}_offsets"][row] : index[f"{name}_offsets"][row + 1]
+        ]
+        for name in ["entry", "exit"]
+    )
+
+
+def get_window_permnos(
+    index: dict, end_month: Union[str, pd.Timestamp], window_months: int = 12
+) -> np.ndarray:
+    """
+    Returns permnos eligible in any month of the window ending with
+    end_month, the stocks a formation window of that length can rank
+    """
+    end_row = get_month_row(index, end_month)
+    if end_row < 0:
+        return np.empty(0, dtype=np.int64)
+
+    rows = index["bitmap"][max(end_row - window_months + 1, 0) : end_row + 1]
+
+    is_eligible = np.unpackbits(
+        np.bitwise_or.reduce(rows, axis=0), count=len(index["permnos"])
+    )
+
+    return index["permnos"][is_eligible.astype(bool)]
+
+
+def iterate_window_deltas(
+    index: dict, window_months: int = 12
+) -> Iterator[tuple[np.datetime64, np.ndarray, np.ndarray]]:
+    """
+    Yields per month the permnos entering and leaving the universe of the
+    window ending that month, kept up to date from the months entering
+    and leaving the window instead of rescanning it
+    """
+    num_permnos = len(index["permnos"])
+    window_counts = np.zeros(num_permnos, dtype=np.int64)
+
+    for row, month in enumerate(index["months"]):
+        prev_is_member = window_counts > 0
+        window_counts += np.unpackbits(index["bitmap"][row], count=num_permnos)
+        if row >= window_months:
+            window_counts -= np.unpackbits(
+                index["bitmap"][row - window_months], count=num_permnos
+            )
+        is_member = window_counts > 0
+
+        yield (
+            month,
+            index["permnos"][is_member & ~prev_is_member],
+            index["permnos"][prev_is_member & ~is_member],
+        )
+
+
+def get_row_months(data: pd.DataFrame) -> np.ndarray:
+    """
+    Returns the calendar month of each observation
+    """
+    if is_compact(data):
+        return (
+            data["DlyCalDt"].to_numpy().astype("datetime64[D]").astype("datetime64[M]")
+        )
+
+    return data["DlyCalDt"].to_numpy().astype("datetime64[M]")
+
+
+def iterate_window_data(
+    data: pd.DataFrame, index: dict, dates: Iterator[pd.Timestamp]
+) -> Iterator[tuple[pd.Timestamp, pd.DataFrame, np.ndarray]]:
+    """
+    Yields per month-end date the observations of its one year formation
+    window and the permnos eligible in it. Rows are grouped by month of
+    the index once, so a window only filters the blocks of its months
+    instead of rescanning the data
+    """
+    rows = (get_row_months(data) - index["months"][0]).astype(np.int64)
+    order = np.argsort(rows, kind="stable")
+    offsets = np.searchsorted(rows[order], np.arange(len(index["months"]) + 1))
+
+    for date in dates:
+        end_row = get_month_row(index, date)
+        # A window after a leap year starts on the 29th of February
+        first_row, last_row = (
+            min(max(row, 0), len(index["months"]))
+            for row in (end_row - 12, end_row + 1)
+        )
+        window_data = data.iloc[np.sort(order[offsets[first_row] : offsets[last_row]])]
+
+        yield (
+            date,
+            window_data[
+                get_date_range_mask(window_data, date - pd.DateOffset(years=1), date)
+            ],
+            get_window_permnos(index, date),
+        )
@@ -0,0 +1,481 @@
+from datetime import datetime
+from utils import WEIGHTINGS, extract_data, get_date_range_mask
+from run_strategies.two_stage_momentum import (
+    get_stock_returns,
+    get_daily_returns_for_permnos,
+    find_momentum_split,
+)
+from run_strategies.portfolio_return import find_returns_per_mo_stock
+from run_strategies.final_strat_stats import get_strategy_stats
+from run_strategies.garch_rv import sigma_hat_rv
+import pandas as pd
+import numpy as np
+import math
+
+
+def get_grid_leg_selection(
+    stock_returns: pd.DataFrame,
+    permnos: pd.Index,
+    cost_sensitivities: np.ndarray,
+    keep: float,
+    is_long: bool,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Runs the cost-adjusted stage of the sort for all cost sensitivities at
+    once, returns a (lambdas x stocks) mask of the kept stocks and the
+    position of the last kept stock per lambda
+    """
+    cumulative_returns = stock_returns["cumulative_return"][permnos].to_numpy()
+    avg_quoted_spreads = stock_returns["avg_quoted_spread"][permnos].to_numpy()
+    sign = -1 if is_long else 1
+    cost_adjusted_returns = (
+        cumulative_returns[None, :]
+        + sign * cost_sensitivities[:, None] * avg_quoted_spreads[None, :]
+    )
+
+    # A stable sort breaks ties like nlargest and nsmallest
+    num_kept = int(len(permnos) * keep)
+    order = np.argsort(sign * cost_adjusted_returns, axis=1, kind="stable")[
+        :, :num_kept
+    ]
+    is_kept = np.zeros(cost_adjusted_returns.shape, dtype=bool)
+    np.put_along_axis(is_kept, order, True, axis=1)
+
+    return is_kept, order[:, -1] if num_kept else np.zeros(0, dtype=int)
+
+
+def get_grid_weights(
+    is_kept: np.ndarray, avg_market_caps: np.ndarray, is_weighting_func_equal: bool
+) -> np.ndarray:
+    """
+    Returns (lambdas x stocks) unscaled leg weights, the layout of
+    get_equal_weights and get_value_weights
+    """
+    leg_sizes = is_kept * (1 if is_weighting_func_equal else avg_market_caps[None, :])
+
+    return leg_sizes / leg_sizes.sum(axis=1, keepdims=True)
+
+
+def get_grid_sum_sq_ret(
+    long_weights: np.ndarray,
+    short_weights: np.ndarray,
+    long_daily_returns: np.ndarray,
+    short_daily_returns: np.ndarray,
+) -> np.ndarray:
+    """
+    Computes the sum of squared WML returns of compute_sum_sq_ret for
+    all lambdas, from (stocks x 125) zero-padded daily returns
+    """
+    return (
+        (long_weights @ long_daily_returns - short_weights @ short_daily_returns) ** 2
+    ).sum(axis=1)
+
+
+def get_padded_daily_returns(
+    window_data: pd.DataFrame, permnos: pd.Index, num_days: int = 125
+) -> np.ndarray:
+    """
+    Stacks the first num_days daily returns of each stock, zero-padded
+    """
+    daily_returns = get_daily_returns_for_permnos(window_data, permnos)
+    padded = np.zeros((len(permnos), num_days))
+    for i, permno in enumerate(permnos):
+        stock_returns = daily_returns[permno][:num_days]
+        padded[i, : len(stock_returns)] = stock_returns
+
+    return padded
+
+
+def get_holding_returns(
+    cum_returns_per_month: dict, year: int, month: int, permnos: pd.Index
+) -> pd.Series:
+    """
+    Returns the compound return of each stock over the holding month,
+    zero for stocks without observations
+    """
+    return pd.Series(
+        [
+            cum_returns_per_month.get((year, month, int(permno)), {}).get(
+                "cumulative_return", 0
+            )
+            for permno in permnos
+        ],
+        index=permnos,
+    )
+
+
+def get_grid_leg_costs(
+    weights: pd.DataFrame,
+    avg_quoted_spreads: pd.Series,
+    prev_weights: pd.DataFrame,
+    prev_avg_quoted_spreads: pd.Series,
+    cum_returns_per_month: dict,
+    year: int,
+    month: int,
+    drift_returns: np.ndarray = None,
+) -> np.ndarray:
+    """
+    Computes the leg costs of compute_total_cost_for_date for all lambdas:
+    rebalancing of kept stocks from previous weights drifted with their
+    holding returns, unless per-lambda drift returns are given, and
+    liquidation of stocks that left the leg
+    """
+    if prev_weights is None:
+        return (weights.abs() * avg_quoted_spreads / 2).sum(axis=1).to_numpy()
+
+    permnos = weights.columns.union(prev_weights.columns)
+    weights = weights.reindex(columns=permnos, fill_value=0).to_numpy()
+    prev_weights = prev_weights.reindex(columns=permnos, fill_value=0).to_numpy()
+    returns = get_holding_returns(
+        cum_returns_per_month, year, month, permnos
+    ).to_numpy()
+    is_held = weights != 0
+    if drift_returns is None:
+        drift_returns = returns[None, :]
+
+    rebalancing = (
+        np.abs(weights - prev_weights * (1 + drift_returns))
+        * avg_quoted_spreads.reindex(permnos, fill_value=0).to_numpy()
+        / 2
+    )
+    liquidation = (
+        np.abs(prev_weights * (1 + returns))
+        * prev_avg_quoted_spreads.reindex(permnos, fill_value=0).to_numpy()
+        / 2
+    )
+
+    return np.where(is_held, rebalancing, liquidation).sum(axis=1)
+
+
+def get_lambda_grid_returns(
+    data: pd.DataFrame,
+    start_year: int,
+    end_year: int,
+    cost_sensitivities: np.ndarray,
+    hedged: bool = False,
+    keep_long: float = 0.5,
+    keep_short: float = 0.5,
+    sigma_target: float = 0.12 / math.sqrt(12),
+    cum_returns_per_month: dict = None,
+) -> dict:
+    """
+    Computes monthly WML returns and costs for all cost sensitivities in
+    one pass: the first sort stage and the formation window aggregates
+    are shared and the cost-adjusted stage runs as one array operation.
+    Returns (gross returns, costs) frames of months x lambdas per
+    weighting, together with the legs of every lambda per month for
+    recosting a path through the grid. Hedging uses RV forecasts
+    """
+    cost_sensitivities = np.asarray(cost_sensitivities, dtype=float)
+    if cum_returns_per_month is None:
+        cum_returns_per_month = find_returns_per_mo_stock(data)
+    grid_returns = {weighting: ({}, {}) for weighting in WEIGHTINGS}
+    grid_legs = {weighting: dict() for weighting in WEIGHTINGS}
+    prev_legs = {weighting: (None, None, None, None) for weighting in WEIGHTINGS}
+
+    # The month after end_year has no returns in the data and is left out
+    for date in pd.date_range(
+        start=datetime(start_year, 12, 31), end=datetime(end_year, 11, 30), freq="ME"
+    ):
+        print(date)
+        window_data = data[
+            get_date_range_mask(data, date - pd.DateOffset(years=1), date)
+        ]
+        stock_returns = get_stock_returns(window_data, with_daily_returns=False)
+        long_permnos, short_permnos = find_momentum_split(stock_returns)
+        (long_kept, last_long), (short_kept, _) = (
+            get_grid_leg_selection(
+                stock_returns, permnos, cost_sensitivities, keep, is_long
+            )
+            for permnos, keep, is_long in [
+                (long_permnos, keep_long, True),
+                (short_permnos, keep_short, False),
+            ]
+        )
+        if hedged:
+            long_daily_returns, short_daily_returns = (
+                get_padded_daily_returns(window_data, permnos)
+                for permnos in (long_permnos, short_permnos)
+            )
+
+        holding_month = date + pd.DateOffset(months=1)
+        year, month = holding_month.year, holding_month.month
+        long_returns, short_returns = (
+            get_holding_returns(cum_returns_per_month, year, month, permnos)
+            for permnos in (long_permnos, short_permnos)
+        )
+        long_spreads, short_spreads = (
+            stock_returns["avg_quoted_spread"][permnos]
+            for permnos in (long_permnos, short_permnos)
+        )
+
+        for weighting in WEIGHTINGS:
+            long_weights, short_weights = (
+                sign
+                * get_grid_weights(
+                    is_kept,
+                    stock_returns["avg_market_cap"][permnos].to_numpy(),
+                    weighting == "equal",
+                )
+                for sign, is_kept, permnos in [
+                    (1, long_kept, long_permnos),
+                    (-1, short_kept, short_permnos),
+                ]
+            )
+            if hedged:
+                scale_factors = sigma_target / sigma_hat_rv(
+                    get_grid_sum_sq_ret(
+                        long_weights,
+                        short_weights,
+                        long_daily_returns,
+                        short_daily_returns,
+                    )
+                )
+                long_weights = long_weights * scale_factors[:, None]
+                short_weights = short_weights * scale_factors[:, None]
+
+            gross_returns, costs = grid_returns[weighting]
+            gross_returns[(year, month)] = (
+                long_weights @ long_returns.to_numpy()
+                + short_weights @ short_returns.to_numpy()
+            )
+
+            long_weights, short_weights = (
+                pd.DataFrame(weights, index=cost_sensitivities, columns=permnos)
+                for weights, permnos in [
+                    (long_weights, long_permnos),
+                    (short_weights, short_permnos),
+                ]
+            )
+            (
+                prev_long_weights,
+                prev_long_spreads,
+                prev_short_weights,
+                prev_short_spreads,
+            ) = prev_legs[weighting]
+            # Short weights drift with the return of the last long stock,
+            # as in compute_total_cost_for_date
+            costs[(year, month)] = get_grid_leg_costs(
+                long_weights,
+                long_spreads,
+                prev_long_weights,
+                prev_long_spreads,
+                cum_returns_per_month,
+                year,
+                month,
+            ) + get_grid_leg_costs(
+                short_weights,
+                short_spreads,
+                prev_short_weights,
+                prev_short_spreads,
+                cum_returns_per_month,
+                year,
+                month,
+                long_returns.to_numpy()[last_long][:, None],
+            )
+            prev_legs[weighting] = (
+                long_weights,
+                long_spreads,
+                short_weights,
+                short_spreads,
+            )
+            grid_legs[weighting][(year, month)] = (
+                *prev_legs[weighting],
+                long_returns.to_numpy()[last_long],
+            )
+
+    return {
+        weighting: (
+            *(
+                pd.DataFrame(
+                    list(per_month.values()),
+                    index=pd.MultiIndex.from_tuples(per_month, names=["year", "month"]),
+                    columns=cost_sensitivities,
+                )
+                for per_month in grid_returns[weighting]
+            ),
+            grid_legs[weighting],
+        )
+        for weighting in WEIGHTINGS
+    }
+
+
+def get_trailing_scores(
+    net_returns: pd.DataFrame, window: int, criterion: str
+) -> pd.DataFrame:
+    """
+    Scores each lambda by its net performance over the window months
+    before each month, so that a score only uses past returns
+    """
+    trailing_mean = net_returns.rolling(window).mean().shift(1)
+    if criterion == "mean":
+        return trailing_mean
+
+    return trailing_mean / net_returns.rolling(window).std(ddof=0).shift(1)
+
+
+def select_walk_forward_lambdas(
+    net_returns: pd.DataFrame, window: int = 36, criterion: str = "sharpe"
+) -> pd.Series:
+    """
+    Picks for each month the lambda with the best trailing net mean
+    return or Sharpe ratio, months without a full window are left out
+    """
+    trailing_scores = get_trailing_scores(net_returns, window, criterion)
+
+    return trailing_scores.dropna(how="all").idxmax(axis=1)
+
+
+def get_lambda_legs(month_legs: tuple, row: int) -> tuple:
+    """
+    Returns the long and short weights and spreads of one lambda of the
+    legs of a month
+    """
+    long_weights, long_spreads, short_weights, short_spreads, _ = month_legs
+
+    return (
+        long_weights.iloc[[row]],
+        long_spreads,
+        short_weights.iloc[[row]],
+        short_spreads,
+    )
+
+
+def get_path_costs(
+    legs: dict, selected_lambdas: pd.Series, cum_returns_per_month: dict
+) -> np.ndarray:
+    """
+    Computes the costs of trading along a path of lambdas: each month the
+    previously selected legs, drifted, are rebalanced into the newly
+    selected ones. The path starts from the previous month's legs of its
+    first lambda, so months without a switch cost what the fixed lambda
+    run pays
+    """
+    months = list(legs)
+    path_costs = []
+
+    for (year, month), cost_sensitivity in selected_lambdas.items():
+        month_num = months.index((year, month))
+        row = legs[(year, month)][0].index.get_loc(cost_sensitivity)
+        if not path_costs:
+            prev_legs = (
+                get_lambda_legs(legs[months[month_num - 1]], row)
+                if month_num
+                else (None, None, None, None)
+            )
+        curr_legs = get_lambda_legs(legs[(year, month)], row)
+        last_long_returns = legs[(year, month)][4]
+
+        # Short weights drift with the return of the last long stock,
+        # as in compute_total_cost_for_date
+        path_costs.append(
+            get_grid_leg_costs(
+                *curr_legs[:2],
+                *prev_legs[:2],
+                cum_returns_per_month,
+                year,
+                month,
+            )[0]
+            + get_grid_leg_costs(
+                *curr_legs[2:],
+                *prev_legs[2:],
+                cum_returns_per_month,
+                year,
+                month,
+                last_long_returns[[row], None],
+            )[0]
+        )
+        prev_legs = curr_legs
+
+    return np.asarray(path_costs)
+
+
+def get_walk_forward_returns(
+    gross_returns: pd.DataFrame,
+    costs: pd.DataFrame,
+    legs: dict,
+    cum_returns_per_month: dict,
+    window: int = 36,
+    criterion: str = "sharpe",
+) -> pd.DataFrame:
+    """
+    Gets monthly returns and costs of the strategy trading each month
+    with the lambda selected on the trailing window, costs include the
+    trades of switching between lambdas
+    """
+    selected_lambdas = select_walk_forward_lambdas(
+        gross_returns - costs, window, criterion
+    )
+    rows = gross_returns.index.get_indexer(selected_lambdas.index)
+    cols = gross_returns.columns.get_indexer(selected_lambdas)
+
+    return pd.DataFrame(
+        {
+            "lambda": selected_lambdas,
+            "total_return": gross_returns.to_numpy()[rows, cols],
+            "total_cost": get_path_costs(legs, selected_lambdas, cum_returns_per_month),
+        },
+        index=selected_lambdas.index,
+    )
+
+
+def get_walk_forward_report(
+    gross_returns: pd.DataFrame, costs: pd.DataFrame, walk_forward: pd.DataFrame
+) -> pd.DataFrame:
+    """
+    Compares the out-of-sample statistics of the adaptive strategy with
+    every fixed lambda over the same months
+    """
+    report = {"adaptive": get_strategy_stats(walk_forward)}
+    for cost_sensitivity in gross_returns.columns:
+        report[cost_sensitivity] = get_strategy_stats(
+            pd.DataFrame(
+                {
+                    "total_return": gross_returns[cost_sensitivity],
+                    "total_cost": costs[cost_sensitivity],
+                }
+            ).loc[walk_forward.index]
+        )
+
+    return pd.DataFrame.from_dict(report, orient="index").rename_axis("lambda")
+
+
+def run_walk_forward(
+    start_year: int = 2005,
+    end_year: int = 2024,
+    cost_sensitivities: np.ndarray = np.arange(0, 25),
+    window: int = 36,
+    criterion: str = "sharpe",
+    hedged: bool = False,
+) -> dict:
+    """
+    Runs walk-forward lambda selection for both weightings, saves the
+    adaptive strategy returns and the out-of-sample report of each
+    """
+    data = extract_data(f"{start_year}-{end_year} v2.csv")
+    cum_returns_per_month = find_returns_per_mo_stock(data)
+    grid_returns = get_lambda_grid_returns(
+        data,
+        start_year,
+        end_year,
+        cost_sensitivities,
+        hedged,
+        cum_returns_per_month=cum_returns_per_month,
+    )
+    reports = dict()
+
+    for weighting, (gross_returns, costs, legs) in grid_returns.items():
+        walk_forward = get_walk_forward_returns(
+            gross_returns, costs, legs, cum_returns_per_month, window, criterion
+        )
+        walk_forward.to_csv(
+            f"walk_forward_{weighting}_{start_year}_{end_year}_{criterion}.csv"
+        )
+        reports[weighting] = get_walk_forward_report(gross_returns, costs, walk_forward)
+        print(f"{weighting}:\n{reports[weighting]}")
+
+    return reports
+
+
+if __name__ == "__main__":
+    run_walk_forward()
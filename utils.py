@@ -1,10 +1,19 @@
 import pandas as pd
-from typing import Union
+import numpy as np
+import json
+import os
+from typing import Iterable, Iterator, Union
 
 
 HEDGING = ["standard", "hedged_rv", "hedged_garch"]
 WEIGHTINGS = ["equal", "value"]
 LAMBDAS = ["0", "1", "6", "12"]
+MODEL_NAMES = {
+    (False, False): "standard",
+    (True, True): "hedged_rv",
+    (True, False): "hedged_garch",
+}
+COMPACT_FLOAT_COLS = ["DlyRet", "quoted_spread", "DlyCap"]
 
 
 def compute_compound_return(returns: Union[list, pd.Series]) -> float:
@@ -18,13 +27,13 @@ def compute_compound_return(returns: Union[list, pd.Series]) -> float:
     return final_return - 1
 
 
-def clean_data(data: pd.DataFrame) -> pd.DataFrame:
+def get_eligibility_mask(data: pd.DataFrame) -> pd.Series:
     """
-    Removes irrelevant or non-informative observations
+    Returns mask of the relevant and informative observations of raw data
     """
-    data = data.dropna()
-    data = data[
-        (data["ShareType"] == "NS")
+    return (
+        data.notna().all(axis=1)
+        & (data["ShareType"] == "NS")
         & (data["SecurityType"] == "EQTY")
         & (data["SecuritySubType"] == "COM")
         & (data["USIncFlg"] == "Y")
@@ -32,10 +41,102 @@ def clean_data(data: pd.DataFrame) -> pd.DataFrame:
         & (data["PrimaryExch"].isin(["N", "Q", "A"]))
         & (data["ConditionalType"].isin(["RW", "NW"]))
         & (data["TradingStatusFlg"] == "A")
-    ]
-    data = data[~data["DlyRet"].apply(lambda x: isinstance(x, str))]
+        & ~data["DlyRet"].apply(lambda x: isinstance(x, str))
+    )
 
-    return data
+
+def build_eligibility_index(eligible_data: pd.DataFrame) -> dict:
+    """
+    Builds a bitmap of the permnos with eligible observations in each
+    calendar month of cleaned data, together with the permnos entering
+    and leaving the universe per month in csr layout
+    """
+    months = (
+        pd.to_datetime(eligible_data["DlyCalDt"]).to_numpy().astype("datetime64[M]")
+    )
+    eligible_permnos = eligible_data["PERMNO"].to_numpy().astype(np.int64)
+
+    permnos = np.unique(eligible_permnos)
+    month_axis = np.arange(months.min(), months.max() + 1)
+    is_eligible = np.zeros((len(month_axis), len(permnos)), dtype=bool)
+    is_eligible[
+        (months - month_axis[0]).astype(np.int64),
+        np.searchsorted(permnos, eligible_permnos),
+    ] = True
+
+    # The universe is empty before the first month
+    was_eligible = np.vstack(
+        [np.zeros((1, len(permnos)), dtype=bool), is_eligible[:-1]]
+    )
+    index = {
+        "months": month_axis,
+        "permnos": permnos,
+        "bitmap": np.packbits(is_eligible, axis=1),
+    }
+    for name, is_changed in [
+        ("entry", is_eligible & ~was_eligible),
+        ("exit", was_eligible & ~is_eligible),
+    ]:
+        rows, cols = np.nonzero(is_changed)
+        index[f"{name}_permnos"] = permnos[cols]
+        index[f"{name}_offsets"] = np.searchsorted(rows, np.arange(len(month_axis) + 1))
+
+    return index
+
+
+def save_eligibility_index(index: dict, path: str) -> None:
+    """
+    Saves an eligibility index to a compressed npz file
+    """
+    np.savez_compressed(path, **{**index, "months": index["months"].astype(np.int64)})
+
+
+def read_eligibility_index(path: str) -> dict:
+    """
+    Reads an eligibility index saved by save_eligibility_index
+    """
+    with np.load(path) as components:
+        index = {name: components[name] for name in components.files}
+    index["months"] = index["months"].astype("datetime64[M]")
+
+    return index
+
+
+def get_indexed_rows_mask(data: pd.DataFrame, index: dict) -> np.ndarray:
+    """
+    Returns mask of the raw observations whose permno is eligible in their
+    month according to the index, only these can pass clean_data
+    """
+    months = pd.to_datetime(data["DlyCalDt"]).to_numpy().astype("datetime64[M]")
+    rows = (months - index["months"][0]).astype(np.int64)
+    permnos = data["PERMNO"].to_numpy()
+    cols = np.minimum(
+        np.searchsorted(index["permnos"], permnos), len(index["permnos"]) - 1
+    )
+    is_indexed = (
+        ~np.isnat(months)
+        & (rows >= 0)
+        & (rows < len(index["months"]))
+        & (index["permnos"][cols] == permnos)
+    )
+
+    bits = np.zeros(len(data), dtype=np.uint8)
+    bits[is_indexed] = index["bitmap"][rows[is_indexed], cols[is_indexed] >> 3] >> (
+        7 - (cols[is_indexed] & 7)
+    )
+
+    return (bits & 1).astype(bool)
+
+
+def clean_data(data: pd.DataFrame, eligibility_index: dict = None) -> pd.DataFrame:
+    """
+    Removes irrelevant or non-informative observations, with an
+    eligibility index the predicates only run on stock months it lists
+    """
+    if eligibility_index is not None:
+        data = data[get_indexed_rows_mask(data, eligibility_index)]
+
+    return data[get_eligibility_mask(data)]
 
 
 def adjust_data_cols(data: pd.DataFrame) -> None:
@@ -51,11 +152,71 @@ def adjust_data_cols(data: pd.DataFrame) -> None:
     data["DlyRet"] = data["DlyRet"].astype("float")
 
 
-def extract_data(path: str) -> pd.DataFrame:
+def compact_data_cols(data: pd.DataFrame, use_float32: bool = False) -> pd.DataFrame:
+    """
+    Converts prepared data to the compact layout: int32 PERMNO, int32 day
+    numbers instead of datetimes, no stored year and month, and optionally
+    float32 returns, spreads and caps
+    """
+    data = data[["PERMNO", "DlyCalDt", *COMPACT_FLOAT_COLS]].copy()
+    data["PERMNO"] = data["PERMNO"].astype("int32")
+    data["DlyCalDt"] = (
+        data["DlyCalDt"].to_numpy().astype("datetime64[D]").astype("int32")
+    )
+
+    if use_float32:
+        data[COMPACT_FLOAT_COLS] = data[COMPACT_FLOAT_COLS].astype("float32")
+
+    return data
+
+
+def is_compact(data: pd.DataFrame) -> bool:
+    """
+    Checks whether data is in the compact layout
+    """
+    return "year" not in data.columns
+
+
+def get_year_month(data: pd.DataFrame) -> tuple[pd.Series, pd.Series]:
+    """
+    Returns year and month of each observation, derived from the
+    day numbers in the compact layout
+    """
+    if not is_compact(data):
+        return data["year"], data["month"]
+
+    months = (
+        data["DlyCalDt"].to_numpy().astype("datetime64[D]").astype("datetime64[M]")
+    ).astype("int64")
+
+    return (
+        pd.Series(months // 12 + 1970, index=data.index, name="year"),
+        pd.Series(months % 12 + 1, index=data.index, name="month"),
+    )
+
+
+def get_date_range_mask(
+    data: pd.DataFrame, start_date: pd.Timestamp, end_date: pd.Timestamp
+) -> pd.Series:
+    """
+    Returns mask of observations after start_date up to and including end_date
+    """
+    if not is_compact(data):
+        return (data["DlyCalDt"] <= end_date) & (data["DlyCalDt"] > start_date)
+
+    start_day, end_day = (
+        np.datetime64(date.date(), "D").astype("int32")
+        for date in (start_date, end_date)
+    )
+
+    return (data["DlyCalDt"] <= end_day) & (data["DlyCalDt"] > start_day)
+
+
+def prepare_data(data: pd.DataFrame, eligibility_index: dict = None) -> pd.DataFrame:
     """
-    Reads and prepares data
+    Cleans raw data, keeps the relevant columns and adjusts them
     """
-    data_cleaned = clean_data(pd.read_csv(path))[
+    data_cleaned = clean_data(data, eligibility_index)[
         [
             "PERMNO",
             "DlyCalDt",
@@ -71,5 +232,157 @@ def extract_data(path: str) -> pd.DataFrame:
     return data_cleaned
 
 
+def get_aggregates_path(path: str) -> str:
+    """
+    Returns path of the monthly aggregates table of a data file
+    """
+    return f"{os.path.splitext(path)[0]} monthly aggregates.csv"
+
+
+def compute_monthly_aggregates(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Computes monthly cross-sectional aggregates: quoted spread statistics,
+    stock counts and dispersion of monthly stock returns
+    """
+    data = data.assign(
+        gross_return=data["DlyRet"] + 1,
+        weighted_spread=data["quoted_spread"] * data["DlyCap"],
+    )
+    per_month = data.groupby(["year", "month"])
+    stock_returns = data.groupby(["year", "month", "PERMNO"])["gross_return"].prod() - 1
+
+    return pd.DataFrame(
+        {
+            "mean_quoted_spread": per_month["quoted_spread"].mean(),
+            "median_quoted_spread": per_month["quoted_spread"].median(),
+            "cap_weighted_quoted_spread": per_month["weighted_spread"].sum()
+            / per_month["DlyCap"].sum(),
+            "num_stocks": per_month["PERMNO"].nunique(),
+            "return_dispersion": stock_returns.groupby(["year", "month"]).std(),
+        }
+    )
+
+
+def is_up_to_date(derived_path: str, source_path: str) -> bool:
+    """
+    Checks whether a file derived from a data file exists and is not
+    older than the data file
+    """
+    return os.path.exists(derived_path) and os.path.getmtime(
+        derived_path
+    ) >= os.path.getmtime(source_path)
+
+
+def load_monthly_aggregates(path: str) -> pd.DataFrame:
+    """
+    Loads the monthly aggregates of a data file, ingesting the data file
+    only if they are missing or older than it
+    """
+    if not is_up_to_date(get_aggregates_path(path), path):
+        extract_data(path)
+
+    return pd.read_csv(get_aggregates_path(path), index_col=["year", "month"])
+
+
+def get_eligibility_index_path(path: str) -> str:
+    """
+    Returns path of the monthly eligibility index of a data file
+    """
+    return f"{os.path.splitext(path)[0]} eligibility.npz"
+
+
+def get_split_path(
+    start_year: int, end_year: int, cost_sensitivity: int, conditioning: str = None
+) -> str:
+    """
+    Returns path of the two-stage sort output, one json record per date,
+    conditional double sorts are marked with their conditioning variable
+    """
+    suffix = "" if conditioning is None else f"_{conditioning}"
+
+    return (
+        f"final_split_{start_year}_{end_year}_lambda_{cost_sensitivity}{suffix}.jsonl"
+    )
+
+
+def get_holdings_path(
+    model_name: str,
+    weighting: str,
+    start_year: int,
+    end_year: int,
+    cost_sensitivity: int,
+    conditioning: str = None,
+) -> str:
+    """
+    Returns path of the stored holdings and trades of a run, runs on
+    conditional double sorts are marked with their conditioning variable
+    """
+    suffix = "" if conditioning is None else f"_{conditioning}"
+
+    return (
+        f"holdings_{model_name}_{weighting}_{start_year}_{end_year}"
+        + f"_lambda_{cost_sensitivity}{suffix}.npz"
+    )
+
+
+def write_splits(splits: Iterable, path: str, mode: str = "w") -> None:
+    """
+    Writes (date, splits) pairs as they come, one json line per date
+    """
+    with open(path, mode) as file:
+        for date, splits_for_date in splits:
+            file.write(json.dumps({"date": date, **splits_for_date}) + "\n")
+
+
+def read_splits(
+    start_year: int, end_year: int, cost_sensitivity: int, conditioning: str = None
+) -> Iterator[tuple[str, dict]]:
+    """
+    Lazily yields (date, splits) pairs of the two-stage sort output, so only
+    one date is parsed at a time; output in the former single json layout
+    is still read, but in one go
+    """
+    path = get_split_path(start_year, end_year, cost_sensitivity, conditioning)
+
+    if not os.path.exists(path):
+        with open(os.path.splitext(path)[0] + ".json") as json_file:
+            yield from json.load(json_file).items()
+        return
+
+    with open(path) as file:
+        for line in file:
+            record = json.loads(line)
+            yield record.pop("date"), record
+
+
+def extract_data(
+    path: str,
+    compact: bool = False,
+    use_float32: bool = False,
+) -> pd.DataFrame:
+    """
+    Reads and prepares data. The eligibility index of the data file
+    speeds up cleaning, it is built from the cleaned data if it is
+    missing or out of date. The monthly aggregates are materialized the
+    same way. use_float32 implies the compact layout
+    """
+    index_path = get_eligibility_index_path(path)
+    if is_up_to_date(index_path, path):
+        data_cleaned = prepare_data(
+            pd.read_csv(path), read_eligibility_index(index_path)
+        )
+    else:
+        data_cleaned = prepare_data(pd.read_csv(path))
+        save_eligibility_index(build_eligibility_index(data_cleaned), index_path)
+
+    if not is_up_to_date(get_aggregates_path(path), path):
+        compute_monthly_aggregates(data_cleaned).to_csv(get_aggregates_path(path))
+
+    if compact or use_float32:
+        return compact_data_cols(data_cleaned, use_float32)
+
+    return data_cleaned
+
+
 if __name__ == "__main__":
     pass